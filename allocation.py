@@ -0,0 +1,76 @@
+import heapq
+
+policies = ("lowest", "nearest", "balanced")
+standard = "standard"
+
+
+class SpotQueue:
+    # Min-heap of (key, spot) over free spots. A released spot is pushed again
+    # and taken spots are only dropped once they reach the top, so take,
+    # release and peek stay O(log n). Stale duplicates are compacted away
+    # when the heap grows past twice the spots it can hold.
+    def __init__(self, entries, capacity):
+        self.heap = list(entries)
+        heapq.heapify(self.heap)
+        self.limit = 2 * capacity + 64
+
+    def push(self, key, spot, is_free):
+        heapq.heappush(self.heap, (key, spot))
+        if len(self.heap) > self.limit:
+            self.heap = [entry for entry in set(self.heap) if is_free(entry[1])]
+            heapq.heapify(self.heap)
+
+    def peek(self, is_free):
+        heap = self.heap
+        while heap and not is_free(heap[0][1]):
+            heapq.heappop(heap)
+        return heap[0][1] if heap else None
+
+
+class OrderedIndex:
+    # The free spot with the smallest key: the lowest number, or the
+    # shortest distance to the entrance.
+    def __init__(self, key, spots, is_free):
+        self.key = key
+        self.is_free = is_free
+        self.queue = SpotQueue(((key(spot), spot) for spot in spots if is_free(spot)), len(spots))
+
+    def taken(self, spot):
+        pass
+
+    def released(self, spot):
+        self.queue.push(self.key(spot), spot, self.is_free)
+
+    def next_free(self):
+        return self.queue.peek(self.is_free)
+
+
+class LevelIndex:
+    # The lowest free spot on the level with the most free spots. Levels are
+    # few, so picking one is a max over their counters; the spot within the
+    # level comes from that level's queue.
+    def __init__(self, level_of, spots, is_free):
+        self.level_of = level_of
+        self.is_free = is_free
+        by_level = {}
+        for spot in spots:
+            by_level.setdefault(level_of(spot), []).append(spot)
+        self.queues = {level: SpotQueue(((spot, spot) for spot in members if is_free(spot)), len(members))
+                       for level, members in by_level.items()}
+        self.free = {level: sum(1 for spot in members if is_free(spot)) for level, members in by_level.items()}
+
+    def taken(self, spot):
+        self.free[self.level_of(spot)] -= 1
+
+    def released(self, spot):
+        level = self.level_of(spot)
+        self.free[level] += 1
+        self.queues[level].push(spot, spot, self.is_free)
+
+    def next_free(self):
+        if not self.free:
+            return None
+        level = max(self.free, key=lambda level: (self.free[level], -level))
+        if not self.free[level]:
+            return None
+        return self.queues[level].peek(self.is_free)
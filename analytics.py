@@ -0,0 +1,44 @@
+import itertools
+
+hour = 3600
+
+
+def hour_of(timestamp):
+    return timestamp - timestamp % hour
+
+
+def session_runs(events):
+    # Consecutive events of the same kind, so a batch becomes one statement
+    # while the order of a park after a leave of the same spot is kept.
+    for kind, run in itertools.groupby(events, key=lambda event: event[0]):
+        yield kind, list(run)
+
+
+def occupancy_buckets(occupied, rows, start, end, bucket):
+    # rows are (hour, arrivals, departures) of the hours in [start, end) in
+    # order, occupied is the number of cars parked at start.
+    buckets = []
+    rows = iter(rows)
+    row = next(rows, None)
+    for bucket_start in range(start, end, bucket):
+        arrivals = departures = 0
+        while row is not None and row[0] < bucket_start + bucket:
+            arrivals += row[1]
+            departures += row[2]
+            row = next(rows, None)
+        occupied += arrivals - departures
+        buckets.append({"start": bucket_start, "arrivals": arrivals, "departures": departures, "occupied": occupied})
+    return buckets
+
+
+def peak_hours(buckets, top):
+    # Hours of the day (UTC) ranked by the cars parked at their end, averaged
+    # over the days of hourly buckets.
+    days = {}
+    for bucket in buckets:
+        days.setdefault(bucket["start"] // hour % 24, []).append(bucket)
+    ranked = sorted(((sum(bucket["occupied"] for bucket in hours) / len(hours),
+                      sum(bucket["arrivals"] for bucket in hours) / len(hours), hour_of_day)
+                     for hour_of_day, hours in days.items()), key=lambda ranking: (-ranking[0], -ranking[1], ranking[2]))
+    return [{"hour": hour_of_day, "average occupied": round(occupied, 1), "average arrivals": round(arrivals, 1)}
+            for occupied, arrivals, hour_of_day in ranked[:top]]
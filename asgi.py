@@ -0,0 +1,526 @@
+# Async serving mode: the parking API on Starlette with an async SQLAlchemy
+# engine (aiosqlite for SQLite, asyncpg for PostgreSQL). The handlers here only
+# adapt requests: reading and changing spots is done by the lot operations of
+# main.py, on the same tables, token cache and occupancy map, so both servers
+# return the same JSON and clients can switch between them freely.
+#
+#   pip install starlette uvicorn aiosqlite
+#   uvicorn asgi:app --host 0.0.0.0 --port 5000
+import asyncio
+import contextlib
+import time
+
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.responses import JSONResponse as StarletteJSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route, Router
+from werkzeug.http import parse_etags
+
+import storage
+from allocation import policies as allocation_policies
+from analytics import hour, peak_hours
+from main import app as flask_app, message, default_lot, lots, journal, token_cache, new_token, token_digest, \
+    spots_committed, shared_state_poller, cache_headers, bare_token, check_signed_token, revocations, \
+    report_window, report_bucket, too_many_buckets, expire_holds, lot_etag, registry, request_duration, auth_duration, \
+    not_authorized, token_expired, no_free_spots, no_such_car, revoke_confirmation, AuthorizationModel, \
+    lot_version, bump_version, record_changes, load_lot, parked_cars, parked_car_line, find_car, all_parked_cars, \
+    parked_cars_page, parked_cars_columns, clamp_page_size, level_counts, lot_list, lot_spot_rows, already_parked, \
+    park_car, leave_spot, hold_spot, release_hold, move_car, batch_too_large, park_cars, leave_spots, batch_conflict, \
+    occupancy_report, dwell_report, vehicle_sessions, live_revocations, store_revocation, forget_token, known_lot, \
+    unknown_lot, start_token_reaper, not_whole_number, caches_legacy_tokens
+from serialization import backend, encode
+from tokens import is_signed
+
+async_drivers = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}
+
+tokens = AuthorizationModel.__table__
+
+
+def async_uri(uri):
+    url = make_url(uri)
+    backend = url.get_backend_name()
+    if backend not in async_drivers:
+        raise ValueError(f"No async driver configured for {backend}")
+    if backend == "sqlite" and url.database and url.database != ":memory:" and not url.database.startswith("/"):
+        # Flask-SQLAlchemy resolves relative SQLite paths against the instance folder.
+        url = url.set(database=f"{flask_app.instance_path}/{url.database}")
+    return url.set(drivername=async_drivers[backend])
+
+
+def create_engine(uri):
+    async_engine = create_async_engine(async_uri(uri), **storage.engine_options(uri))
+    storage.install_pragmas(async_engine.sync_engine, storage.sqlite_pragmas(flask_app.config['STORAGE_PROFILE']))
+    return async_engine
+
+
+engine = create_engine(flask_app.config['SQLALCHEMY_DATABASE_URI'])
+lot_engines = {int(key[len("lot-"):]): create_engine(bind["url"])
+               for key, bind in flask_app.config['SQLALCHEMY_BINDS'].items() if key.startswith("lot-")}
+
+
+def lot_of(request):
+    return request.path_params.get("lot_id", default_lot)
+
+
+def spot_engine(lot_id):
+    return lot_engines.get(lot_id, engine)
+
+
+# The lot operations of main.py are synchronous functions of a connection;
+# they run on the sync side of an async connection with run_sync.
+async def read(lot_id, query, *args):
+    async with spot_engine(lot_id).connect() as connection:
+        return await connection.run_sync(query, lot_id, *args)
+
+
+async def write_spots(lot_id, operation, *args):
+    async with spot_engine(lot_id).connect() as connection:
+        result, events = await connection.run_sync(operation, lot_id, *args)
+        if not events:
+            await connection.rollback()
+            return result
+        version = await connection.run_sync(bump_version, lot_id)
+        await connection.run_sync(record_changes, lot_id, version, events)
+        try:
+            await connection.commit()
+        except Exception:
+            # The next transaction of the lot reuses the version, which
+            # tells the replay to drop this record.
+            if journal.enabled:
+                journal.abort(lot_id, version)
+            raise
+    spots_committed(lot_id, version, events)
+    return result
+
+
+async def is_authorized(headers):
+    if 'Authorization' not in headers:
+        return not_authorized, False
+    basic_token = headers['Authorization']
+    now = int(time.time())
+    if is_signed(bare_token(basic_token)):
+        interval = flask_app.config['TOKEN_REVOCATION_CHECK']
+        if interval is not None and revocations.due(interval, time.monotonic()):
+            async with engine.connect() as connection:
+                revocations.load(await connection.run_sync(live_revocations, now), now)
+        return check_signed_token(bare_token(basic_token), now)
+    if token_cache.get(basic_token, now) is not None:
+        return {}, True
+    async with engine.connect() as connection:
+        expires_at = (await connection.execute(
+            select(tokens.c.expires_at).where(tokens.c.access_token == token_digest(basic_token)))).scalar()
+    if expires_at is None:
+        return not_authorized, False
+    if expires_at < now:
+        return token_expired, False
+    if caches_legacy_tokens(flask_app.config):
+        token_cache.put(basic_token, expires_at, now)
+    return {}, True
+
+
+def auth(function):
+    async def decorator(request):
+        started = time.perf_counter()
+        error, ok = await is_authorized(request.headers)
+        auth_duration.observe(function.__name__, time.perf_counter() - started)
+        if not ok:
+            return JSONResponse(error)
+        return await function(request)
+    decorator.__name__ = function.__name__
+    return decorator
+
+
+class LotRouter(Router):
+    # The routes under /lots/{lot_id}; an unknown lot gets a 404 before any
+    # state is kept for it.
+    async def app(self, scope, receive, send):
+        lot_id = scope["path_params"]["lot_id"]
+        if scope["type"] == "http" and lot_id != default_lot and lot_id not in lots:
+            async with engine.connect() as connection:
+                if not await connection.run_sync(known_lot, lot_id):
+                    return await JSONResponse(unknown_lot(lot_id), status_code=404)(scope, receive, send)
+        await super().app(scope, receive, send)
+
+
+class AppContext:
+    # The lots, journal and token cache are kept on the Flask app; the lot
+    # operations of main.py find them in its context, here as in Flask.
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        with flask_app.app_context():
+            await self.application(scope, receive, send)
+
+
+class RequestMetrics:
+    # The request durations of /metrics, by endpoint like the Flask app.
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.application(scope, receive, send)
+        started = time.perf_counter()
+        try:
+            await self.application(scope, receive, send)
+        finally:
+            endpoint = getattr(scope.get("endpoint"), "__name__", "unmatched")
+            request_duration.observe(endpoint, time.perf_counter() - started)
+
+
+async def lot_state(lot_id):
+    state = lots[lot_id]
+    interval = flask_app.config['SHARED_STATE_CHECK_INTERVAL']
+    check = state.version.waiting() or interval is not None and state.version.due(interval, time.monotonic())
+    if check or not state.occupancy.loaded:
+        async with spot_engine(lot_id).connect() as connection:
+            if check and not state.version.observe(await connection.run_sync(lot_version, lot_id)):
+                state.occupancy.loaded = False
+            if not state.occupancy.loaded:
+                await connection.run_sync(load_lot, lot_id, flask_app.config['VEHICLE_INDEX'])
+    expire_holds(state)
+    return state
+
+
+def conditional(function):
+    async def decorator(request):
+        lot_id = lot_of(request)
+        state = await lot_state(lot_id)
+        version = state.version.current()
+        if version is None:
+            return await function(request)
+        etag = lot_etag(lot_id, version, state.occupancy)
+        headers = cache_headers(etag, flask_app.config['READ_CACHE_MAX_AGE'])
+        if parse_etags(request.headers.get("if-none-match")).contains(etag):
+            return Response(status_code=304, headers=headers)
+        response = await function(request)
+        if response.status_code == 200:
+            response.headers.update(headers)
+        return response
+    decorator.__name__ = function.__name__
+    return decorator
+
+
+async def get_token(request):
+    token, expires_at = new_token(request.path_params["vehicle_number"], request.path_params["vehicle_mark"])
+    return JSONResponse({"access_token": token, "expires_at": expires_at})
+
+
+@auth
+async def revoke_token(request):
+    async with engine.begin() as connection:
+        await connection.run_sync(store_revocation, request.headers['Authorization'])
+    forget_token(request.headers['Authorization'])
+    return JSONResponse(revoke_confirmation)
+
+
+@auth
+async def list_lots(request):
+    async with engine.connect() as connection:
+        return JSONResponse(await connection.run_sync(lot_list))
+
+
+async def metrics(request):
+    return Response(registry.render(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+@auth
+async def token_cache_stats(request):
+    return JSONResponse(token_cache.stats())
+
+
+@auth
+@conditional
+async def free_spots(request):
+    state = await lot_state(lot_of(request))
+    return JSONResponse({"free": state.occupancy.free_count()})
+
+
+@auth
+@conditional
+async def next_free_spot(request):
+    policy = request.query_params.get("policy", flask_app.config['ALLOCATION_POLICY'])
+    if policy not in allocation_policies:
+        return JSONResponse({message: f"Unknown allocation policy {policy}, use one of {', '.join(allocation_policies)}."})
+    state = await lot_state(lot_of(request))
+    spot_type = request.query_params.get("type")
+    if spot_type is not None and not state.occupancy.has_type(spot_type):
+        return JSONResponse({message: f"No spot in this lot has type {spot_type}."})
+    spot = state.occupancy.next_free(policy, spot_type)
+    if spot is None:
+        return JSONResponse(no_free_spots)
+    return JSONResponse({"closest spot": spot})
+
+
+@auth
+@conditional
+async def get_parking_spot(request):
+    lot_id = lot_of(request)
+    vehicle_number = request.path_params["vehicle_number"]
+    if flask_app.config['VEHICLE_INDEX']:
+        spot = (await lot_state(lot_id)).vehicles.spot_of(vehicle_number)
+    else:
+        spot = await read(lot_id, find_car, vehicle_number)
+    if spot is None:
+        return JSONResponse(no_such_car)
+    return JSONResponse({vehicle_number: spot})
+
+
+@auth
+async def levels(request):
+    return JSONResponse(await read(lot_of(request), level_counts))
+
+
+@auth
+async def occupancy_check(request):
+    lot_id = lot_of(request)
+    state = await lot_state(lot_id)
+    mismatched = state.occupancy.mismatches(await read(lot_id, lot_spot_rows))
+    return JSONResponse({"consistent": len(mismatched) == 0, "mismatched": mismatched})
+
+
+@auth
+async def occupancy_history(request):
+    error = not_whole_number(request.query_params, "from", "to", "bucket")
+    if error:
+        return JSONResponse(error)
+    start, end = report_window(request.query_params, int(time.time()), flask_app.config['REPORT_WINDOW'])
+    bucket = report_bucket(request.query_params)
+    error = too_many_buckets(start, end, bucket, flask_app.config['MAX_REPORT_BUCKETS'])
+    if error:
+        return JSONResponse(error)
+    return JSONResponse({"bucket": bucket, "buckets": await read(lot_of(request), occupancy_report, start, end, bucket)})
+
+
+@auth
+async def dwell_time(request):
+    error = not_whole_number(request.query_params, "from", "to")
+    if error:
+        return JSONResponse(error)
+    start, end = report_window(request.query_params, int(time.time()), flask_app.config['REPORT_WINDOW'])
+    return JSONResponse(await read(lot_of(request), dwell_report, start, end))
+
+
+@auth
+async def busiest_hours(request):
+    error = not_whole_number(request.query_params, "from", "to", "top")
+    if error:
+        return JSONResponse(error)
+    start, end = report_window(request.query_params, int(time.time()), flask_app.config['REPORT_WINDOW'])
+    error = too_many_buckets(start, end, hour, flask_app.config['MAX_REPORT_BUCKETS'])
+    if error:
+        return JSONResponse(error)
+    buckets = await read(lot_of(request), occupancy_report, start, end, hour)
+    return JSONResponse({"peak hours": peak_hours(buckets, int(request.query_params.get("top", 3)))})
+
+
+@auth
+async def sessions_of(request):
+    error = not_whole_number(request.query_params, "limit")
+    if error:
+        return JSONResponse(error)
+    page_size = clamp_page_size(int(request.query_params.get("limit", flask_app.config['PAGE_SIZE'])), flask_app.config)
+    return JSONResponse({"sessions": await read(lot_of(request), vehicle_sessions,
+                                                request.path_params["vehicle_number"], page_size)})
+
+
+@auth
+@conditional
+async def get_all(request):
+    error = not_whole_number(request.query_params, "after", "limit")
+    if error:
+        return JSONResponse(error)
+    lot_id = lot_of(request)
+    if request.query_params.get("format") == "ndjson":
+        async def generate():
+            async with spot_engine(lot_id).connect() as connection:
+                rows = await connection.stream(
+                    parked_cars(lot_id).execution_options(yield_per=flask_app.config['STREAM_CHUNK_SIZE']))
+                async for spot, number in rows:
+                    yield parked_car_line(spot, number, JSONResponse.dumps)
+        return StreamingResponse(generate(), media_type="application/x-ndjson")
+    if request.query_params.get("format") == "columnar":
+        return JSONResponse(await read(lot_id, parked_cars_columns))
+    if "after" in request.query_params or "limit" in request.query_params:
+        page_size = clamp_page_size(int(request.query_params.get("limit", flask_app.config['PAGE_SIZE'])),
+                                    flask_app.config)
+        return JSONResponse(await read(lot_id, parked_cars_page, int(request.query_params.get("after", 0)), page_size))
+    return JSONResponse(await read(lot_id, all_parked_cars))
+
+
+@auth
+async def parking(request):
+    body = await request.json()
+    try:
+        return JSONResponse(await write_spots(lot_of(request), park_car, request.path_params["spot_number"],
+                                              body["vehicle_number"], body["vehicle_mark"]))
+    except IntegrityError:
+        return JSONResponse(already_parked(body["vehicle_number"]))
+
+
+@auth
+async def leave(request):
+    return JSONResponse(await write_spots(lot_of(request), leave_spot, request.path_params["spot_number"]))
+
+
+@auth
+async def reserve(request):
+    body = await request.json()
+    error = not_whole_number(body, "ttl")
+    if error:
+        return JSONResponse(error)
+    ttl = int(body.get("ttl", flask_app.config['RESERVATION_TTL']))
+    if not 0 < ttl <= flask_app.config['MAX_RESERVATION_TTL']:
+        return JSONResponse({message: f"A reservation lasts 1 to {flask_app.config['MAX_RESERVATION_TTL']} seconds."})
+    now = int(time.time())
+    return JSONResponse(await write_spots(lot_of(request), hold_spot, request.path_params["spot_number"],
+                                          body["vehicle_number"], now + ttl, now))
+
+
+@auth
+async def cancel_reservation(request):
+    return JSONResponse(await write_spots(lot_of(request), release_hold, request.path_params["spot_number"],
+                                          int(time.time())))
+
+
+@auth
+async def parking_batch(request):
+    body = await request.json()
+    error = batch_too_large(body, flask_app.config)
+    if error:
+        return JSONResponse(error)
+    try:
+        return JSONResponse(await write_spots(lot_of(request), park_cars, body))
+    except IntegrityError:
+        return JSONResponse(batch_conflict)
+
+
+@auth
+async def leave_batch(request):
+    body = await request.json()
+    error = batch_too_large(body, flask_app.config)
+    if error:
+        return JSONResponse(error)
+    return JSONResponse(await write_spots(lot_of(request), leave_spots, body))
+
+
+@auth
+async def change_spot(request):
+    body = await request.json()
+    return JSONResponse(await write_spots(lot_of(request), move_car, body['vehicle_number'], body['vehicle_mark'],
+                                          request.path_params["new_spot"]))
+
+
+class FeedWaker:
+    # Wakes every subscriber of a lot on this event loop with one callback per
+    # sealed batch, instead of one per subscriber.
+    def __init__(self, loop):
+        self.loop = loop
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        self.loop.call_soon_threadsafe(self.wake)
+
+    def wake(self):
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+
+@auth
+async def occupancy_feed(request):
+    lot_id = lot_of(request)
+    feed = (await lot_state(lot_id)).feed
+    # The wakers belong to the event loop of this lifespan, a later lifespan
+    # (another loop) starts with none.
+    feed_wakers = request.app.state.feed_wakers
+    waker = feed_wakers.get(lot_id)
+    if waker is None:
+        waker = feed_wakers[lot_id] = FeedWaker(asyncio.get_running_loop())
+        feed.add_listener(waker.notify)
+    interval = flask_app.config['SHARED_STATE_CHECK_INTERVAL']
+    if interval is None:
+        feed.start(flask_app.config['FEED_COALESCE'])
+    else:
+        feed.start(flask_app.config['FEED_COALESCE'], max(interval, flask_app.config['FEED_COALESCE']),
+                   shared_state_poller(flask_app, lot_id))
+    last_event_id = request.headers.get("last-event-id", "")
+    last_seq = int(last_event_id) if last_event_id.isdigit() else None
+
+    async def generate(last_seq):
+        feed.attach()
+        try:
+            chunks, last_seq = feed.since(last_seq)
+            yield "".join(chunks) or ": connected\n\n"
+            while True:
+                changed = waker.changed
+                chunks, last_seq = feed.since(last_seq)
+                if chunks:
+                    yield "".join(chunks)
+                    continue
+                try:
+                    await asyncio.wait_for(changed.wait(), flask_app.config['FEED_HEARTBEAT'])
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+        finally:
+            feed.detach()
+    return StreamingResponse(generate(last_seq), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+class JSONResponse(StarletteJSONResponse):
+    # The same bodies as the Flask app, from the same JSON backend.
+    dumps = staticmethod(backend(flask_app.config['JSON_BACKEND'])[0])
+
+    def render(self, content):
+        return encode(content, self.dumps)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(application):
+    await lot_state(default_lot)
+    start_token_reaper(flask_app)
+    application.state.feed_wakers = {}
+    yield
+    for lot_id, waker in application.state.feed_wakers.items():
+        lots[lot_id].feed.remove_listener(waker.notify)
+    application.state.feed_wakers = {}
+    await engine.dispose()
+    for lot_engine in lot_engines.values():
+        await lot_engine.dispose()
+
+
+lot_routes = [
+    Route("/free_spots", free_spots),
+    Route("/next_free_spot", next_free_spot),
+    Route("/get_parking_spot/{vehicle_number}", get_parking_spot),
+    Route("/get_all", get_all),
+    Route("/levels", levels),
+    Route("/occupancy_history", occupancy_history),
+    Route("/dwell_time", dwell_time),
+    Route("/peak_hours", busiest_hours),
+    Route("/sessions/{vehicle_number}", sessions_of),
+    Route("/occupancy_feed", occupancy_feed),
+    Route("/occupancy_check", occupancy_check),
+    Route("/parking/{spot_number:int}", parking, methods=["PUT"]),
+    Route("/leave/{spot_number:int}", leave, methods=["PATCH"]),
+    Route("/reserve/{spot_number:int}", reserve, methods=["PUT"]),
+    Route("/cancel_reservation/{spot_number:int}", cancel_reservation, methods=["PATCH"]),
+    Route("/parking_batch", parking_batch, methods=["PUT"]),
+    Route("/leave_batch", leave_batch, methods=["PATCH"]),
+    Route("/change_to/{new_spot:int}", change_spot, methods=["PUT"]),
+]
+
+app = Starlette(lifespan=lifespan, middleware=[Middleware(AppContext), Middleware(RequestMetrics)], routes=[
+    Route("/get_token/{vehicle_number}/{vehicle_mark}", get_token),
+    Route("/revoke_token", revoke_token, methods=["POST"]),
+    Route("/lots", list_lots),
+    Route("/metrics", metrics),
+    Route("/token_cache_stats", token_cache_stats),
+    Mount("/lots/{lot_id:int}", app=LotRouter(lot_routes)),
+    *lot_routes,
+])
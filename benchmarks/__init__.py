@@ -0,0 +1,14 @@
+import os
+import tempfile
+
+
+def scratch_environment(environment=None):
+    # Points the app at a scratch database and journal unless
+    # PARKING_DATABASE_URI and PARKING_JOURNAL are set, so a benchmark that
+    # drops its tables never runs on instance/database.db. Call it before
+    # importing main, which reads them when it builds the app.
+    environment = os.environ if environment is None else environment
+    scratch = tempfile.mkdtemp()
+    environment.setdefault("PARKING_DATABASE_URI", "sqlite:///" + os.path.join(scratch, "bench.db"))
+    environment.setdefault("PARKING_JOURNAL", os.path.join(scratch, "journal.ndjson"))
+    return environment
@@ -0,0 +1,66 @@
+# Cost of picking a spot with each allocation policy on a large lot, against
+# a scan over all spots that gives the same answer. Every round takes the
+# suggested spot and releases a random taken one, so the indexes see the same
+# churn as a busy lot.
+# Run from the project directory: python -m benchmarks.allocation [spots] [rounds]
+import random
+import statistics
+import sys
+import time
+
+from occupancy import Occupancy
+
+
+def scan(engine, policy, spot_type):
+    free = [spot for spot in range(1, len(engine.slots)) if engine.is_free(spot)
+            and (spot_type is None or engine.types.get(spot, "standard") == spot_type)]
+    if not free:
+        return None
+    if policy == "nearest":
+        return min(free, key=lambda spot: (engine.distances[spot], spot))
+    if policy == "balanced":
+        levels = {}
+        for spot in free:
+            levels[engine.levels[spot]] = levels.get(engine.levels[spot], 0) + 1
+        level = max(levels, key=lambda level: (levels[level], -level))
+        return min(spot for spot in free if engine.levels[spot] == level)
+    return free[0]
+
+
+def run(engine, pick, rounds, generator):
+    timings = []
+    taken = []
+    for i in range(rounds):
+        started = time.perf_counter()
+        spot = pick()
+        timings.append(time.perf_counter() - started)
+        if spot is not None:
+            engine.take(spot)
+            taken.append(spot)
+        if taken and generator.random() < 0.5:
+            engine.release(taken.pop(generator.randrange(len(taken))))
+    return timings
+
+
+def report(name, timings):
+    print(f"  {name:26} mean {statistics.mean(timings) * 1e6:10.1f} us   p50 {statistics.median(timings) * 1e6:10.1f} us")
+
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    generator = random.Random(1)
+    rows = [(spot, generator.random() < 0.3, (spot - 1) // 5000 + 1,
+             "ev" if spot % 20 == 0 else "standard", generator.randrange(1000)) for spot in range(1, size + 1)]
+    print(f"{size} spots, {rounds} rounds")
+    for policy, spot_type in [("lowest", None), ("nearest", None), ("balanced", None), ("lowest", "ev"), ("nearest", "ev")]:
+        name = policy + (f", {spot_type}" if spot_type else "")
+        engine = Occupancy()
+        engine.load(rows)
+        started = time.perf_counter()
+        engine.next_free(policy, spot_type)
+        build = time.perf_counter() - started
+        report(f"{name} index", run(engine, lambda: engine.next_free(policy, spot_type), rounds, random.Random(2)))
+        print(f"  {'':26} first call (builds the index) {build * 1000:.1f} ms")
+        engine.load(rows)
+        report(f"{name} scan", run(engine, lambda: scan(engine, policy, spot_type), min(rounds, 50), random.Random(2)))
@@ -0,0 +1,90 @@
+# A month-long occupancy report from the hourly rollups against the same
+# report computed from the raw session rows, on a lot with millions of
+# sessions. The rollups are filled the way record_sessions fills them.
+# Run from the project directory: python -m benchmarks.analytics [sessions] [days]
+# Unless PARKING_DATABASE_URI is set a scratch database is used.
+import random
+import statistics
+import sys
+import time
+
+from benchmarks import scratch_environment
+
+scratch_environment()
+
+from sqlalchemy import func, insert, select
+
+from analytics import hour, hour_of, occupancy_buckets
+from main import app, db, default_lot, occupancy_report, ParkingSessionModel, OccupancyRollupModel
+
+
+def fill(sessions, days, generator):
+    start = hour_of(int(time.time())) - days * 24 * hour
+    rollups = {}
+    rows = []
+    for session_id in range(sessions):
+        entered_at = start + generator.randrange(days * 24 * hour)
+        left_at = entered_at + int(generator.expovariate(1 / 7200))
+        rows.append({"lot_id": 1, "parking_spot": session_id % 5000 + 1, "vehicle_number": f"{session_id:06d}"[-6:],
+                     "entered_at": entered_at, "left_at": left_at})
+        rollups.setdefault(hour_of(entered_at), [0, 0, 0])[0] += 1
+        departure = rollups.setdefault(hour_of(left_at), [0, 0, 0])
+        departure[1] += 1
+        departure[2] += left_at - entered_at
+        if len(rows) == 100000:
+            db.session.execute(insert(ParkingSessionModel), rows)
+            rows = []
+    if rows:
+        db.session.execute(insert(ParkingSessionModel), rows)
+    db.session.execute(insert(OccupancyRollupModel), [
+        {"lot_id": 1, "hour": hour_start, "arrivals": arrivals, "departures": departures, "dwell_seconds": dwell}
+        for hour_start, (arrivals, departures, dwell) in rollups.items()])
+    db.session.commit()
+    return start
+
+
+def from_sessions(start, end, bucket):
+    # The same report straight from the sessions: arrivals and departures
+    # grouped by hour, plus the cars parked before the window.
+    session = ParkingSessionModel
+    occupied = db.session.execute(select(func.count()).where(
+        session.lot_id == 1, session.entered_at < start,
+        (session.left_at.is_(None)) | (session.left_at >= start))).scalar()
+    arrivals = dict(db.session.execute(
+        select(session.entered_at - session.entered_at % hour, func.count())
+        .where(session.lot_id == 1, session.entered_at >= start, session.entered_at < end)
+        .group_by(session.entered_at - session.entered_at % hour)).all())
+    departures = dict(db.session.execute(
+        select(session.left_at - session.left_at % hour, func.count())
+        .where(session.lot_id == 1, session.left_at >= start, session.left_at < end)
+        .group_by(session.left_at - session.left_at % hour)).all())
+    rows = [(hour_start, arrivals.get(hour_start, 0), departures.get(hour_start, 0))
+            for hour_start in sorted(set(arrivals) | set(departures))]
+    return occupancy_buckets(occupied, rows, start, end, bucket)
+
+
+def measure(report, rounds):
+    timings = []
+    for i in range(rounds):
+        started = time.perf_counter()
+        result = report()
+        timings.append(time.perf_counter() - started)
+    return timings, result
+
+
+if __name__ == "__main__":
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 90
+    with app.app_context():
+        db.create_all()
+        started = time.perf_counter()
+        first = fill(sessions, days, random.Random(1))
+        print(f"{sessions} sessions over {days} days, loaded in {time.perf_counter() - started:.1f} s")
+        end = first + days * 24 * hour
+        start = end - 30 * 24 * hour
+        rollup_timings, expected = measure(lambda: occupancy_report(db.session, default_lot, start, end, hour), 20)
+        scan_timings, result = measure(lambda: from_sessions(start, end, hour), 3)
+        assert result == expected
+        print(f"30-day hourly occupancy report ({len(expected)} buckets):")
+        print(f"  rollups   mean {statistics.mean(rollup_timings) * 1000:9.2f} ms")
+        print(f"  sessions  mean {statistics.mean(scan_timings) * 1000:9.2f} ms")
@@ -0,0 +1,75 @@
+# Per-request cost of checking the Authorization header: tokens stored in the
+# token table (looked up in the database, or found in the token cache) against
+# signed tokens, which are checked with an HMAC and no I/O.
+# Run from the project directory: python -m benchmarks.auth [iterations]
+# Unless PARKING_DATABASE_URI is set a scratch database is used.
+import base64
+import statistics
+import sys
+import time
+
+from benchmarks import scratch_environment
+
+scratch_environment()
+
+from main import app, db, is_authorized, new_token, token_cache, token_digest, provision_lot, AuthorizationModel
+
+
+def table_token(vehicle_number, vehicle_mark):
+    # The format get_token issued before tokens were signed.
+    token = base64.encodebytes(f"{vehicle_number}:{vehicle_mark}".encode("utf8")).decode("utf8").replace("\n", "")
+    expires_at = int(time.time()) + 900
+    db.session.merge(AuthorizationModel(access_token=token_digest("Basic " + token), expires_at=expires_at))
+    db.session.commit()
+    return "Basic " + token
+
+
+def measure(headers, iterations, cached=True):
+    timings = []
+    for i in range(iterations):
+        if not cached:
+            token_cache.clear()
+        started = time.perf_counter()
+        error, ok = is_authorized(headers)
+        timings.append(time.perf_counter() - started)
+        assert ok, error
+    return timings
+
+
+def measure_requests(client, headers, iterations):
+    timings = []
+    for i in range(iterations):
+        started = time.perf_counter()
+        response = client.get("/free_spots", headers=headers)
+        timings.append(time.perf_counter() - started)
+        assert "free" in response.json, response.json
+    return timings
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    p99 = timings[int(len(timings) * 0.99) - 1]
+    print(f"  {name:22} mean {statistics.mean(timings) * 1e6:9.1f} us   "
+          f"p50 {statistics.median(timings) * 1e6:9.1f} us   p99 {p99 * 1e6:9.1f} us")
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    with app.app_context():
+        db.create_all()
+        provision_lot(100)
+        table = {"Authorization": table_token("BEN001", "bench")}
+        signed = {"Authorization": "Basic " + new_token("BEN001", "bench")[0]}
+        print(f"is_authorized, {iterations} calls:")
+        report("table, uncached", measure(table, iterations, cached=False))
+        report("table, cached", measure(table, iterations))
+        report("signed", measure(signed, iterations))
+    client = app.test_client()
+    measure_requests(client, signed, iterations // 10)
+    print(f"GET /free_spots, {iterations} requests:")
+    app_cache = app.extensions["parking"].token_cache
+    app_cache.maxsize = 0
+    report("table, uncached", measure_requests(client, table, iterations))
+    app_cache.maxsize = app.config['TOKEN_CACHE_SIZE']
+    report("table, cached", measure_requests(client, table, iterations))
+    report("signed", measure_requests(client, signed, iterations))
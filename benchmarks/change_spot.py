@@ -0,0 +1,76 @@
+# Compares the single-transaction change_spot with the previous implementation,
+# which re-entered parking() and leave() through nested request contexts.
+# Run from the project directory: python -m benchmarks.change_spot [iterations]
+# Unless PARKING_DATABASE_URI and PARKING_JOURNAL are set, scratch files are used;
+# the tables of the database it runs on are dropped and recreated.
+import statistics
+import sys
+import time
+
+from benchmarks import scratch_environment
+
+scratch_environment()
+
+from flask import request
+
+from main import app, db, auth, get_token, get_parking_spot, parking, leave, change_spot, \
+    message, CarParkingModel, default_lot, load_lot, ensure_lot
+
+
+# The unique index on vehicle_number means the old order (park, then leave) now
+# fails, so leave runs first. The cost is the same: two nested contexts, two
+# auth checks and two commits.
+@auth
+def legacy_change_spot(new_spot):
+    body = request.get_json()
+    vehicle_number = body['vehicle_number']
+    spot = get_parking_spot(vehicle_number)
+    if vehicle_number not in spot:
+        return {message: f"Car {vehicle_number} not parked."}
+    spot_nr = spot[vehicle_number]
+    with app.test_request_context(headers={"Authorization": request.headers["Authorization"]}):
+        leave(spot_nr)
+    with app.test_request_context(
+        headers={"Authorization": request.headers["Authorization"]},
+        json=body
+    ):
+        reparking = parking(new_spot)
+    if "parking spot" not in reparking:
+        return reparking
+    return {"message": f"{vehicle_number} parked to {new_spot}"}
+
+
+def measure(function, iterations, headers, body):
+    timings = []
+    for i in range(iterations):
+        new_spot = 2 if i % 2 == 0 else 1
+        with app.test_request_context(headers=headers, json=body):
+            started = time.perf_counter()
+            result = function(new_spot)
+            timings.append(time.perf_counter() - started)
+        assert result == {"message": f"{body['vehicle_number']} parked to {new_spot}"}, result
+    return timings
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f"{name:8} mean {statistics.mean(timings) * 1000:7.3f} ms   "
+          f"p50 {statistics.median(timings) * 1000:7.3f} ms   p95 {p95 * 1000:7.3f} ms")
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        ensure_lot()
+        db.session.add(CarParkingModel(parking_spot=1, parking_available=False, vehicle_number="BEN001", vehicle_mark="bench"))
+        db.session.add(CarParkingModel(parking_spot=2, parking_available=True))
+        db.session.commit()
+        load_lot(db.session, default_lot)
+        token = get_token("BEN001", "bench")["access_token"]
+        headers = {"Authorization": "Basic " + token}
+        body = {"vehicle_number": "BEN001", "vehicle_mark": "bench"}
+        report("legacy", measure(legacy_change_spot, iterations, headers, body))
+        report("native", measure(change_spot, iterations, headers, body))
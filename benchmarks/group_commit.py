@@ -0,0 +1,81 @@
+# Park/leave throughput with one commit per request against group commit, at
+# 8, 32 and 128 concurrent clients. Every client parks a car on its own spot
+# and takes it away again, so requests never conflict and the difference is
+# the number of commits (and fsyncs) they need.
+#
+# Run from the project directory:
+#   python -m benchmarks.group_commit --clients 8 32 128 --seconds 3 --window 0.002
+# Unless PARKING_DATABASE_URI is set a scratch database is used, with the
+# durable storage profile (synchronous=FULL) unless PARKING_STORAGE_PROFILE is set.
+import argparse
+import os
+import statistics
+import threading
+import time
+
+from benchmarks import scratch_environment
+
+scratch_environment()
+os.environ.setdefault("PARKING_STORAGE_PROFILE", "durable")
+
+from main import app, db, new_token, provision_lot
+
+
+def client_loop(spot, headers, stop, latencies, errors):
+    client = app.test_client()
+    car = {"vehicle_number": f"G{spot:05d}", "vehicle_mark": "bench"}
+    while not stop.is_set():
+        started = time.perf_counter()
+        parked = client.put(f"/parking/{spot}", json=car, headers=headers).json
+        left = client.patch(f"/leave/{spot}", headers=headers).json
+        latencies.append((time.perf_counter() - started) / 2)
+        if parked != {"parking spot": spot} or "available" not in left.get("message", ""):
+            errors.append((parked, left))
+
+
+def run(clients, seconds, headers):
+    stop = threading.Event()
+    latencies = []
+    errors = []
+    threads = [threading.Thread(target=client_loop, args=(spot, headers, stop, latencies, errors))
+               for spot in range(1, clients + 1)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    assert not errors, errors[:3]
+    latencies.sort()
+    return {"ops": 2 * len(latencies) / elapsed, "p50": statistics.median(latencies),
+            "p99": latencies[int(len(latencies) * 0.99) - 1]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-request commits with group commit.")
+    parser.add_argument("--clients", type=int, nargs="+", default=[8, 32, 128])
+    parser.add_argument("--seconds", type=float, default=3.0)
+    parser.add_argument("--window", type=float, default=0.002, help="seconds the writer waits for more writes")
+    parser.add_argument("--size", type=int, default=64, help="most writes in one commit")
+    args = parser.parse_args()
+    with app.app_context():
+        db.create_all()
+        provision_lot(max(args.clients))
+        headers = {"Authorization": "Basic " + new_token("BEN001", "bench")[0]}
+    print(f"{app.config['STORAGE_PROFILE']} storage, {args.seconds} s per run")
+    for clients in args.clients:
+        results = {}
+        for mode, window in (("per request", None), ("group commit", args.window)):
+            app.config['GROUP_COMMIT_WINDOW'] = window
+            app.config['GROUP_COMMIT_SIZE'] = args.size
+            results[mode] = run(clients, args.seconds, headers)
+        for mode, result in results.items():
+            print(f"  {clients:4} clients  {mode:13} {result['ops']:9.1f} ops/s   "
+                  f"p50 {result['p50'] * 1000:7.2f} ms   p99 {result['p99'] * 1000:7.2f} ms")
+        print(f"  {'':4}          speedup       {results['group commit']['ops'] / results['per request']['ops']:9.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# Replay speed of the parking journal. Writes a synthetic journal of park,
+# leave and move events through journal.Journal (batched fsync), then times a
+# full replay, a replay on top of a checkpoint taken at 90% of the events, and
+# optionally rebuilding the spot table from the result.
+#
+# Run from the project directory:
+#   python -m benchmarks.journal_replay --events 1000000 --lot-size 10000 --rebuild
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from benchmarks import scratch_environment
+
+scratch_environment()
+
+from journal import Journal, leave_event, move_event, park_event, replay, size_event, write_checkpoint
+
+
+def generate(journal, events, lot_size, seed):
+    rng = random.Random(seed)
+    free = list(range(1, lot_size + 1))
+    parked = []
+    journal.append(1, 1, [size_event(lot_size, None)])
+    for version in range(2, events + 2):
+        if parked and (not free or rng.random() < 0.45):
+            index = rng.randrange(len(parked))
+            spot, number = parked[index]
+            if free and rng.random() < 0.2:
+                target = rng.randrange(len(free))
+                parked[index], free[target] = (free[target], number), spot
+                journal.append(1, version, [move_event(spot, parked[index][0], number, "bench")])
+                continue
+            parked[index] = parked[-1]
+            parked.pop()
+            free.append(spot)
+            journal.append(1, version, [leave_event(spot)])
+        else:
+            index = rng.randrange(len(free))
+            spot = free[index]
+            free[index] = free[-1]
+            free.pop()
+            number = f"B{version:05d}"[-6:]
+            parked.append((spot, number))
+            journal.append(1, version, [park_event(spot, number, "bench")])
+    return {spot: number for spot, number in parked}
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark journal append and replay.")
+    parser.add_argument("--events", type=int, default=1000000)
+    parser.add_argument("--lot-size", type=int, default=10000)
+    parser.add_argument("--sync-interval", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--rebuild", action="store_true", help="also rebuild the spot table of a scratch database")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "journal.ndjson")
+    journal = Journal()
+    journal.configure(path, args.sync_interval)
+    expected, seconds = timed(generate, journal, args.events, args.lot_size, args.seed)
+    journal.close()
+    print(f"append     {args.events / seconds:12.0f} events/s   {seconds:7.2f} s   "
+          f"{os.path.getsize(path) / args.events:5.1f} bytes/event   {journal.syncs} fsyncs")
+
+    (snapshots, applied, offset, torn), seconds = timed(replay, path)
+    cars = {spot: number for spot, (number, mark) in snapshots[1].cars.items()}
+    assert cars == expected, "replay does not match the generated state"
+    print(f"replay     {applied / seconds:12.0f} events/s   {seconds:7.2f} s")
+
+    # A checkpoint of the first 90% of the journal, as `flask checkpoint` takes it.
+    checkpoint = os.path.join(directory, "journal.ndjson.checkpoint")
+    partial = os.path.join(directory, "partial.ndjson")
+    with open(path, "rb") as source, open(partial, "wb") as target:
+        for number, line in enumerate(source):
+            if number > args.events * 0.9:
+                break
+            target.write(line)
+    snapshots, applied, offset, torn = replay(partial, settle=False)
+    write_checkpoint(checkpoint, snapshots, offset)
+    (snapshots, applied, offset, torn), seconds = timed(replay, path, checkpoint)
+    assert {spot: number for spot, (number, mark) in snapshots[1].cars.items()} == expected
+    print(f"checkpoint {applied:12d} events    {seconds:7.2f} s")
+
+    if args.rebuild:
+        from main import app, db, rebuild_from_snapshot, upgrade_schema
+        with app.app_context():
+            db.drop_all()
+            upgrade_schema()
+            _, seconds = timed(rebuild_from_snapshot, snapshots)
+        print(f"rebuild    {args.lot_size:12d} spots     {seconds:7.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+# Load test for every endpoint, through the Flask test client ("client") and
+# through a locally started server ("server"). Each phase sends its requests
+# from a pool of concurrent workers and reports requests per second and
+# p50/p95/p99 latency. Results are written as JSON so runs can be compared.
+#
+# Run from the project directory:
+#   python -m benchmarks.load --mode both --workers 16 --lot-size 2000 --output run.json
+#   python -m benchmarks.load --baseline run.json
+#
+# Unless PARKING_DATABASE_URI and PARKING_JOURNAL are set, scratch files are used.
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import scratch_environment
+
+scratch_environment()
+
+import requests
+
+from main import app, db, provision_lot
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class ClientTransport:
+    def __init__(self):
+        self.local = threading.local()
+
+    def send(self, method, path, headers=None, body=None):
+        if not hasattr(self.local, "client"):
+            self.local.client = app.test_client()
+        response = self.local.client.open(path, method=method, headers=headers, json=body)
+        return response.status_code, response.get_json(silent=True)
+
+    def close(self):
+        pass
+
+
+def flask_command(port):
+    return [sys.executable, "-m", "flask", "--app", "main", "run", "--port", str(port),
+            "--with-threads", "--no-reload", "--no-debugger"]
+
+
+class ServerTransport:
+    def __init__(self, port, command=None, env=None):
+        self.base = f"http://127.0.0.1:{port}"
+        self.local = threading.local()
+        self.server = subprocess.Popen(
+            command or flask_command(port),
+            cwd=PROJECT_DIR, env=dict(os.environ, **(env or {})), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for attempt in range(100):
+            try:
+                requests.get(self.base + "/free_spots", timeout=1)
+                return
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        self.close()
+        raise RuntimeError("Server did not start")
+
+    def send(self, method, path, headers=None, body=None):
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        response = self.local.session.request(method, self.base + path, headers=headers, json=body)
+        try:
+            return response.status_code, response.json()
+        except ValueError:
+            return response.status_code, None
+
+    def close(self):
+        self.server.terminate()
+        self.server.wait()
+
+
+def phases(count):
+    # (name, request, check) per phase: request builds the method, path and body of
+    # request i, check tells whether its answer is the success one and not an error
+    # message. parking/change_spot/leave move cars 1..count to count+1..2*count and
+    # back out, so the lot ends up empty again.
+    return [
+        ("get_token", lambda i: ("GET", f"/get_token/V{i}/bench", None),
+         lambda i, payload: "access_token" in payload),
+        ("parking", lambda i: ("PUT", f"/parking/{i + 1}", {"vehicle_number": f"V{i}", "vehicle_mark": "bench"}),
+         lambda i, payload: payload.get("parking spot") == i + 1),
+        ("free_spots", lambda i: ("GET", "/free_spots", None),
+         lambda i, payload: "free" in payload),
+        ("next_free_spot", lambda i: ("GET", "/next_free_spot", None),
+         lambda i, payload: "closest spot" in payload),
+        ("get_parking_spot", lambda i: ("GET", f"/get_parking_spot/V{i}", None),
+         lambda i, payload: payload.get(f"V{i}") == i + 1),
+        ("get_all", lambda i: ("GET", "/get_all", None),
+         lambda i, payload: payload.get(str(i + 1)) == f"V{i}"),
+        ("change_spot", lambda i: ("PUT", f"/change_to/{count + i + 1}", {"vehicle_number": f"V{i}", "vehicle_mark": "bench"}),
+         lambda i, payload: payload.get("message") == f"V{i} parked to {count + i + 1}"),
+        ("leave", lambda i: ("PATCH", f"/leave/{count + i + 1}", None),
+         lambda i, payload: payload.get("message") == f"spot {count + i + 1} is available"),
+    ]
+
+
+def percentile(timings, fraction):
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+
+def run_phase(transport, build, check, count, workers, headers):
+    def one(i):
+        method, path, body = build(i)
+        started = time.perf_counter()
+        status, payload = transport.send(method, path, headers=headers, body=body)
+        return time.perf_counter() - started, status == 200 and isinstance(payload, dict) and check(i, payload)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        outcomes = list(pool.map(one, range(count)))
+    elapsed = time.perf_counter() - started
+    timings = sorted(timing for timing, ok in outcomes)
+    return {
+        "count": count,
+        "errors": sum(1 for timing, ok in outcomes if not ok),
+        "rps": round(count / elapsed, 1),
+        "p50_ms": round(percentile(timings, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(timings, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(timings, 0.99) * 1000, 3),
+        "mean_ms": round(statistics.mean(timings) * 1000, 3),
+    }
+
+
+def run_mode(transport, count, workers):
+    status, token = transport.send("GET", "/get_token/BENCH/bench")
+    headers = {"Authorization": "Basic " + token["access_token"]}
+    results = {}
+    for name, build, check in phases(count):
+        results[name] = run_phase(transport, build, check, count, workers, headers)
+        row = results[name]
+        print(f"  {name:17} {row['rps']:9.1f} req/s   p50 {row['p50_ms']:8.3f} ms   "
+              f"p95 {row['p95_ms']:8.3f} ms   p99 {row['p99_ms']:8.3f} ms   errors {row['errors']}")
+    return results
+
+
+def compare(baseline_path, current):
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    print(f"Compared with {baseline_path} (rps ratio, p99 ratio):")
+    for mode, results in current["modes"].items():
+        for name, row in results.items():
+            before = baseline.get("modes", {}).get(mode, {}).get(name)
+            if before:
+                print(f"  {mode:6} {name:17} rps x{row['rps'] / before['rps']:.2f}   p99 x{row['p99_ms'] / before['p99_ms']:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the parking API.")
+    parser.add_argument("--mode", choices=["client", "server", "both"], default="client")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--lot-size", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=500, help="requests per endpoint, at most lot-size / 2")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    count = min(args.requests, args.lot_size // 2)
+    with app.app_context():
+        db.create_all()
+        provision_lot(args.lot_size)
+    report = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "database": os.environ["PARKING_DATABASE_URI"],
+        "storage_profile": app.config["STORAGE_PROFILE"],
+        "workers": args.workers,
+        "lot_size": args.lot_size,
+        "requests": count,
+        "modes": {},
+    }
+    for mode in (["client", "server"] if args.mode == "both" else [args.mode]):
+        print(f"{mode}: {args.workers} workers, {count} requests per endpoint, {args.lot_size} spots")
+        transport = ClientTransport() if mode == "client" else ServerTransport(args.port)
+        try:
+            report["modes"][mode] = run_mode(transport, count, args.workers)
+        finally:
+            transport.close()
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    if args.baseline:
+        compare(args.baseline, report)
+
+
+if __name__ == "__main__":
+    main()
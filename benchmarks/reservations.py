@@ -0,0 +1,74 @@
+# Expiring tens of thousands of reservation holds: the occupancy map's expiry
+# heap, checked once a second, against a sweep that scans every hold (or polls
+# the spots table) on each tick. Holds run out evenly over the simulated span,
+# so each tick frees a few of them.
+# Run from the project directory: python -m benchmarks.reservations [holds] [seconds]
+import random
+import sqlite3
+import statistics
+import sys
+import time
+
+from occupancy import Occupancy
+
+
+def held_lot(holds, start, span, generator):
+    engine = Occupancy()
+    engine.load([(spot, True) for spot in range(1, holds + 1)])
+    expiries = {spot: start + generator.randrange(1, span) for spot in range(1, holds + 1)}
+    for spot, until in expiries.items():
+        engine.hold(spot, until)
+    return engine, expiries
+
+
+def heap_ticks(engine, start, span):
+    timings = []
+    freed = 0
+    for now in range(start + 1, start + span + 1):
+        started = time.perf_counter()
+        freed += len(engine.expire(now))
+        timings.append(time.perf_counter() - started)
+    return timings, freed
+
+
+def sweep_ticks(expiries, start, span):
+    timings = []
+    freed = 0
+    for now in range(start + 1, start + span + 1):
+        started = time.perf_counter()
+        due = [spot for spot, until in expiries.items() if until <= now]
+        for spot in due:
+            del expiries[spot]
+        freed += len(due)
+        timings.append(time.perf_counter() - started)
+    return timings, freed
+
+
+def poll_ticks(expiries, start, span, ticks):
+    # What a database sweep does on every tick: find and clear the due holds.
+    connection = sqlite3.connect(":memory:")
+    connection.execute("CREATE TABLE spots (spot INTEGER PRIMARY KEY, reserved_until INTEGER)")
+    connection.executemany("INSERT INTO spots VALUES (?, ?)", expiries.items())
+    timings = []
+    for now in range(start + 1, start + ticks + 1):
+        started = time.perf_counter()
+        connection.execute("UPDATE spots SET reserved_until = NULL WHERE reserved_until <= ?", (now,))
+        connection.commit()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+if __name__ == "__main__":
+    holds = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    span = int(sys.argv[2]) if len(sys.argv) > 2 else 900
+    start = int(time.time())
+    started = time.perf_counter()
+    engine, expiries = held_lot(holds, start, span, random.Random(1))
+    print(f"{holds} holds over {span} s, placed in {(time.perf_counter() - started) * 1000:.1f} ms")
+    heap_timings, heap_freed = heap_ticks(engine, start, span)
+    poll_timings = poll_ticks(dict(expiries), start, span, 50)
+    sweep_timings, sweep_freed = sweep_ticks(expiries, start, span)
+    assert heap_freed == sweep_freed == holds and engine.free_count() == holds
+    print("cost of one expiry tick:")
+    for name, timings in (("heap", heap_timings), ("sweep", sweep_timings), ("table poll", poll_timings)):
+        print(f"  {name:10}  mean {statistics.mean(timings) * 1000:9.3f} ms   max {max(timings) * 1000:9.3f} ms")
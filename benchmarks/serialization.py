@@ -0,0 +1,102 @@
+# Bytes on the wire and CPU time per response of get_all on a full lot, for
+# every body format and JSON backend, against Flask's default provider that
+# served them before (sorted keys, ASCII escapes, the stdlib encoder). Also
+# the cost of a fixed error message, encoded per response or sent pre-encoded.
+# Finally whole get_all requests against a scratch database, in both formats.
+#
+# Run from the project directory: python -m benchmarks.serialization [spots ...]
+# Unless PARKING_DATABASE_URI is set a scratch database is used.
+import gzip
+import statistics
+import sys
+import time
+
+from benchmarks import scratch_environment
+
+scratch_environment()
+
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import update
+
+from main import app, db, new_token, provision_lot, spot_not_available, CarParkingModel
+from serialization import CompactJSONProvider, backends, encode
+
+
+def bodies(size):
+    rows = [(spot, f"{spot:06d}") for spot in range(1, size + 1)]
+    return {
+        "object": lambda: {spot: number for spot, number in rows},
+        "columnar": lambda: {"spots": [spot for spot, number in rows],
+                             "vehicle_numbers": [number for spot, number in rows]},
+        "ndjson": lambda: rows,
+    }
+
+
+def respond(provider, format, build):
+    if format == "ndjson":
+        return b"".join(encode({"spot": spot, "vehicle_number": number}, provider.encoder) for spot, number in build())
+    return provider.response(build()).get_data()
+
+
+def cpu_time(function, rounds):
+    timings = []
+    for i in range(rounds):
+        started = time.process_time()
+        function()
+        timings.append(time.process_time() - started)
+    return statistics.median(timings)
+
+
+def formats_and_backends(size, rounds):
+    providers = {name: CompactJSONProvider(app, name) for name in backends()}
+    print(f"get_all on a full lot of {size} spots, per response:")
+    cases = [("before", "object", DefaultJSONProvider(app))]
+    cases += [(name, format, provider) for format in ("object", "columnar", "ndjson")
+              for name, provider in providers.items()]
+    for name, format, provider in cases:
+        build = bodies(size)[format]
+        if name == "before":
+            body = provider.response(build()).get_data()
+            seconds = cpu_time(lambda: provider.response(build()).get_data(), rounds)
+        else:
+            body = respond(provider, format, build)
+            seconds = cpu_time(lambda: respond(provider, format, build), rounds)
+        print(f"  {format:9} {name:7} {len(body):10} bytes {len(gzip.compress(body)):9} gzipped   "
+              f"cpu {seconds * 1000:8.2f} ms")
+
+
+def fixed_message(rounds):
+    per_response = DefaultJSONProvider(app)
+    compact = CompactJSONProvider(app, app.config['JSON_BACKEND'])
+    plain = dict(spot_not_available)
+    for name, function in (("encoded per response", lambda: per_response.response(plain)),
+                           ("pre-encoded", lambda: compact.response(spot_not_available))):
+        seconds = cpu_time(lambda: [function() for i in range(1000)], rounds)
+        print(f"  {name:20} {seconds * 1000:8.2f} us per response")
+
+
+def requests(size, rounds):
+    with app.app_context():
+        provision_lot(size)
+        db.session.execute(update(CarParkingModel).values(
+            parking_available=False, vehicle_number=CarParkingModel.parking_spot, vehicle_mark="bench"))
+        db.session.commit()
+        headers = {"Authorization": "Basic " + new_token("BEN001", "bench")[0]}
+    client = app.test_client()
+    for format in ("", "columnar"):
+        response = client.get(f"/get_all?format={format}", headers=headers)
+        seconds = cpu_time(lambda: client.get(f"/get_all?format={format}", headers=headers).get_data(), rounds)
+        print(f"  {format or 'object':9} {len(response.get_data()):10} bytes   cpu {seconds * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    sizes = [int(size) for size in sys.argv[1:]] or [10000, 100000]
+    with app.app_context():
+        for size in sizes:
+            formats_and_backends(size, 15)
+        print(f"a fixed error message ({app.config['JSON_BACKEND']} backend):")
+        fixed_message(15)
+    with app.app_context():
+        db.create_all()
+    print(f"whole get_all requests on a full lot of {max(sizes)} spots:")
+    requests(max(sizes), 7)
@@ -0,0 +1,97 @@
+# Cold-start time of the entry points, each run in a fresh interpreter:
+# importing main (tests, benchmarks and jobs), a worker answering its first
+# request, a CLI command, and the async app. Most of it is importing Flask and
+# SQLAlchemy, so every entry point is also timed against an interpreter that
+# only imports its dependencies, and the difference has a target, a share of
+# that dependency-only time so it holds on slower and faster machines alike;
+# the run exits with status 1 when one is above it. --importtime adds the slowest
+# direct imports of main, from python -X importtime.
+#
+# Run from the project directory:
+#   python -m benchmarks.startup --runs 10 --importtime
+# --path runs the same entry points against another checkout, e.g. an older
+# commit unpacked with git archive, to compare with it.
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks import scratch_environment
+
+dependencies = ["-c", "import click, flask, flask_sqlalchemy"]
+async_dependencies = ["-c", "import aiosqlite, flask, flask_sqlalchemy, sqlalchemy.ext.asyncio, starlette.applications"]
+
+# name: (command, command importing only its dependencies, target over them as a share of their time)
+entry_points = {
+    "import main": (["-c", "import main"], dependencies, 0.2),
+    "worker, first request": (["-c", "from main import app; app.test_client().get('/metrics')"], dependencies, 0.3),
+    "cli: flask migrate": (["-m", "flask", "--app", "main", "migrate"], dependencies, 0.2),
+    "import asgi": (["-c", "import asgi"], async_dependencies, 0.2),
+}
+
+
+def cold_start(arguments, path, environment):
+    started = time.perf_counter()
+    subprocess.run([sys.executable, *arguments], cwd=path, env=environment, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - started
+
+
+def slowest_imports(path, environment, top):
+    # Cumulative microseconds of every module main imports directly, largest
+    # first. The report lists a module after its imports, indented one level
+    # deeper per level of nesting.
+    report = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=path, env=environment,
+                            check=True, capture_output=True, text=True).stderr
+    modules = []
+    for line in report.splitlines()[1:]:
+        own, cumulative, name = line.split(":", 1)[1].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            if name.strip() == "main":
+                return [(int(cumulative), "main (total)")] + sorted(modules, reverse=True)[:top]
+            modules = []
+        elif depth == 1:
+            modules.append((int(cumulative), name.strip()))
+    return []
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold-start time of the CLI, worker and import entry points.")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--path", default=os.getcwd(), help="checkout to run the entry points in")
+    parser.add_argument("--importtime", type=int, nargs="?", const=12, default=0, metavar="TOP",
+                        help="also list the slowest imports of main")
+    args = parser.parse_args()
+    environment = scratch_environment(dict(os.environ))
+    environment.setdefault("PARKING_SECRET_KEY", "startup-bench")
+    subprocess.run([sys.executable, "-m", "flask", "--app", "main", "migrate"], cwd=args.path, env=environment,
+                   check=True, stdout=subprocess.DEVNULL)
+    cold_start(["-c", "import main"], args.path, environment)
+    print(f"median of {args.runs} cold starts, and what the entry point adds to importing its dependencies:")
+    missed = []
+    for name, (arguments, baseline, target) in entry_points.items():
+        timings = []
+        floor = []
+        # Alternate the two, so a busy moment slows both of them.
+        for i in range(args.runs):
+            timings.append(cold_start(arguments, args.path, environment))
+            floor.append(cold_start(baseline, args.path, environment))
+        added = statistics.median(timings) - statistics.median(floor)
+        limit = target * statistics.median(floor)
+        if added > limit:
+            missed.append(name)
+        print(f"  {name:22} {statistics.median(timings) * 1000:8.1f} ms   added {added * 1000:7.1f} ms   "
+              f"target {limit * 1000:5.0f} ms ({target:.0%} of the dependencies)"
+              f"{'   MISSED' if added > limit else ''}")
+    if args.importtime:
+        print("slowest imports of main (cumulative):")
+        for cumulative, name in slowest_imports(args.path, environment, args.importtime):
+            print(f"  {name:28} {cumulative / 1000:8.1f} ms")
+    sys.exit(1 if missed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# Throughput of the API under gunicorn as the number of worker processes grows.
+# Every worker count runs the same load phases as benchmarks.load against a
+# freshly provisioned lot, with PARKING_SHARED_STATE_CHECK=0 so each read sees
+# writes from the other workers.
+#
+# Run from the project directory (needs gunicorn):
+#   python -m benchmarks.workers --workers 1 2 4 8 --clients 32 --output workers.json
+# Unless PARKING_DATABASE_URI and PARKING_JOURNAL are set, scratch files are used.
+import argparse
+import json
+import os
+import sys
+import time
+
+from benchmarks import scratch_environment
+
+# Every worker count drops and recreates the tables, so main must be
+# imported with the scratch database in place.
+scratch_environment()
+
+from benchmarks.load import ServerTransport, run_mode
+from main import app, db, provision_lot
+
+
+def gunicorn_command(port, workers, threads):
+    return [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py",
+            "--bind", f"127.0.0.1:{port}", "--workers", str(workers), "--threads", str(threads)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scale gunicorn workers under load.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--lot-size", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--port", type=int, default=5056)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    count = min(args.requests, args.lot_size // 2)
+    report = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "database": os.environ["PARKING_DATABASE_URI"],
+        "threads": args.threads,
+        "clients": args.clients,
+        "requests": count,
+        "workers": {},
+    }
+    for workers in args.workers:
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            provision_lot(args.lot_size)
+        print(f"{workers} workers x {args.threads} threads, {args.clients} clients")
+        transport = ServerTransport(args.port, gunicorn_command(args.port, workers, args.threads),
+                                    env={"PARKING_SHARED_STATE_CHECK": "0"})
+        try:
+            report["workers"][workers] = run_mode(transport, count, args.clients)
+        finally:
+            transport.close()
+    print("rps by worker count:")
+    for name in next(iter(report["workers"].values())):
+        print(f"  {name:17} " + "  ".join(
+            f"{workers}: {results[name]['rps']:8.1f}" for workers, results in report["workers"].items()))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
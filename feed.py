@@ -0,0 +1,146 @@
+import collections
+import itertools
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def event(kind, seq, data):
+    return f"id: {seq}\nevent: {kind}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+class OccupancyFeed:
+    # Post-commit occupancy changes of one lot, coalesced by a background
+    # thread into numbered batches that are encoded once and kept in a ring
+    # buffer. Subscribers only read the buffer, so adding one costs no
+    # database work.
+    def __init__(self, occupancy, coalesce=0.05, history=256):
+        self.occupancy = occupancy
+        self.coalesce = coalesce
+        self.batches = collections.deque(maxlen=history)
+        self.pending = {}
+        self.seq = 0
+        self.subscribers = 0
+        self.listeners = []
+        self.poll = None
+        self.poll_interval = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.sealed = threading.Condition(self.lock)
+
+    def start(self, coalesce=None, poll_interval=None, poll=None):
+        with self.lock:
+            if coalesce is not None:
+                self.coalesce = coalesce
+            if poll is not None:
+                self.poll, self.poll_interval = poll, poll_interval
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="occupancy-feed", daemon=True)
+                self.thread.start()
+
+    def attach(self):
+        with self.lock:
+            self.subscribers += 1
+
+    def detach(self):
+        with self.lock:
+            self.subscribers -= 1
+
+    def add_listener(self, listener):
+        with self.lock:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self.lock:
+            self.listeners.remove(listener)
+
+    def publish(self, spot_number, free):
+        with self.lock:
+            if not self.subscribers:
+                return
+            self.pending[spot_number] = free
+            self.changed.notify()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.changed.wait(self.poll_interval)
+                poll = self.poll if self.subscribers else None
+            if poll is not None:
+                try:
+                    poll()
+                except Exception:
+                    # A locked or unreachable database only delays the changes
+                    # of other workers to the next poll.
+                    logger.exception("occupancy feed poll failed")
+            if self.pending:
+                time.sleep(self.coalesce)
+                self._seal()
+
+    def _seal(self):
+        with self.lock:
+            changes, self.pending = self.pending, {}
+            self.seq += 1
+            self.batches.append((self.seq, event("delta", self.seq, {
+                "free": self.occupancy.free_count(),
+                "closest spot": self.occupancy.next_free(),
+                "changed": changes,
+            })))
+            self.sealed.notify_all()
+            listeners = list(self.listeners)
+        for listener in listeners:
+            try:
+                listener()
+            except Exception:
+                logger.exception("occupancy feed listener failed")
+
+    def _snapshot(self):
+        return event("snapshot", self.seq, {
+            "free": self.occupancy.free_count(),
+            "closest spot": self.occupancy.next_free(),
+            "free spots": self.occupancy.free_spots(),
+        })
+
+    def _since(self, last_seq):
+        if last_seq == self.seq:
+            return [], last_seq
+        oldest = self.batches[0][0] if self.batches else self.seq + 1
+        if last_seq is None or last_seq < oldest - 1 or last_seq > self.seq:
+            return [self._snapshot()], self.seq
+        start = len(self.batches) - (self.seq - last_seq)
+        return [text for seq, text in itertools.islice(self.batches, start, None)], self.seq
+
+    def since(self, last_seq):
+        with self.lock:
+            return self._since(last_seq)
+
+    def wait(self, last_seq, timeout):
+        with self.lock:
+            if last_seq == self.seq:
+                self.sealed.wait(timeout)
+            return self._since(last_seq)
+
+    def stream(self, last_seq, heartbeat):
+        self.attach()
+        try:
+            chunks, last_seq = self.since(last_seq)
+            yield "".join(chunks) or ": connected\n\n"
+            while True:
+                chunks, last_seq = self.wait(last_seq, heartbeat)
+                yield "".join(chunks) or ": keepalive\n\n"
+        finally:
+            self.detach()
+
+    def after_fork(self):
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.sealed = threading.Condition(self.lock)
+        self.thread = None
+        self.subscribers = 0
+        self.pending = {}
+        self.listeners = []
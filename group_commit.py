@@ -0,0 +1,62 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class GroupCommit:
+    # Spot writes of concurrent requests to one lot, run by a writer thread in
+    # one shared transaction: it takes the first queued operation, collects
+    # more for up to window seconds or until there are size of them, and
+    # commits them together. Each request waits for the commit of its group,
+    # so a response still means its change is committed.
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.run = None
+        self.window = 0.0
+        self.size = 1
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self, run, window, size):
+        with self.lock:
+            self.run, self.window, self.size = run, window, size
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+                self.thread.start()
+
+    def submit(self, operation):
+        future = Future()
+        self.queue.put((operation, future))
+        return future.result()
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.size:
+            try:
+                batch.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                outcomes = self.run([operation for operation, future in batch])
+            except Exception as error:
+                # The shared commit failed, so none of the operations happened.
+                for operation, future in batch:
+                    future.set_exception(error)
+                continue
+            for (operation, future), (done, value) in zip(batch, outcomes):
+                if done:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    def after_fork(self):
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.lock = threading.Lock()
@@ -0,0 +1,19 @@
+# gunicorn --config gunicorn.conf.py
+# Each worker keeps its own occupancy map and token cache; PARKING_SHARED_STATE_CHECK
+# (seconds) makes them notice writes committed by the other workers.
+import multiprocessing
+import os
+
+wsgi_app = "main:create_app()"
+bind = os.environ.get("PARKING_BIND", "127.0.0.1:5000")
+workers = int(os.environ.get("PARKING_WORKERS", multiprocessing.cpu_count()))
+threads = int(os.environ.get("PARKING_THREADS", 4))
+worker_class = "gthread"
+raw_env = ["PARKING_SHARED_STATE_CHECK=" + os.environ.get("PARKING_SHARED_STATE_CHECK", "0")]
+
+
+def post_fork(server, worker):
+    from main import after_fork, start_token_reaper
+    app = worker.app.wsgi()
+    after_fork(app)
+    start_token_reaper(app)
@@ -0,0 +1,393 @@
+import json
+import os
+import threading
+import time
+
+# One NDJSON record per committed transaction of a lot:
+#   {"l": lot, "v": version, "t": unix time, "ev": [event, ...]}
+# with compact array events
+#   ["park", spot, vehicle_number, vehicle_mark]
+#   ["leave", spot]
+#   ["move", from_spot, to_spot, vehicle_number, vehicle_mark]
+#   ["size", spots, spots_per_level]
+#   ["layout", first_spot, last_spot, spot_type, distance, step]
+# "v" is the lot's state version bumped in the same transaction. Records are
+# appended before the commit while the version row is locked, so per lot the
+# file is in version order. A transaction that failed to commit is followed by
+# {"l": lot, "v": version, "abort": true}, or by a record reusing its version.
+# A checkpoint rotates the file out to a numbered segment (journal.ndjson.1,
+# journal.ndjson.2, ...) and removes the segments before it; writers notice
+# the rotation on their next append and start a new file.
+
+
+def park_event(spot_number, vehicle_number, vehicle_mark):
+    return ["park", spot_number, vehicle_number, vehicle_mark]
+
+
+def leave_event(spot_number):
+    return ["leave", spot_number]
+
+
+def move_event(from_spot, to_spot, vehicle_number, vehicle_mark):
+    return ["move", from_spot, to_spot, vehicle_number, vehicle_mark]
+
+
+def reserve_event(spot_number, vehicle_number, until):
+    return ["reserve", spot_number, vehicle_number, until]
+
+
+def cancel_event(spot_number):
+    return ["cancel", spot_number]
+
+
+def size_event(spots, spots_per_level):
+    return ["size", spots, spots_per_level]
+
+
+def layout_event(first_spot, last_spot, spot_type, distance, step):
+    return ["layout", first_spot, last_spot, spot_type, distance, step]
+
+
+class Journal:
+    def __init__(self):
+        self.path = None
+        self.sync_interval = 0.1
+        self.fd = None
+        self.inode = None
+        self.pid = None
+        self.dirty = False
+        self.appended = 0
+        self.syncs = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+
+    def configure(self, path, sync_interval):
+        self.close()
+        self.path = path
+        self.sync_interval = sync_interval
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _rotated(self):
+        try:
+            return os.stat(self.path).st_ino != self.inode
+        except FileNotFoundError:
+            return True
+
+    def _open(self):
+        # Called with the lock held; reopens after a fork, where the syncer
+        # thread of the parent does not exist, and after a checkpoint rotated
+        # the file out, where the records written so far stay in the segment.
+        if self.fd is not None and self.pid == os.getpid():
+            if not self._rotated():
+                return
+            os.fsync(self.fd)
+            os.close(self.fd)
+            self.fd = None
+            self.wakeup.notify_all()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        size = os.fstat(self.fd).st_size
+        if size and os.pread(self.fd, 1, size - 1) != b"\n":
+            # The last record was cut short by a crash; end its line so the
+            # next record does not run into it.
+            os.write(self.fd, b"\n")
+        self.inode = os.fstat(self.fd).st_ino
+        self.pid = os.getpid()
+        self.dirty = False
+        if self.sync_interval:
+            threading.Thread(target=self._sync_loop, args=(self.fd,), name="journal-sync", daemon=True).start()
+
+    def append(self, lot_id, version, events):
+        self._write({"l": lot_id, "v": version, "t": int(time.time()), "ev": events})
+
+    def abort(self, lot_id, version):
+        self._write({"l": lot_id, "v": version, "abort": True})
+
+    def _write(self, record):
+        line = (json.dumps(record, separators=(",", ":")) + "\n").encode("utf8")
+        with self.lock:
+            self._open()
+            os.write(self.fd, line)
+            self.appended += 1
+            if not self.sync_interval:
+                os.fsync(self.fd)
+                self.syncs += 1
+            elif not self.dirty:
+                self.dirty = True
+                self.wakeup.notify()
+
+    def _sync_loop(self, fd):
+        while True:
+            with self.lock:
+                while not self.dirty and self.fd == fd:
+                    self.wakeup.wait()
+                if self.fd != fd:
+                    return
+            time.sleep(self.sync_interval)
+            with self.lock:
+                if self.fd != fd:
+                    return
+                self.dirty = False
+            os.fsync(fd)
+            self.syncs += 1
+
+    def sync(self):
+        with self.lock:
+            if self.fd is not None and self.pid == os.getpid():
+                os.fsync(self.fd)
+                self.dirty = False
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None and self.pid == os.getpid():
+                os.fsync(self.fd)
+                os.close(self.fd)
+            self.fd = None
+            self.wakeup.notify_all()
+
+    def after_fork(self):
+        # The lock may have been held by a thread that does not exist in the
+        # child; the inherited descriptor is replaced on the next append.
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = None
+
+    def stats(self):
+        return {"path": self.path, "appended": self.appended, "syncs": self.syncs}
+
+
+class LotSnapshot:
+    def __init__(self, version=0, spots_per_level=None):
+        self.version = version
+        self.spots_per_level = spots_per_level
+        self.levels = []
+        self.cars = {}
+        self.layout = {}
+        self.holds = {}
+        # The lot's last record, carried by a checkpoint until a later record
+        # or the database shows it was committed.
+        self.pending = None
+
+    def level_of(self, spot_number):
+        if not self.spots_per_level:
+            return 1
+        return (spot_number - 1) // self.spots_per_level + 1
+
+    def apply(self, event):
+        kind = event[0]
+        if kind == "park":
+            self.cars[event[1]] = (event[2], event[3])
+            self.holds.pop(event[1], None)
+        elif kind == "leave":
+            self.cars.pop(event[1], None)
+        elif kind == "move":
+            self.cars.pop(event[1], None)
+            self.cars[event[2]] = (event[3], event[4])
+            self.holds.pop(event[2], None)
+        elif kind == "reserve":
+            self.holds[event[1]] = (event[2], event[3])
+        elif kind == "cancel":
+            self.holds.pop(event[1], None)
+        elif kind == "size":
+            size, spots_per_level = event[1], event[2]
+            if spots_per_level:
+                self.spots_per_level = spots_per_level
+            if size < len(self.levels):
+                del self.levels[size:]
+                self.cars = {spot: car for spot, car in self.cars.items() if spot <= size}
+                self.layout = {spot: layout for spot, layout in self.layout.items() if spot <= size}
+                self.holds = {spot: hold for spot, hold in self.holds.items() if spot <= size}
+            self.levels.extend(self.level_of(spot) for spot in range(len(self.levels) + 1, size + 1))
+        elif kind == "layout":
+            first, last, spot_type, distance, step = event[1:]
+            for spot in range(first, min(last, len(self.levels)) + 1):
+                current_type, current_distance = self.layout.get(spot, ("standard", None))
+                self.layout[spot] = (spot_type if spot_type is not None else current_type,
+                                     distance + (spot - first) * step if distance is not None else current_distance)
+        else:
+            raise ValueError(f"Unknown journal event {kind!r}")
+
+    def rows(self):
+        for spot, level in enumerate(self.levels, 1):
+            car = self.cars.get(spot)
+            spot_type, distance = self.layout.get(spot, ("standard", None))
+            reserved_for, reserved_until = self.holds.get(spot, (None, None))
+            yield {"parking_spot": spot, "level": level, "spot_type": spot_type, "distance": distance,
+                   "parking_available": car is None,
+                   "vehicle_number": car[0] if car else None, "vehicle_mark": car[1] if car else None,
+                   "reserved_for": reserved_for, "reserved_until": reserved_until}
+
+    def to_record(self, lot_id):
+        runs = []
+        for spot, level in enumerate(self.levels, 1):
+            if not runs or runs[-1][1] != level:
+                runs.append([spot, level])
+        record = {"l": lot_id, "v": self.version, "k": self.spots_per_level, "n": len(self.levels), "levels": runs,
+                  "cars": [[spot, number, mark] for spot, (number, mark) in sorted(self.cars.items())],
+                  "layout": [[spot, spot_type, distance] for spot, (spot_type, distance) in sorted(self.layout.items())],
+                  "holds": [[spot, number, until] for spot, (number, until) in sorted(self.holds.items())]}
+        if self.pending is not None:
+            record["pending"] = self.pending
+        return record
+
+    @classmethod
+    def from_record(cls, record):
+        snapshot = cls(record["v"], record["k"])
+        runs = record["levels"] + [[record["n"] + 1, None]]
+        for (first, level), (following, _) in zip(runs, runs[1:]):
+            snapshot.levels.extend([level] * (following - first))
+        snapshot.cars = {spot: (number, mark) for spot, number, mark in record["cars"]}
+        snapshot.layout = {spot: (spot_type, distance) for spot, spot_type, distance in record.get("layout", [])}
+        snapshot.holds = {spot: (number, until) for spot, number, until in record.get("holds", [])}
+        snapshot.pending = record.get("pending")
+        return snapshot
+
+
+def segment_path(path, segment):
+    return f"{path}.{segment}"
+
+
+def journal_segments(path):
+    # The numbers of the segments rotated out of the journal, oldest first.
+    directory, name = os.path.split(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        return []
+    prefix = name + "."
+    return sorted(int(entry[len(prefix):]) for entry in os.listdir(directory)
+                  if entry.startswith(prefix) and entry[len(prefix):].isdigit())
+
+
+def rotate(path):
+    # Moves the journal to a new segment, numbered after the existing ones,
+    # and returns its number. Writers keep appending to the segment until
+    # they notice, which the next replay reads.
+    # An empty segment stands in for a journal nobody wrote to, so the
+    # numbers keep growing once older segments are removed.
+    segment = max(journal_segments(path), default=0) + 1
+    if os.path.exists(path):
+        os.rename(path, segment_path(path, segment))
+    else:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        open(segment_path(path, segment), "ab").close()
+    return segment
+
+
+def remove_segments(path, before=None):
+    for segment in journal_segments(path):
+        if before is None or segment < before:
+            os.remove(segment_path(path, segment))
+
+
+def read_checkpoint(path):
+    lots = {}
+    segment, offset = None, 0
+    if path and os.path.exists(path):
+        with open(path, "rb") as checkpoint:
+            header = json.loads(checkpoint.readline())
+            segment, offset = header.get("segment"), header["offset"]
+            for line in checkpoint:
+                record = json.loads(line)
+                lots[record["l"]] = LotSnapshot.from_record(record)
+    return lots, segment, offset
+
+
+def write_checkpoint(path, lots, offset=0, segment=None):
+    # offset is where the next replay starts reading the journal, or the
+    # segment the journal was rotated to; records before it are all covered
+    # by the snapshots and their pending records.
+    temporary = path + ".tmp"
+    with open(temporary, "w") as checkpoint:
+        checkpoint.write(json.dumps({"segment": segment, "offset": offset}) + "\n")
+        for lot_id, snapshot in sorted(lots.items()):
+            checkpoint.write(json.dumps(snapshot.to_record(lot_id), separators=(",", ":")) + "\n")
+        checkpoint.flush()
+        os.fsync(checkpoint.fileno())
+    os.replace(temporary, path)
+
+
+def replay(journal_path, checkpoint_path=None, settle=True, committed=None):
+    # Folds the segments and the journal into the last checkpoint. A lot's
+    # record is applied only once a later version of that lot shows it was
+    # committed, which drops aborted transactions. With settle the last record
+    # of every lot is applied at the end of the journal; without it (for a new
+    # checkpoint) those stay unapplied, as the pending records of the
+    # snapshots, and the returned offset is the end of the journal.
+    # The journal is written before the commit, so a crash in between leaves
+    # a last record that never happened; committed(lot) gives the version the
+    # database holds for a lot (None when it has none) and a newer last
+    # record is skipped.
+    # A record cut short by a crash was never committed: the replay stops at
+    # an unterminated last line of a file and skips a terminated one that does
+    # not decode (a torn record the journal closed when it was reopened). The
+    # file names and offsets of such records are returned in torn.
+    lots, segment, offset = read_checkpoint(checkpoint_path)
+    pending = {}
+    for lot_id, snapshot in lots.items():
+        if snapshot.pending is not None:
+            pending[lot_id], snapshot.pending = snapshot.pending, None
+    applied = 0
+    torn = []
+
+    def apply(lot_id, record):
+        snapshot = lots.get(lot_id)
+        if snapshot is None:
+            snapshot = lots[lot_id] = LotSnapshot()
+        for event in record["ev"]:
+            snapshot.apply(event)
+        snapshot.version = record["v"]
+        return len(record["ev"])
+
+    files, end = [], offset
+    if journal_path:
+        files = [journal_path]
+        if segment is not None:
+            files = [segment_path(journal_path, number) for number in journal_segments(journal_path)
+                     if number >= segment] + files
+            end = 0
+    first = journal_path if segment is None else segment_path(journal_path, segment)
+    for name in files:
+        if not os.path.exists(name):
+            continue
+        with open(name, "rb") as journal_file:
+            position = offset if name == first else 0
+            if position > os.fstat(journal_file.fileno()).st_size:
+                position = 0
+            journal_file.seek(position)
+            for line in journal_file:
+                if not line.endswith(b"\n"):
+                    torn.append([os.path.basename(name), position])
+                    break
+                start = position
+                position += len(line)
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    torn.append([os.path.basename(name), start])
+                    continue
+                lot_id = record["l"]
+                snapshot = lots.get(lot_id)
+                if snapshot is not None and record["v"] <= snapshot.version:
+                    continue
+                previous = pending.pop(lot_id, None)
+                if previous is not None and previous["v"] < record["v"]:
+                    applied += apply(lot_id, previous)
+                if "abort" not in record:
+                    pending[lot_id] = record
+        if name == journal_path:
+            end = position
+    for lot_id, record in pending.items():
+        if not settle:
+            if lot_id not in lots:
+                lots[lot_id] = LotSnapshot()
+            lots[lot_id].pending = record
+            continue
+        version = committed(lot_id) if committed else None
+        if version is None or record["v"] <= version:
+            applied += apply(lot_id, record)
+    return lots, applied, end, torn
@@ -1,34 +1,269 @@
-from flask import Flask, request
-from flask_restful import Api
+from flask import Blueprint, Flask, Response, after_this_request, current_app, g, has_app_context, has_request_context, \
+    request, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-import base64
+from flask_sqlalchemy.session import Session as FlaskSession
+import click
+from flask.cli import with_appcontext
+import sqlalchemy
+from sqlalchemy import case, delete, event, func, insert, select, text, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateColumn
+from werkzeug.http import quote_etag
+from werkzeug.local import LocalProxy
+import hashlib
+import json
+import os
+import threading
 from datetime import datetime, timedelta
 import time
+from occupancy import Lots
+from analytics import hour, hour_of, occupancy_buckets, peak_hours, session_runs
+from allocation import policies as allocation_policies, standard
+from journal import Journal, LotSnapshot, cancel_event, layout_event, leave_event, move_event, park_event, \
+    reserve_event, size_event, replay, write_checkpoint, rotate, remove_segments
+from scheduler import Scheduler
+from serialization import CompactJSONProvider, StaticBody, default_backend, encode
+from token_cache import TokenCache
+from tokens import Revocations, TokenSigner, is_signed, token_id
+import storage
+from metrics import Counter, Histogram, Registry, count_buckets, latency_buckets
 
-app = Flask(__name__)
-api = Api(app)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///database.db'
-db = SQLAlchemy(app)
+default_lot = 1
+partitioned_tables = {"car_parking_model", "state_version_model", "parking_session_model", "occupancy_rollup_model"}
+
+
+def current_lot():
+    if has_app_context():
+        return g.get("lot_id", default_lot)
+    return default_lot
+
+
+def lot_bind_key(lot_id):
+    return f"lot-{lot_id}"
+
+
+class LotSession(FlaskSession):
+    # Spots, their sessions and state version live in the lot's own database
+    # when SQLALCHEMY_BINDS has an entry for it, everything else in the default one.
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and mapper is not None:
+            table = sqlalchemy.inspect(mapper).local_table
+            engine = self._db.engines.get(lot_bind_key(current_lot()))
+            if engine is not None and table.name in partitioned_tables:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class ParkingApp(Flask):
+    # Compiling the URL rules is most of the time it takes to build the app,
+    # and CLI commands and jobs never route a request. Deferred blueprints are
+    # registered the first time the URL map is needed.
+    routes_registered = True
+
+    def __init__(self, import_name):
+        self.pending_blueprints = []
+        self.routes_lock = threading.RLock()
+        super().__init__(import_name)
+
+    def defer_blueprint(self, blueprint, **options):
+        self.pending_blueprints.append((blueprint, options))
+        self.routes_registered = False
+
+    @property
+    def url_map(self):
+        if not self.routes_registered:
+            # Reentrant: registering a blueprint reads the URL map itself.
+            with self.routes_lock:
+                pending, self.pending_blueprints = self.pending_blueprints, []
+                for blueprint, options in pending:
+                    self.register_blueprint(blueprint, **options)
+                if pending:
+                    self.routes_registered = True
+        return self.__dict__["url_map"]
+
+    @url_map.setter
+    def url_map(self, url_map):
+        self.__dict__["url_map"] = url_map
+
+
+db = SQLAlchemy(session_options={"class_": LotSession})
+bp = Blueprint("parking", __name__)
+service = Blueprint("service", __name__)
 
 message = "message"
+# Fixed responses, encoded once.
+not_authorized = StaticBody({message: "You are not authorized"})
+token_expired = StaticBody({message: "You are not authorized, token expired"})
+token_revoked = StaticBody({message: "You are not authorized, token revoked"})
+revoke_confirmation = StaticBody({message: "Token revoked"})
+no_free_spots = StaticBody({message: "There are no free spots in a parking lot."})
+no_such_car = StaticBody({message: "There is no car with this vehicle number in a parking lot."})
+no_cars_parked = StaticBody({message: "There are no cars parked in this parking lot."})
+spot_not_available = StaticBody({message: "This spot is not available!"})
+no_car_in_spot = StaticBody({message: "There is no car parked in this spot."})
+no_reservation = StaticBody({message: "There is no reservation for this spot."})
+batch_conflict = StaticBody({message: "A car in this batch was parked concurrently, nothing was changed."})
+
+
+class ParkingState:
+    # What a worker keeps in memory for one app. create_app puts it in
+    # app.extensions, so a second app has its own key, journal and maps.
+    def __init__(self, config):
+        key = config['SECRET_KEY']
+        self.lots = Lots()
+        self.token_cache = TokenCache(config['TOKEN_CACHE_SIZE'])
+        self.token_signer = TokenSigner(key.encode('utf8') if isinstance(key, str) else key)
+        self.revocations = Revocations()
+        self.journal = Journal()
+        self.journal.configure(config['JOURNAL_PATH'], config['JOURNAL_SYNC_INTERVAL'])
+        self.scheduler = Scheduler()
+        self.feed_limit = config['FEED_STREAMS']
+        self.feed_streams = threading.Semaphore(self.feed_limit)
+
+    def after_fork(self):
+        self.feed_streams = threading.Semaphore(self.feed_limit)
+        self.lots.after_fork()
+        self.token_cache.clear()
+        self.revocations.clear()
+        self.scheduler.after_fork()
+        self.journal.after_fork()
+
+
+def parking_state():
+    return current_app.extensions["parking"]
+
+
+# The state of the current app, looked up on every use.
+lots = LocalProxy(lambda: parking_state().lots)
+token_cache = LocalProxy(lambda: parking_state().token_cache)
+token_signer = LocalProxy(lambda: parking_state().token_signer)
+revocations = LocalProxy(lambda: parking_state().revocations)
+journal = LocalProxy(lambda: parking_state().journal)
+scheduler = LocalProxy(lambda: parking_state().scheduler)
+
+registry = Registry()
+request_duration = registry.register(Histogram(
+    "parking_request_duration_seconds", "Time spent handling a request.", latency_buckets))
+request_sql_statements = registry.register(Histogram(
+    "parking_request_sql_statements", "SQL statements executed while handling a request.", count_buckets))
+request_sql_duration = registry.register(Histogram(
+    "parking_request_sql_duration_seconds", "Time spent in SQL statements while handling a request.", latency_buckets))
+request_commit_duration = registry.register(Histogram(
+    "parking_request_commit_duration_seconds", "Time spent committing while handling a request.", latency_buckets))
+auth_duration = registry.register(Histogram(
+    "parking_auth_duration_seconds", "Time spent in is_authorized.", latency_buckets))
+registry.register(Counter("parking_token_cache_hits_total", "Token cache hits.", lambda: token_cache.hits))
+registry.register(Counter("parking_token_cache_misses_total", "Token cache misses.", lambda: token_cache.misses))
+
+
+def sql_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info["sql_started"] = time.perf_counter()
+
+
+def sql_finished(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and "sql_statements" in g:
+        g.sql_statements += 1
+        g.sql_seconds += time.perf_counter() - conn.info["sql_started"]
+
+
+def commit_started(session):
+    session.info["commit_started"] = time.perf_counter()
+
+
+def commit_finished(session):
+    if has_request_context() and "commit_seconds" in g and "commit_started" in session.info:
+        g.commit_seconds += time.perf_counter() - session.info.pop("commit_started")
+
+
+event.listen(Session, "before_commit", commit_started)
+event.listen(Session, "after_commit", commit_finished)
+
+
+@bp.url_value_preprocessor
+def pull_lot_id(endpoint, values):
+    if values and "lot_id" in values:
+        g.lot_id = values.pop("lot_id")
+
+
+@bp.before_request
+def check_lot():
+    # An unknown lot gets a 404 before any state is kept for it.
+    if not known_lot(db.session, current_lot()):
+        return unknown_lot(current_lot()), 404
+
+
+@bp.before_app_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.sql_statements = 0
+    g.sql_seconds = 0.0
+    g.commit_seconds = 0.0
+
+
+@bp.after_app_request
+def record_request_metrics(response):
+    if "request_started" in g:
+        endpoint = request.endpoint or "unmatched"
+        request_duration.observe(endpoint, time.perf_counter() - g.request_started)
+        request_sql_statements.observe(endpoint, g.sql_statements)
+        request_sql_duration.observe(endpoint, g.sql_seconds)
+        request_commit_duration.observe(endpoint, g.commit_seconds)
+    return response
+
 
 class AuthorizationModel(db.Model):
-    access_token = db.Column(db.String(100), primary_key=True)
-    expires_at = db.Column(db.Integer, nullable=False)
+    access_token = db.Column(db.LargeBinary(16), primary_key=True)
+    expires_at = db.Column(db.Integer, nullable=False, index=True)
 
     def get_expires_at(self):
         return self.expires_at
 
 
+class RevokedTokenModel(db.Model):
+    token_id = db.Column(db.LargeBinary(16), primary_key=True)
+    expires_at = db.Column(db.Integer, nullable=False, index=True)
+
+
+class LotModel(db.Model):
+    lot_id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=True)
+    spots_per_level = db.Column(db.Integer, nullable=True)
+
+    def get_level(self, spot_number):
+        if not self.spots_per_level:
+            return 1
+        return (spot_number - 1) // self.spots_per_level + 1
+
+
 class CarParkingModel(db.Model):
+    __table_args__ = (
+        db.Index("ix_car_parking_model_lot_vehicle", "lot_id", "vehicle_number", unique=True),
+        db.Index("ix_car_parking_model_lot_level", "lot_id", "level", "parking_available"),
+    )
+    lot_id = db.Column(db.Integer, primary_key=True, default=default_lot)
     parking_spot = db.Column(db.Integer, primary_key=True)
+    level = db.Column(db.Integer, nullable=False, default=1)
+    spot_type = db.Column(db.String(20), nullable=False, default=standard, server_default=standard)
+    distance = db.Column(db.Integer, nullable=True)
     vehicle_number = db.Column(db.String(6), nullable=True)
     vehicle_mark = db.Column(db.String(100), nullable=True)
     parking_available = db.Column(db.Boolean, nullable=False)
+    reserved_for = db.Column(db.String(6), nullable=True)
+    reserved_until = db.Column(db.Integer, nullable=True)
 
     def get_spot(self):
         return self.parking_spot
 
+    def get_level(self):
+        return self.level
+
+    def get_type(self):
+        return self.spot_type
+
+    def get_distance(self):
+        return self.distance
+
     def get_available(self):
         return self.parking_available
 
@@ -38,6 +273,12 @@ class CarParkingModel(db.Model):
     def get_mark(self):
         return self.vehicle_mark
 
+    def get_reserved_for(self):
+        return self.reserved_for
+
+    def get_reserved_until(self):
+        return self.reserved_until
+
     def set_mark(self, mark):
         self.vehicle_mark = mark
 
@@ -47,132 +288,1470 @@ class CarParkingModel(db.Model):
     def set_available(self, status):
         self.parking_available = status
 
+
+class StateVersionModel(db.Model):
+    lot_id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+
+
+class ParkingSessionModel(db.Model):
+    __table_args__ = (
+        db.Index("ix_parking_session_model_lot_entered", "lot_id", "entered_at"),
+        db.Index("ix_parking_session_model_lot_vehicle", "lot_id", "vehicle_number", "entered_at"),
+        db.Index("ix_parking_session_model_lot_open", "lot_id", "parking_spot", "left_at"),
+    )
+    session_id = db.Column(db.Integer, primary_key=True)
+    lot_id = db.Column(db.Integer, nullable=False)
+    parking_spot = db.Column(db.Integer, nullable=False)
+    vehicle_number = db.Column(db.String(6), nullable=False)
+    vehicle_mark = db.Column(db.String(100), nullable=True)
+    entered_at = db.Column(db.Integer, nullable=False)
+    left_at = db.Column(db.Integer, nullable=True)
+
+
+class OccupancyRollupModel(db.Model):
+    # Arrivals and departures per lot and hour, kept up to date with the
+    # sessions, so reports read one row per hour instead of the sessions.
+    lot_id = db.Column(db.Integer, primary_key=True)
+    hour = db.Column(db.Integer, primary_key=True)
+    arrivals = db.Column(db.Integer, nullable=False, default=0)
+    departures = db.Column(db.Integer, nullable=False, default=0)
+    dwell_seconds = db.Column(db.BigInteger, nullable=False, default=0)
+
+# Lot operations shared with asgi.py. They take the connection to run on,
+# the Flask session here or the sync side of an async connection there, and
+# the lot, so both servers read and change spots the same way.
+def lot_spot_rows(connection, lot_id):
+    return connection.execute(select(CarParkingModel.parking_spot, CarParkingModel.parking_available,
+                                     CarParkingModel.level, CarParkingModel.spot_type, CarParkingModel.distance,
+                                     CarParkingModel.reserved_until)
+                              .where(CarParkingModel.lot_id == lot_id)).all()
+
+
+def lot_version(connection, lot_id):
+    return connection.execute(select(StateVersionModel.version).where(StateVersionModel.lot_id == lot_id)).scalar()
+
+
+def bump_version(connection, lot_id):
+    return connection.execute(
+        update(StateVersionModel).where(StateVersionModel.lot_id == lot_id)
+        .values(version=StateVersionModel.version + 1)
+        .returning(StateVersionModel.version)
+        .execution_options(synchronize_session=False)
+    ).scalar()
+
+
+def record_changes(connection, lot_id, version, events):
+    # What a write adds to its transaction besides the spots: the parking
+    # sessions, and the journal record, appended before the commit.
+    record_sessions(connection, lot_id, events, int(time.time()))
+    if journal.enabled and events:
+        journal.append(lot_id, version, events)
+
+
+def load_lot(connection, lot_id, vehicles=False):
+    # The version is read first: rows committed in between only make the
+    # maps newer than the version they are tagged with.
+    state = lots[lot_id]
+    version = lot_version(connection, lot_id)
+    rows = lot_spot_rows(connection, lot_id)
+    cars = connection.execute(parked_cars(lot_id)).all() if vehicles else None
+
+    def load():
+        state.occupancy.load(rows)
+        if cars is not None:
+            state.vehicles.load(cars)
+    state.version.observe(version, load)
+    schedule_expiry(lot_id)
+    return state
+
+
+def parked_cars(lot_id):
+    return select(CarParkingModel.parking_spot, CarParkingModel.vehicle_number) \
+        .where(CarParkingModel.lot_id == lot_id, CarParkingModel.parking_available.is_(False)) \
+        .order_by(CarParkingModel.parking_spot)
+
+
+def parked_car_line(spot, number, dumps):
+    return encode({"spot": spot, "vehicle_number": number}, dumps)
+
+
+def find_car(connection, lot_id, vehicle_number):
+    return connection.execute(select(CarParkingModel.parking_spot).where(
+        CarParkingModel.lot_id == lot_id, CarParkingModel.vehicle_number == vehicle_number)).scalar()
+
+
+def all_parked_cars(connection, lot_id):
+    rows = connection.execute(parked_cars(lot_id)).all()
+    if len(rows) == 0:
+        return no_cars_parked
+    return {spot: number for spot, number in rows}
+
+
+def parked_cars_page(connection, lot_id, after, page_size):
+    rows = connection.execute(parked_cars(lot_id).where(CarParkingModel.parking_spot > after).limit(page_size)).all()
+    next_after = rows[-1][0] if len(rows) == page_size else None
+    return {"cars": {spot: number for spot, number in rows}, "next": next_after}
+
+
+def parked_cars_columns(connection, lot_id):
+    # Two parallel arrays instead of an object keyed by spot: no spot number
+    # turned into a string key per car, and only two columns are loaded.
+    rows = connection.execute(parked_cars(lot_id)).all()
+    return {"spots": [spot for spot, number in rows], "vehicle_numbers": [number for spot, number in rows]}
+
+
+def clamp_page_size(page_size, config):
+    return max(1, min(page_size, config['MAX_PAGE_SIZE']))
+
+
+def level_counts(connection, lot_id):
+    # A held spot is not free until its hold runs out, as in free_spots.
+    now = int(time.time())
+    free = CarParkingModel.parking_available & (CarParkingModel.reserved_until.is_(None) |
+                                                (CarParkingModel.reserved_until <= now))
+    rows = connection.execute(select(CarParkingModel.level, func.count(), func.count(case((free, 1))))
+                              .where(CarParkingModel.lot_id == lot_id)
+                              .group_by(CarParkingModel.level)
+                              .order_by(CarParkingModel.level)).all()
+    return {level: {"spots": spots, "free": free} for level, spots, free in rows}
+
+
+def known_lot(connection, lot_id):
+    # Lots are never removed, so one that has state in this process exists.
+    if lot_id == default_lot or lot_id in lots:
+        return True
+    return connection.execute(select(LotModel.lot_id).where(LotModel.lot_id == lot_id)).first() is not None
+
+
+def unknown_lot(lot_id):
+    return {message: f"There is no lot {lot_id}."}
+
+
+def lot_list(connection):
+    rows = connection.execute(select(LotModel.lot_id, LotModel.name, LotModel.spots_per_level)
+                              .order_by(LotModel.lot_id)).all()
+    return {lot_id: {"name": name, "spots_per_level": spots_per_level} for lot_id, name, spots_per_level in rows}
+
+
+def not_held(vehicle_number, now):
+    return CarParkingModel.reserved_until.is_(None) | (CarParkingModel.reserved_until <= now) | \
+        (CarParkingModel.reserved_for == vehicle_number)
+
+
+def spot_update(lot_id, spot_number, *criteria):
+    return update(CarParkingModel).where(CarParkingModel.lot_id == lot_id, CarParkingModel.parking_spot == spot_number,
+                                         *criteria).execution_options(synchronize_session=False)
+
+
+def occupy_spot(connection, lot_id, spot_number, vehicle_number, vehicle_mark):
+    # A reserved spot only takes the car it is held for until the hold runs out.
+    return connection.execute(spot_update(
+        lot_id, spot_number, CarParkingModel.parking_available.is_(True), not_held(vehicle_number, int(time.time())))
+        .values(vehicle_number=vehicle_number, vehicle_mark=vehicle_mark, parking_available=False,
+                reserved_for=None, reserved_until=None)).rowcount
+
+
+def vacate_spot(connection, lot_id, spot_number, vehicle_number=None):
+    criteria = [CarParkingModel.parking_available.is_(False)]
+    if vehicle_number is not None:
+        criteria.append(CarParkingModel.vehicle_number == vehicle_number)
+    return connection.execute(spot_update(lot_id, spot_number, *criteria)
+                              .values(vehicle_number=None, vehicle_mark=None, parking_available=True)).rowcount
+
+
+def reserve_spot(connection, lot_id, spot_number, vehicle_number, until, now):
+    return connection.execute(spot_update(
+        lot_id, spot_number, CarParkingModel.parking_available.is_(True), not_held(vehicle_number, now))
+        .values(reserved_for=vehicle_number, reserved_until=until)).rowcount
+
+
+def cancel_hold(connection, lot_id, spot_number, now):
+    return connection.execute(spot_update(lot_id, spot_number, CarParkingModel.reserved_until > now)
+                              .values(reserved_for=None, reserved_until=None)).rowcount
+
+
+# The writes return their response with the events to commit; without
+# events the caller rolls back whatever they changed on the way.
+def already_parked(vehicle_number):
+    return {message: f"Car {vehicle_number} is already parked."}
+
+
+def park_car(connection, lot_id, spot_number, vehicle_number, vehicle_mark):
+    if not occupy_spot(connection, lot_id, spot_number, vehicle_number, vehicle_mark):
+        return spot_not_available, []
+    return {"parking spot": spot_number}, [park_event(spot_number, vehicle_number, vehicle_mark)]
+
+
+def leave_spot(connection, lot_id, spot_number):
+    if not vacate_spot(connection, lot_id, spot_number):
+        return no_car_in_spot, []
+    return {"message": f"spot {spot_number} is available"}, [leave_event(spot_number)]
+
+
+def hold_spot(connection, lot_id, spot_number, vehicle_number, until, now):
+    if not reserve_spot(connection, lot_id, spot_number, vehicle_number, until, now):
+        return spot_not_available, []
+    return {"reserved spot": spot_number, "expires_at": until}, [reserve_event(spot_number, vehicle_number, until)]
+
+
+def release_hold(connection, lot_id, spot_number, now):
+    if not cancel_hold(connection, lot_id, spot_number, now):
+        return no_reservation, []
+    return {"message": f"spot {spot_number} is available"}, [cancel_event(spot_number)]
+
+
+def move_car(connection, lot_id, vehicle_number, vehicle_mark, new_spot):
+    spot_nr = find_car(connection, lot_id, vehicle_number)
+    if spot_nr == new_spot:
+        # Already parked there: nothing moves, so no event and no session update.
+        return spot_not_available, []
+    if spot_nr is None or not vacate_spot(connection, lot_id, spot_nr, vehicle_number):
+        return {message: f"Car {vehicle_number} not parked."}, []
+    if not occupy_spot(connection, lot_id, new_spot, vehicle_number, vehicle_mark):
+        return spot_not_available, []
+    return {"message": f"{vehicle_number} parked to {new_spot}"}, \
+        [move_event(spot_nr, new_spot, vehicle_number, vehicle_mark)]
+
+
+def batch_too_large(items, config):
+    if len(items) > config['MAX_BATCH_SIZE']:
+        return {message: f"Batch is limited to {config['MAX_BATCH_SIZE']} items."}
+    return None
+
+
+def park_cars(connection, lot_id, items):
+    numbers = [item["vehicle_number"] for item in items]
+    parked = set(connection.execute(select(CarParkingModel.vehicle_number).where(
+        CarParkingModel.lot_id == lot_id, CarParkingModel.vehicle_number.in_(numbers))).scalars())
+    results = []
+    events = []
+    for item in items:
+        if item["vehicle_number"] in parked:
+            results.append(already_parked(item["vehicle_number"]))
+            continue
+        result, changes = park_car(connection, lot_id, item["spot"], item["vehicle_number"], item["vehicle_mark"])
+        if changes:
+            parked.add(item["vehicle_number"])
+        results.append(result)
+        events.extend(changes)
+    return {"results": results}, events
+
+
+def leave_spots(connection, lot_id, spot_numbers):
+    results = []
+    events = []
+    for spot_number in spot_numbers:
+        result, changes = leave_spot(connection, lot_id, spot_number)
+        results.append(result)
+        events.extend(changes)
+    return {"results": results}, events
+
+
+def spot_rows():
+    return lot_spot_rows(db.session, current_lot())
+
+
+def stored_version():
+    return lot_version(db.session, current_lot())
+
+
+def refresh_shared_state():
+    state = lots[current_lot()]
+    interval = current_app.config['SHARED_STATE_CHECK_INTERVAL']
+    if not state.version.waiting() and (interval is None or not state.version.due(interval, time.monotonic())):
+        return state
+    version = stored_version()
+    if not state.version.observe(version):
+        state.occupancy.loaded = False
+        state.vehicles.loaded = False
+    return state
+
+
+def bump_state_version():
+    return bump_version(db.session, current_lot())
+
+
+def commit_spot_changes(events=()):
+    # Nothing changed: the version stays and nothing is committed.
+    if not events:
+        return None
+    return commit_version(current_lot(), bump_state_version(), events)
+
+
+def commit_version(lot_id, version, events):
+    record_changes(db.session, lot_id, version, events)
+    try:
+        db.session.commit()
+    except Exception:
+        if journal.enabled and events:
+            journal.abort(lot_id, version)
+        raise
+    spots_committed(lot_id, version, events)
+    return version
+
+
+def spots_committed(lot_id, version, events):
+    # The events reach the maps in version order, whatever order the
+    # committing threads get here in. The maps are updated before the version
+    # advances, so a version read before building a response never claims a
+    # change the maps lack.
+    state = lots[lot_id]
+    if not state.version.advance(version, lambda: apply_events(lot_id, events)):
+        state.occupancy.loaded = False
+        state.vehicles.loaded = False
+
+
+def apply_events(lot_id, events):
+    for change in events:
+        if change[0] == "park":
+            spot_taken(change[1], change[2], lot_id)
+        elif change[0] == "leave":
+            spot_released(change[1], lot_id)
+        elif change[0] == "move":
+            spot_released(change[1], lot_id)
+            spot_taken(change[2], change[3], lot_id)
+        elif change[0] == "reserve":
+            spot_held(change[1], change[3], lot_id)
+        elif change[0] == "cancel":
+            spot_released(change[1], lot_id)
+
+
+def commit_group(operations):
+    # The version row is updated first: that opens the transaction, so the
+    # savepoint of each operation nests in it (pysqlite would otherwise let
+    # the first SAVEPOINT start the transaction and its RELEASE commit it).
+    lot_id = current_lot()
+    version = bump_state_version()
+    outcomes = []
+    events = []
+    for operation in operations:
+        savepoint = db.session.begin_nested()
+        try:
+            result, changes = operation()
+        except Exception as error:
+            savepoint.rollback()
+            outcomes.append((False, error))
+            continue
+        if not changes:
+            savepoint.rollback()
+        else:
+            savepoint.commit()
+        events.extend(changes)
+        outcomes.append((True, result))
+    if events:
+        commit_version(lot_id, version, events)
+    else:
+        db.session.rollback()
+    return outcomes
+
+
+def group_committer(app, lot_id):
+    def run(operations):
+        with app.app_context():
+            g.lot_id = lot_id
+            return commit_group(operations)
+    return run
+
+
+def write_spots(operation):
+    # operation changes spots in the current session and returns its result
+    # with the events to commit. With group commit the writer thread of the
+    # lot runs it in a transaction shared with other requests.
+    window = current_app.config['GROUP_COMMIT_WINDOW']
+    if window is None:
+        result, events = operation()
+        if events:
+            commit_spot_changes(events)
+        else:
+            db.session.rollback()
+        return result
+    lot_id = current_lot()
+    writer = lots[lot_id].writer
+    if writer.thread is None:
+        writer.start(group_committer(current_app._get_current_object(), lot_id), window,
+                     current_app.config['GROUP_COMMIT_SIZE'])
+    return writer.submit(operation)
+
+
+def open_session(lot_id):
+    return (ParkingSessionModel.lot_id == lot_id) & ParkingSessionModel.left_at.is_(None)
+
+
+def session_statements(lot_id, events, now):
+    # One statement per run of parks or leaves in the events of a transaction;
+    # the leaves return when their sessions started.
+    for kind, run in session_runs(events):
+        if kind == "park":
+            yield kind, insert(ParkingSessionModel), [
+                {"lot_id": lot_id, "parking_spot": change[1], "vehicle_number": change[2], "vehicle_mark": change[3],
+                 "entered_at": now} for change in run]
+        elif kind == "leave":
+            yield kind, update(ParkingSessionModel) \
+                .where(open_session(lot_id), ParkingSessionModel.parking_spot.in_([change[1] for change in run])) \
+                .values(left_at=now).returning(ParkingSessionModel.entered_at) \
+                .execution_options(synchronize_session=False), None
+        elif kind == "move":
+            for change in run:
+                yield kind, update(ParkingSessionModel) \
+                    .where(open_session(lot_id), ParkingSessionModel.parking_spot == change[1]) \
+                    .values(parking_spot=change[2], vehicle_mark=change[4]) \
+                    .execution_options(synchronize_session=False), None
+
+
+def rollup_statements(lot_id, now, arrivals, departures, dwell_seconds):
+    # Writers of a lot hold its version row until they commit, so only the
+    # first change of an hour inserts its row and no two of them race.
+    rollup = OccupancyRollupModel
+    hour_start = hour_of(now)
+    return (update(rollup).where(rollup.lot_id == lot_id, rollup.hour == hour_start)
+            .values(arrivals=rollup.arrivals + arrivals, departures=rollup.departures + departures,
+                    dwell_seconds=rollup.dwell_seconds + dwell_seconds)
+            .execution_options(synchronize_session=False),
+            insert(rollup).values(lot_id=lot_id, hour=hour_start, arrivals=arrivals, departures=departures,
+                                  dwell_seconds=dwell_seconds))
+
+
+def add_to_rollup(connection, lot_id, now, arrivals, departures, dwell_seconds):
+    if not arrivals and not departures:
+        return
+    update_rollup, insert_rollup = rollup_statements(lot_id, now, arrivals, departures, dwell_seconds)
+    if not connection.execute(update_rollup).rowcount:
+        connection.execute(insert_rollup)
+
+
+def record_sessions(connection, lot_id, events, now):
+    arrivals = departures = dwell_seconds = 0
+    for kind, statement, rows in session_statements(lot_id, events, now):
+        if kind == "park":
+            connection.execute(statement, rows)
+            arrivals += len(rows)
+        elif kind == "leave":
+            entered = connection.execute(statement).scalars().all()
+            departures += len(entered)
+            dwell_seconds += sum(now - entered_at for entered_at in entered)
+        else:
+            connection.execute(statement)
+    add_to_rollup(connection, lot_id, now, arrivals, departures, dwell_seconds)
+
+
+def reconcile_sessions(now=None):
+    # Cars parked before sessions were recorded, or put back by a rebuild,
+    # get a session starting now; open sessions whose car is gone end now.
+    now = now or int(time.time())
+    lot_id = current_lot()
+    session = ParkingSessionModel
+    spot = CarParkingModel
+    parked = (spot.lot_id == lot_id) & spot.parking_available.is_(False)
+    ended = db.session.execute(
+        update(session).where(open_session(lot_id), ~select(spot.parking_spot).where(
+            parked, spot.parking_spot == session.parking_spot, spot.vehicle_number == session.vehicle_number).exists())
+        .values(left_at=now).returning(session.entered_at)
+        .execution_options(synchronize_session=False)).scalars().all()
+    opened = db.session.execute(insert(session).from_select(
+        ["lot_id", "parking_spot", "vehicle_number", "vehicle_mark", "entered_at"],
+        select(spot.lot_id, spot.parking_spot, spot.vehicle_number, spot.vehicle_mark, sqlalchemy.literal(now))
+        .where(parked, ~select(session.session_id).where(
+            open_session(lot_id), session.parking_spot == spot.parking_spot,
+            session.vehicle_number == spot.vehicle_number).exists()))).rowcount
+    add_to_rollup(db.session, lot_id, now, opened, len(ended), sum(now - entered_at for entered_at in ended))
+    return {"opened": opened, "ended": len(ended)}
+
+
+def ensure_lot(name=None, spots_per_level=None):
+    lot = db.session.get(LotModel, current_lot())
+    if lot is None:
+        lot = LotModel(lot_id=current_lot(), name=name, spots_per_level=spots_per_level)
+        db.session.add(lot)
+    elif name is not None or spots_per_level is not None:
+        lot.name = name if name is not None else lot.name
+        lot.spots_per_level = spots_per_level if spots_per_level is not None else lot.spots_per_level
+    if db.session.get(StateVersionModel, current_lot()) is None:
+        db.session.add(StateVersionModel(lot_id=current_lot(), version=0))
+    return lot
+
+
+def get_occupancy():
+    state = refresh_shared_state()
+    if not state.occupancy.loaded:
+        load_lot(db.session, current_lot())
+    expire_holds(state)
+    return state.occupancy
+
+
+def get_vehicle_index():
+    state = refresh_shared_state()
+    if not state.vehicles.loaded:
+        state.vehicles.load(db.session.execute(parked_cars(current_lot())).all())
+    return state.vehicles
+
+
+def spot_taken(spot_number, vehicle_number, lot_id=None):
+    state = lots[lot_id or current_lot()]
+    state.occupancy.take(spot_number)
+    if state.vehicles.loaded:
+        state.vehicles.park(spot_number, vehicle_number)
+    state.feed.publish(spot_number, False)
+
+
+def spot_released(spot_number, lot_id=None):
+    state = lots[lot_id or current_lot()]
+    state.occupancy.release(spot_number)
+    if state.vehicles.loaded:
+        state.vehicles.leave(spot_number)
+    state.feed.publish(spot_number, True)
+
+
+def spot_held(spot_number, until, lot_id=None):
+    lot_id = lot_id or current_lot()
+    state = lots[lot_id]
+    state.occupancy.hold(spot_number, until)
+    state.feed.publish(spot_number, False)
+    scheduler.call_at(until, hold_expiry(lot_id))
+
+
+def expire_holds(state):
+    for spot_number in state.occupancy.expire(time.time()):
+        state.feed.publish(spot_number, True)
+
+
+def schedule_expiry(lot_id):
+    until = lots[lot_id].occupancy.next_expiry()
+    if until is not None:
+        scheduler.call_at(until, hold_expiry(lot_id))
+
+
+def hold_expiry(lot_id):
+    app = current_app._get_current_object()
+
+    def run():
+        with app.app_context():
+            holds_expired(lot_id)
+    return run
+
+
+def holds_expired(lot_id):
+    # Run by the scheduler thread when a hold is due, so feed subscribers see
+    # the spot free up without any read or database query. Reads expire due
+    # holds themselves as well, the scheduler may be a moment late.
+    expire_holds(lots[lot_id])
+    schedule_expiry(lot_id)
+
+
+def lot_engines():
+    return {int(key[len("lot-"):]): engine for key, engine in db.engines.items()
+            if key is not None and key.startswith("lot-")}
+
+
+def rebuild_spot_table(engine):
+    # Databases created before lots existed have a flat car_parking_model keyed
+    # by parking_spot alone; its rows become lot 1, level 1. The rebuild is one
+    # transaction, so a failure leaves the flat table as it was.
+    inspector = sqlalchemy.inspect(engine)
+    old_versions = inspector.has_table("state_version_model") and \
+        "lot_id" not in {column["name"] for column in inspector.get_columns("state_version_model")}
+    flat = inspector.has_table("car_parking_model") and \
+        "lot_id" not in {column["name"] for column in inspector.get_columns("car_parking_model")}
+    if not old_versions and not flat:
+        return
+    with engine.begin() as connection:
+        if engine.dialect.name == "sqlite":
+            # pysqlite opens its transaction at the first INSERT, after the
+            # rename and the new table would already be committed.
+            connection.exec_driver_sql("BEGIN")
+        if old_versions:
+            StateVersionModel.__table__.drop(connection)
+        if not flat:
+            return
+        connection.execute(text("ALTER TABLE car_parking_model RENAME TO car_parking_model_flat"))
+        free_duplicate_plates(connection, "car_parking_model_flat")
+        CarParkingModel.__table__.create(connection)
+        connection.execute(text(
+            f"INSERT INTO car_parking_model (lot_id, parking_spot, level, vehicle_number, vehicle_mark, parking_available) "
+            f"SELECT {default_lot}, parking_spot, 1, vehicle_number, vehicle_mark, parking_available FROM car_parking_model_flat"))
+        connection.execute(text("DROP TABLE car_parking_model_flat"))
+
+
+def free_duplicate_plates(connection, table):
+    # The flat table allowed a car in two spots (the old change_spot parked it
+    # at the new spot before leaving the old one), the unique index of the
+    # vehicle number does not. Such a car keeps its lowest spot, the others
+    # are freed and reported.
+    rows = connection.execute(text(
+        f"SELECT parking_spot, vehicle_number FROM {table} WHERE vehicle_number IN "
+        f"(SELECT vehicle_number FROM {table} WHERE vehicle_number IS NOT NULL "
+        f"GROUP BY vehicle_number HAVING COUNT(*) > 1) ORDER BY vehicle_number, parking_spot")).all()
+    kept = {}
+    freed = []
+    for spot, vehicle_number in rows:
+        if vehicle_number in kept:
+            freed.append({"spot": spot, "free": True})
+            click.echo(f"Car {vehicle_number} was parked in spots {kept[vehicle_number]} and {spot}, "
+                       f"spot {spot} was freed.", err=True)
+        else:
+            kept[vehicle_number] = spot
+    if freed:
+        connection.execute(text(f"UPDATE {table} SET vehicle_number = NULL, vehicle_mark = NULL, "
+                                f"parking_available = :free WHERE parking_spot = :spot"), freed)
+    return freed
+
+
+def add_spot_columns(engine):
+    # Columns added to car_parking_model after a database was created.
+    if not sqlalchemy.inspect(engine).has_table("car_parking_model"):
+        return
+    existing = {column["name"] for column in sqlalchemy.inspect(engine).get_columns("car_parking_model")}
+    with engine.begin() as connection:
+        for column in CarParkingModel.__table__.columns:
+            if column.name not in existing:
+                connection.execute(text(
+                    f"ALTER TABLE car_parking_model ADD COLUMN {CreateColumn(column).compile(dialect=engine.dialect)}"))
+
+
+def digest_stored_tokens(engine):
+    # Databases from before tokens were stored as digests hold the whole
+    # "Basic ..." header as text. The live ones are replaced by their digest
+    # so they keep working until they expire, the expired ones are dropped.
+    with engine.begin() as connection:
+        connection.execute(delete(AuthorizationModel).where(AuthorizationModel.expires_at < int(time.time())))
+        stored = connection.execute(text("SELECT access_token, expires_at FROM authorization_model")).all()
+        legacy = [(token, expires_at) for token, expires_at in stored if isinstance(token, str)]
+        if not legacy:
+            return
+        connection.execute(text("DELETE FROM authorization_model WHERE access_token = :token"),
+                           [{"token": token} for token, expires_at in legacy])
+        connection.execute(insert(AuthorizationModel), [{"access_token": token_digest(token), "expires_at": expires_at}
+                                                        for token, expires_at in legacy])
+
+
+def upgrade_schema():
+    spot_tables = [CarParkingModel.__table__, StateVersionModel.__table__, ParkingSessionModel.__table__,
+                   OccupancyRollupModel.__table__]
+    rebuild_spot_table(db.engine)
+    add_spot_columns(db.engine)
+    db.create_all()
+    digest_stored_tokens(db.engine)
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    for lot_id, engine in lot_engines().items():
+        rebuild_spot_table(engine)
+        add_spot_columns(engine)
+        db.metadata.create_all(engine, tables=spot_tables)
+        # Pending rows are flushed to the bind of the current lot, so commit
+        # before switching to the next one.
+        g.lot_id = lot_id
+        ensure_lot()
+        db.session.commit()
+    g.lot_id = default_lot
+    if db.session.query(CarParkingModel.parking_spot).filter_by(lot_id=default_lot).first() is not None:
+        ensure_lot()
+        db.session.commit()
+    for lot_id, in db.session.query(LotModel.lot_id).all():
+        g.lot_id = lot_id
+        reconcile_sessions()
+        db.session.commit()
+    g.lot_id = default_lot
+
 #Authorization activities
-@app.route("/get_token/<string:vehicle_number>/<string:vehicle_mark>")
-def get_token(vehicle_number, vehicle_mark):
-    token = base64.encodebytes(('%s:%s' % (vehicle_number, vehicle_mark)).encode('utf8')).decode('utf8').replace('\n', '')
+def token_digest(basic_token):
+    return hashlib.blake2b(basic_token.encode('utf8'), digest_size=16).digest()
+
+
+def new_token(vehicle_number, vehicle_mark):
     expires_at = int(time.mktime((datetime.now() + timedelta(minutes=15)).timetuple()))
-    authorization = AuthorizationModel(access_token="Basic " + token, expires_at=expires_at)
-    db.session.merge(authorization)
-    db.session.commit()
+    return token_signer.sign({"n": vehicle_number, "m": vehicle_mark, "e": expires_at}), expires_at
+
+
+def bare_token(basic_token):
+    return basic_token[len("Basic "):] if basic_token.startswith("Basic ") else basic_token
+
+
+@service.route("/get_token/<string:vehicle_number>/<string:vehicle_mark>")
+def get_token(vehicle_number, vehicle_mark):
+    token, expires_at = new_token(vehicle_number, vehicle_mark)
     return {"access_token": token, "expires_at": expires_at}
 
 
+def refresh_revocations(now):
+    interval = current_app.config['TOKEN_REVOCATION_CHECK']
+    if interval is None or not revocations.due(interval, time.monotonic()):
+        return
+    revocations.load(live_revocations(db.session, now), now)
+
+
+def live_revocations(connection, now):
+    return connection.execute(select(RevokedTokenModel.token_id, RevokedTokenModel.expires_at)
+                              .where(RevokedTokenModel.expires_at >= now)).all()
+
+
+def store_revocation(connection, basic_token):
+    # Signed tokens are listed until they expire, older ones are deleted.
+    token = bare_token(basic_token)
+    if is_signed(token):
+        expires_at = token_signer.verify(token)["e"]
+        if not connection.execute(update(RevokedTokenModel).where(RevokedTokenModel.token_id == token_id(token))
+                                  .values(expires_at=expires_at)
+                                  .execution_options(synchronize_session=False)).rowcount:
+            connection.execute(insert(RevokedTokenModel).values(token_id=token_id(token), expires_at=expires_at))
+    else:
+        connection.execute(delete(AuthorizationModel).where(AuthorizationModel.access_token == token_digest(basic_token)))
+
+
+def forget_token(basic_token):
+    # After the revocation is committed.
+    token = bare_token(basic_token)
+    if is_signed(token):
+        revocations.add(token_id(token), token_signer.verify(token)["e"])
+    else:
+        token_cache.invalidate(basic_token)
+
+
+def check_signed_token(token, now):
+    claims = token_signer.verify(token)
+    if claims is None:
+        return not_authorized, False
+    if claims["e"] < now:
+        return token_expired, False
+    if token_id(token) in revocations:
+        return token_revoked, False
+    return {}, True
+
+
+def caches_legacy_tokens(config):
+    # A revoked token is deleted from the table, but only the revoking worker
+    # drops it from its cache; with several workers every check reads the row.
+    return config['SHARED_STATE_CHECK_INTERVAL'] is None
+
+
 def is_authorized(headers):
     if 'Authorization' not in headers:
-        return {message: "You are not authorized"}, False
+        return not_authorized, False
     basic_token = headers['Authorization']
-    access_token = AuthorizationModel.query.filter_by(access_token=basic_token).first()
+    now = int(time.time())
+    if is_signed(bare_token(basic_token)):
+        refresh_revocations(now)
+        return check_signed_token(bare_token(basic_token), now)
+    # Tokens issued before signing was introduced stay valid until they
+    # expire; upgrade_schema stores the ones of older databases as digests.
+    if token_cache.get(basic_token, now) is not None:
+        return {}, True
+    access_token = AuthorizationModel.query.filter_by(access_token=token_digest(basic_token)).first()
     if access_token is None:
-        return {message: "You are not authorized"}, False
-    if access_token.get_expires_at() < int(time.mktime(datetime.now().timetuple())):
-        return {message: "You are not authorized, token expired"}, False
+        return not_authorized, False
+    if access_token.get_expires_at() < now:
+        return token_expired, False
+    if caches_legacy_tokens(current_app.config):
+        token_cache.put(basic_token, access_token.get_expires_at(), now)
     return {}, True
 
 
+def reap_expired_tokens(batch_size=None):
+    batch_size = batch_size or current_app.config['TOKEN_REAPER_BATCH']
+    now = int(time.time())
+    reaped = 0
+    while True:
+        expired = select(AuthorizationModel.access_token).where(AuthorizationModel.expires_at < now).limit(batch_size)
+        deleted = db.session.execute(delete(AuthorizationModel).where(AuthorizationModel.access_token.in_(expired))).rowcount
+        db.session.commit()
+        reaped += deleted
+        if deleted < batch_size:
+            return reaped
+
+
+def reap_expired_revocations():
+    reaped = db.session.execute(delete(RevokedTokenModel).where(RevokedTokenModel.expires_at < int(time.time()))).rowcount
+    db.session.commit()
+    return reaped
+
+
+def start_token_reaper(app):
+    def run():
+        while True:
+            time.sleep(app.config['TOKEN_REAPER_INTERVAL'])
+            with app.app_context():
+                reap_expired_tokens()
+                reap_expired_revocations()
+    reaper = threading.Thread(target=run, name="token-reaper", daemon=True)
+    reaper.start()
+    return reaper
+
+
 def auth(function):
     def decorator(*args,**kwargs):
+        started = time.perf_counter()
         error, ok = is_authorized(request.headers)
+        auth_duration.observe(function.__name__, time.perf_counter() - started)
         if not ok:
             return error
         return function(*args,**kwargs)
     decorator.__name__ = function.__name__
     return decorator
 
+
+def cache_headers(etag, max_age):
+    # Browsers revalidate every time; a reverse proxy may answer from its
+    # copy for max_age seconds, kept apart per token by Vary.
+    return {"ETag": quote_etag(etag), "Vary": "Authorization", "Cache-Control": f"max-age=0, s-maxage={max_age}"}
+
+
+def lot_etag(lot_id, version, occupancy):
+    # Holds run out without a new version; the last expiry that passed tells
+    # apart responses from before and after it.
+    if occupancy.expired_through is None:
+        return f"{lot_id}-{version}"
+    return f"{lot_id}-{version}-{occupancy.expired_through}"
+
+
+def conditional(function):
+    # Reads are tagged with the lot's occupancy version, taken before the
+    # response is built; a client or proxy holding the current tag gets a
+    # 304 without the spot table being queried.
+    def decorator(*args, **kwargs):
+        state = refresh_shared_state()
+        version = state.version.current()
+        if version is None or not state.occupancy.loaded:
+            return function(*args, **kwargs)
+        expire_holds(state)
+        etag = lot_etag(current_lot(), version, state.occupancy)
+        headers = cache_headers(etag, current_app.config['READ_CACHE_MAX_AGE'])
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers=headers)
+
+        @after_this_request
+        def tag(response):
+            if response.status_code == 200:
+                response.headers.update(headers)
+            return response
+        return function(*args, **kwargs)
+    decorator.__name__ = function.__name__
+    return decorator
+
 #End-points for parking lot activities
 
-@app.route("/free_spots")
+@bp.route("/free_spots")
 @auth
+@conditional
 def free_spots():
-    result = CarParkingModel.query.filter_by(parking_available=True).all()
-    free = len(result)
-    return {"free": free}
+    return {"free": get_occupancy().free_count()}
 
 
-@app.route("/next_free_spot")
+@bp.route("/next_free_spot")
 @auth
+@conditional
 def next_free_spot():
-    result = CarParkingModel.query.filter_by(parking_available=True).first()
-    if result is None:
-        return {message: "There are no free spots in a parking lot."}
-    return {"closest spot": result.get_spot()}
+    policy = request.args.get("policy", current_app.config['ALLOCATION_POLICY'])
+    if policy not in allocation_policies:
+        return {message: f"Unknown allocation policy {policy}, use one of {', '.join(allocation_policies)}."}
+    spot_type = request.args.get("type")
+    occupancy = get_occupancy()
+    if spot_type is not None and not occupancy.has_type(spot_type):
+        return {message: f"No spot in this lot has type {spot_type}."}
+    spot = occupancy.next_free(policy, spot_type)
+    if spot is None:
+        return no_free_spots
+    return {"closest spot": spot}
 
 
-@app.route("/get_parking_spot/<string:vehicle_number>")
+@bp.route("/get_parking_spot/<string:vehicle_number>")
 @auth
+@conditional
 def get_parking_spot(vehicle_number):
-    search_number = CarParkingModel.query.filter_by(vehicle_number=vehicle_number).first()
-    if search_number is None:
-        return {message: "There is no car with this vehicle number in a parking lot."}
-    return {vehicle_number: search_number.get_spot()}
+    if current_app.config['VEHICLE_INDEX']:
+        spot = get_vehicle_index().spot_of(vehicle_number)
+        if spot is None:
+            return no_such_car
+        return {vehicle_number: spot}
+    spot = find_car(db.session, current_lot(), vehicle_number)
+    if spot is None:
+        return no_such_car
+    return {vehicle_number: spot}
+
 
+def stream_parked_cars():
+    statement = parked_cars(current_lot()).execution_options(yield_per=current_app.config['STREAM_CHUNK_SIZE'])
+    dumps = current_app.json.encoder
 
-@app.route("/get_all")
+    def generate():
+        for spot, number in db.session.execute(statement):
+            yield parked_car_line(spot, number, dumps)
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+@bp.route("/get_all")
 @auth
+@conditional
 def get_all():
-    empty_dict = {}
-    results = CarParkingModel.query.filter_by(parking_available=False).all()
-    if len(results) == 0:
-        return {message: "There are no cars parked in this parking lot."}
-    for result in results:
-        empty_dict[result.get_spot()] = result.get_number()
-    return empty_dict
+    error = not_whole_number(request.args, "after", "limit")
+    if error:
+        return error
+    if request.args.get("format") == "ndjson":
+        return stream_parked_cars()
+    if request.args.get("format") == "columnar":
+        return parked_cars_columns(db.session, current_lot())
+    if "after" in request.args or "limit" in request.args:
+        return parked_cars_page(db.session, current_lot(), request.args.get("after", 0, type=int),
+                                clamp_page_size(request.args.get("limit", current_app.config['PAGE_SIZE'], type=int),
+                                                current_app.config))
+    return all_parked_cars(db.session, current_lot())
 
 
-@app.route("/parking/<int:spot_number>", methods=["PUT"])
+@bp.route("/parking/<int:spot_number>", methods=["PUT"])
 @auth
 def parking(spot_number):
-    spot = CarParkingModel.query.filter_by(parking_spot=spot_number).first()
-    if not spot.get_available():
-        return {message: "This spot is not available!"}
     body = request.get_json()
-    spot.set_mark(body["vehicle_mark"])
-    spot.set_number(body["vehicle_number"])
-    spot.set_available(False)
-    db.session.merge(spot)
-    db.session.commit()
-    return {"parking spot": spot_number}
+    try:
+        return write_spots(
+            lambda: park_car(db.session, current_lot(), spot_number, body["vehicle_number"], body["vehicle_mark"]))
+    except IntegrityError:
+        db.session.rollback()
+        return already_parked(body["vehicle_number"])
 
 
-@app.route("/leave/<int:spot_number>", methods=["PATCH"])
+@bp.route("/leave/<int:spot_number>", methods=["PATCH"])
 @auth
 def leave(spot_number):
-    spot = CarParkingModel.query.filter_by(parking_spot=spot_number).first()
-    if spot.get_available() is True:
-        return {message: "There is no car parked in this spot."}
-    spot.set_available(True)
-    spot.set_number(None)
-    spot.set_mark(None)
-    db.session.merge(spot)
-    db.session.commit()
-    return {"message": f"spot {spot_number} is available"}
+    return write_spots(lambda: leave_spot(db.session, current_lot(), spot_number))
 
 
-@app.route("/change_to/<int:new_spot>", methods=["PUT"])
+@bp.route("/reserve/<int:spot_number>", methods=["PUT"])
+@auth
+def reserve(spot_number):
+    body = request.get_json()
+    error = not_whole_number(body, "ttl")
+    if error:
+        return error
+    ttl = int(body.get("ttl", current_app.config['RESERVATION_TTL']))
+    if not 0 < ttl <= current_app.config['MAX_RESERVATION_TTL']:
+        return {message: f"A reservation lasts 1 to {current_app.config['MAX_RESERVATION_TTL']} seconds."}
+    now = int(time.time())
+    return write_spots(lambda: hold_spot(db.session, current_lot(), spot_number, body["vehicle_number"], now + ttl, now))
+
+
+@bp.route("/cancel_reservation/<int:spot_number>", methods=["PATCH"])
+@auth
+def cancel_reservation(spot_number):
+    return write_spots(lambda: release_hold(db.session, current_lot(), spot_number, int(time.time())))
+
+
+@bp.route("/parking_batch", methods=["PUT"])
+@auth
+def parking_batch():
+    body = request.get_json()
+    error = batch_too_large(body, current_app.config)
+    if error:
+        return error
+    try:
+        return write_spots(lambda: park_cars(db.session, current_lot(), body))
+    except IntegrityError:
+        db.session.rollback()
+        return batch_conflict
+
+
+@bp.route("/leave_batch", methods=["PATCH"])
+@auth
+def leave_batch():
+    body = request.get_json()
+    error = batch_too_large(body, current_app.config)
+    if error:
+        return error
+    return write_spots(lambda: leave_spots(db.session, current_lot(), body))
+
+
+@bp.route("/change_to/<int:new_spot>", methods=["PUT"])
 @auth
 def change_spot(new_spot):
     body = request.get_json()
-    vehicle_number = body['vehicle_number']
-    spot = get_parking_spot(vehicle_number)
-    if vehicle_number not in spot:
-        return {message: f"Car {vehicle_number} not parked."}
-    spot_nr = spot[vehicle_number]
-    with app.test_request_context(
-        headers={"Authorization": request.headers["Authorization"]},
-        json=body
-    ):
-        reparking = parking(new_spot)
-    if "parking spot" not in reparking:
-        return reparking
-    with app.test_request_context(headers={"Authorization": request.headers["Authorization"]}):
-        leave(spot_nr)
-    return {"message": f"{vehicle_number} parked to {new_spot}"}
+    return write_spots(
+        lambda: move_car(db.session, current_lot(), body['vehicle_number'], body['vehicle_mark'], new_spot))
+
+
+def shared_state_poller(app, lot_id):
+    # Run by the feed thread: picks up spots changed by other worker
+    # processes, one version query per lot however many subscribers there are.
+    def poll():
+        with app.app_context():
+            g.lot_id = lot_id
+            state = lots[lot_id]
+            before = state.occupancy.copy()
+            get_occupancy()
+            for spot_number, free in state.occupancy.changes(before):
+                state.feed.publish(spot_number, free)
+    return poll
+
+
+@bp.route("/occupancy_feed")
+@auth
+def occupancy_feed():
+    lot_id = current_lot()
+    get_occupancy()
+    feed = lots[lot_id].feed
+    interval = current_app.config['SHARED_STATE_CHECK_INTERVAL']
+    if interval is None:
+        feed.start(current_app.config['FEED_COALESCE'])
+    else:
+        feed.start(current_app.config['FEED_COALESCE'], max(interval, current_app.config['FEED_COALESCE']),
+                   shared_state_poller(current_app._get_current_object(), lot_id))
+    # Every open stream holds a worker thread here, so only FEED_STREAMS of
+    # them are kept open per process; the async server has no such limit.
+    state = parking_state()
+    if not state.feed_streams.acquire(blocking=False):
+        return {message: f"This server keeps at most {state.feed_limit} live feeds open, "
+                         f"use the async server (uvicorn asgi:app) for more."}, 503
+    last_seq = request.headers.get("Last-Event-ID", type=int)
+    response = Response(feed.stream(last_seq, current_app.config['FEED_HEARTBEAT']), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    response.call_on_close(state.feed_streams.release)
+    return response
+
+
+@bp.route("/levels")
+@auth
+def levels():
+    return level_counts(db.session, current_lot())
+
+
+def report_window(params, now, window):
+    # Whole hours from the from timestamp up to the to timestamp (seconds
+    # since the epoch); without them the last window seconds.
+    end = int(params.get("to", now))
+    start = int(params.get("from", end - window))
+    return hour_of(start), hour_of(end + hour - 1)
+
+
+def report_bucket(params):
+    return max(hour_of(int(params.get("bucket", hour))), hour)
+
+
+def not_whole_number(params, *names):
+    # The message for the first of names given in the query string (or a
+    # JSON body) that is not a whole number, so ?from=yesterday or a "ttl" of
+    # "soon" is answered instead of failing.
+    for name in names:
+        if name not in params:
+            continue
+        value = params[name]
+        try:
+            if isinstance(value, bool) or isinstance(value, float) and not value.is_integer():
+                raise ValueError(value)
+            int(value)
+        except (TypeError, ValueError):
+            return {message: f"{name} must be a whole number."}
+    return None
+
+
+def too_many_buckets(start, end, bucket, limit):
+    if (end - start) // bucket > limit:
+        return {message: f"Reports are limited to {limit} buckets."}
+    return None
+
+
+def occupied_before(lot_id, start):
+    rollup = OccupancyRollupModel
+    return select(func.coalesce(func.sum(rollup.arrivals - rollup.departures), 0)) \
+        .where(rollup.lot_id == lot_id, rollup.hour < start)
+
+
+def rollup_rows(lot_id, start, end):
+    rollup = OccupancyRollupModel
+    return select(rollup.hour, rollup.arrivals, rollup.departures) \
+        .where(rollup.lot_id == lot_id, rollup.hour >= start, rollup.hour < end).order_by(rollup.hour)
+
+
+def dwell_totals(lot_id, start, end):
+    rollup = OccupancyRollupModel
+    return select(func.coalesce(func.sum(rollup.departures), 0), func.coalesce(func.sum(rollup.dwell_seconds), 0)) \
+        .where(rollup.lot_id == lot_id, rollup.hour >= start, rollup.hour < end)
+
+
+def dwell_report(connection, lot_id, start, end):
+    sessions, seconds = connection.execute(dwell_totals(lot_id, start, end)).one()
+    return {"from": start, "to": end, "sessions": sessions,
+            "average dwell seconds": round(seconds / sessions) if sessions else None}
+
+
+def vehicle_sessions(connection, lot_id, vehicle_number, limit):
+    session = ParkingSessionModel
+    rows = connection.execute(select(session.parking_spot, session.vehicle_mark, session.entered_at, session.left_at)
+                              .where(session.lot_id == lot_id, session.vehicle_number == vehicle_number)
+                              .order_by(session.entered_at.desc()).limit(limit)).all()
+    return [{"spot": spot, "vehicle_mark": mark, "entered_at": entered_at, "left_at": left_at}
+            for spot, mark, entered_at, left_at in rows]
+
+
+def occupancy_report(connection, lot_id, start, end, bucket):
+    occupied = connection.execute(occupied_before(lot_id, start)).scalar()
+    return occupancy_buckets(occupied, connection.execute(rollup_rows(lot_id, start, end)).all(), start, end, bucket)
+
+
+@bp.route("/occupancy_history")
+@auth
+def occupancy_history():
+    error = not_whole_number(request.args, "from", "to", "bucket")
+    if error:
+        return error
+    start, end = report_window(request.args, int(time.time()), current_app.config['REPORT_WINDOW'])
+    bucket = report_bucket(request.args)
+    error = too_many_buckets(start, end, bucket, current_app.config['MAX_REPORT_BUCKETS'])
+    if error:
+        return error
+    return {"bucket": bucket, "buckets": occupancy_report(db.session, current_lot(), start, end, bucket)}
+
+
+@bp.route("/dwell_time")
+@auth
+def dwell_time():
+    error = not_whole_number(request.args, "from", "to")
+    if error:
+        return error
+    start, end = report_window(request.args, int(time.time()), current_app.config['REPORT_WINDOW'])
+    return dwell_report(db.session, current_lot(), start, end)
+
+
+@bp.route("/peak_hours")
+@auth
+def busiest_hours():
+    error = not_whole_number(request.args, "from", "to", "top")
+    if error:
+        return error
+    start, end = report_window(request.args, int(time.time()), current_app.config['REPORT_WINDOW'])
+    error = too_many_buckets(start, end, hour, current_app.config['MAX_REPORT_BUCKETS'])
+    if error:
+        return error
+    return {"peak hours": peak_hours(occupancy_report(db.session, current_lot(), start, end, hour),
+                                     request.args.get("top", 3, type=int))}
+
+
+@bp.route("/sessions/<string:vehicle_number>")
+@auth
+def sessions_of(vehicle_number):
+    error = not_whole_number(request.args, "limit")
+    if error:
+        return error
+    page_size = clamp_page_size(request.args.get("limit", current_app.config['PAGE_SIZE'], type=int), current_app.config)
+    return {"sessions": vehicle_sessions(db.session, current_lot(), vehicle_number, page_size)}
+
+
+@bp.route("/occupancy_check")
+@auth
+def occupancy_check():
+    mismatched = get_occupancy().mismatches(spot_rows())
+    return {"consistent": len(mismatched) == 0, "mismatched": mismatched}
+
+@service.route("/metrics")
+def metrics():
+    return Response(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+@service.route("/token_cache_stats")
+@auth
+def token_cache_stats():
+    return token_cache.stats()
+
+@service.route("/revoke_token", methods=["POST"])
+@auth
+def revoke_token():
+    store_revocation(db.session, request.headers['Authorization'])
+    db.session.commit()
+    forget_token(request.headers['Authorization'])
+    return revoke_confirmation
+
+@service.route("/lots")
+@auth
+def list_lots():
+    return lot_list(db.session)
+
+def provision_lot(size, name=None, spots_per_level=None):
+    started = time.perf_counter()
+    lot_id = current_lot()
+    lot = ensure_lot(name, spots_per_level)
+    current = db.session.query(func.max(CarParkingModel.parking_spot)).filter_by(lot_id=lot_id).scalar() or 0
+    added = 0
+    removed = 0
+    if size > current:
+        db.session.execute(insert(CarParkingModel), [
+            {"lot_id": lot_id, "parking_spot": spot, "level": lot.get_level(spot), "parking_available": True}
+            for spot in range(current + 1, size + 1)
+        ])
+        added = size - current
+    elif size < current:
+        occupied = CarParkingModel.query.filter_by(lot_id=lot_id, parking_available=False) \
+            .filter(CarParkingModel.parking_spot > size).count()
+        if occupied:
+            db.session.rollback()
+            return {message: f"Cannot remove spots above {size}, {occupied} of them are occupied."}
+        removed = CarParkingModel.query.filter_by(lot_id=lot_id) \
+            .filter(CarParkingModel.parking_spot > size).delete(synchronize_session=False)
+    commit_spot_changes([size_event(size, lot.spots_per_level)])
+    load_lot(db.session, lot_id)
+    lots[lot_id].vehicles.loaded = False
+    return {"spots": size, "added": added, "removed": removed, "seconds": round(time.perf_counter() - started, 3)}
+
+
+def set_layout(first, last, spot_type=None, distance=None, step=0):
+    # Spot types and distances to the entrance of spots first..last; the
+    # distance grows by step per spot. None leaves that attribute as it is.
+    values = {}
+    if spot_type is not None:
+        values["spot_type"] = spot_type
+    if distance is not None:
+        values["distance"] = distance + (CarParkingModel.parking_spot - first) * step
+    changed = CarParkingModel.query.filter_by(lot_id=current_lot()) \
+        .filter(CarParkingModel.parking_spot.between(first, last)) \
+        .update(values, synchronize_session=False) if values else 0
+    commit_spot_changes([layout_event(first, last, spot_type, distance, step)])
+    load_lot(db.session, current_lot())
+    return {"spots": changed}
+
+
+def database_snapshot():
+    snapshots = {}
+    for lot in LotModel.query.order_by(LotModel.lot_id).all():
+        g.lot_id = lot.lot_id
+        snapshot = snapshots[lot.lot_id] = LotSnapshot(
+            stored_version() or 0,
+            lot.spots_per_level)
+        for spot in CarParkingModel.query.filter_by(lot_id=lot.lot_id).order_by(CarParkingModel.parking_spot):
+            snapshot.levels.append(spot.get_level())
+            if spot.get_type() != standard or spot.get_distance() is not None:
+                snapshot.layout[spot.get_spot()] = (spot.get_type(), spot.get_distance())
+            if spot.get_reserved_until() is not None:
+                snapshot.holds[spot.get_spot()] = (spot.get_reserved_for(), spot.get_reserved_until())
+            if not spot.get_available():
+                snapshot.cars[spot.get_spot()] = (spot.get_number(), spot.get_mark())
+        db.session.commit()
+    g.lot_id = default_lot
+    return snapshots
+
+
+def committed_version(lot_id):
+    g.lot_id = lot_id
+    version = lot_version(db.session, lot_id)
+    g.lot_id = default_lot
+    return version
+
+
+def rebuild_from_snapshot(snapshots):
+    # Replaces each lot's spot rows with the snapshot. The version never goes
+    # back, so records appended later cannot reuse a version in the journal,
+    # and it always moves on, so every worker reloads the replaced rows and
+    # the ETags of the old ones stop matching.
+    for lot_id, snapshot in sorted(snapshots.items()):
+        g.lot_id = lot_id
+        ensure_lot(spots_per_level=snapshot.spots_per_level)
+        db.session.flush()
+        CarParkingModel.query.filter_by(lot_id=lot_id).delete(synchronize_session=False)
+        rows = [dict(row, lot_id=lot_id) for row in snapshot.rows()]
+        if rows:
+            db.session.execute(insert(CarParkingModel), rows)
+        db.session.execute(update(StateVersionModel).where(StateVersionModel.lot_id == lot_id)
+                           .values(version=case((StateVersionModel.version < snapshot.version, snapshot.version),
+                                                 else_=StateVersionModel.version) + 1)
+                           .execution_options(synchronize_session=False))
+        reconcile_sessions()
+        db.session.commit()
+        lots[lot_id].reset()
+    g.lot_id = default_lot
+
+
+def echo_report(report):
+    click.echo(json.dumps(report))
+
+
+@click.command("checkpoint")
+@click.option("--from-database", is_flag=True, help="Take the snapshot from the tables instead of the journal.")
+@with_appcontext
+def checkpoint_command(from_database):
+    started = time.perf_counter()
+    if from_database:
+        snapshots, applied, offset, torn = database_snapshot(), 0, 0, []
+    else:
+        snapshots, applied, offset, torn = replay(current_app.config['JOURNAL_PATH'],
+                                                  current_app.config['JOURNAL_CHECKPOINT_PATH'], settle=False)
+    # The journal read so far moves to a segment the checkpoint starts from,
+    # and the segments before it are no longer needed.
+    segment = rotate(current_app.config['JOURNAL_PATH'])
+    write_checkpoint(current_app.config['JOURNAL_CHECKPOINT_PATH'], snapshots, offset, segment)
+    remove_segments(current_app.config['JOURNAL_PATH'], segment)
+    echo_report({"lots": len(snapshots), "events": applied, "torn records at": torn,
+                 "seconds": round(time.perf_counter() - started, 3)})
+
+
+@click.command("rebuild")
+@with_appcontext
+def rebuild_command():
+    started = time.perf_counter()
+    upgrade_schema()
+    snapshots, applied, offset, torn = replay(current_app.config['JOURNAL_PATH'],
+                                              current_app.config['JOURNAL_CHECKPOINT_PATH'],
+                                              committed=committed_version)
+    rebuild_from_snapshot(snapshots)
+    echo_report({"lots": len(snapshots), "events": applied, "torn records at": torn,
+                 "seconds": round(time.perf_counter() - started, 3)})
+
+
+@click.command("provision")
+@click.argument("size", type=int)
+@click.option("--lot", "lot_id", type=int, default=default_lot, help="Lot to create or resize.")
+@click.option("--name", help="Name of the lot.")
+@click.option("--spots-per-level", type=int, help="Spots on each level, new spots fill the levels in order.")
+@with_appcontext
+def provision_command(size, lot_id, name, spots_per_level):
+    upgrade_schema()
+    g.lot_id = lot_id
+    echo_report(provision_lot(size, name, spots_per_level))
+
+
+@click.command("layout")
+@click.argument("first", type=int)
+@click.argument("last", type=int)
+@click.option("--lot", "lot_id", type=int, default=default_lot, help="Lot of the spots.")
+@click.option("--type", "spot_type", help="Spot type, e.g. standard, ev, disabled or compact.")
+@click.option("--distance", type=int, help="Distance of the first spot to the entrance.")
+@click.option("--step", type=int, default=0, help="Distance added for every following spot.")
+@with_appcontext
+def layout_command(first, last, lot_id, spot_type, distance, step):
+    upgrade_schema()
+    g.lot_id = lot_id
+    echo_report(set_layout(first, last, spot_type, distance, step))
+
+
+@click.command("migrate")
+@with_appcontext
+def migrate_command():
+    upgrade_schema()
+    click.echo("Schema is up to date.")
+
+
+def lot_databases():
+    # PARKING_LOT_DATABASES="2=sqlite:///lot-2.db,3=sqlite:///lot-3.db" keeps
+    # those lots in their own databases, the others stay in the default one.
+    binds = {}
+    for entry in os.environ.get('PARKING_LOT_DATABASES', '').split(','):
+        if entry.strip():
+            lot_id, uri = entry.split('=', 1)
+            binds[lot_bind_key(int(lot_id))] = {"url": uri.strip(), **storage.engine_options(uri.strip())}
+    return binds
+
+
+def shared_state_interval():
+    value = os.environ.get('PARKING_SHARED_STATE_CHECK', '')
+    return float(value) if value else None
+
+
+def group_commit_window():
+    # PARKING_GROUP_COMMIT=0.002 lets the writer thread of a lot wait up to
+    # 2 ms for more parks and leaves to commit with; 0 commits whatever is
+    # queued at once, unset commits every request on its own.
+    value = os.environ.get('PARKING_GROUP_COMMIT', '')
+    return float(value) if value else None
+
+
+def instance_secret_key(instance_path):
+    # Without PARKING_SECRET_KEY the key is generated once in the instance
+    # folder, so every worker process signs and checks tokens with the same one.
+    path = os.path.join(instance_path, 'secret_key')
+    if not os.path.exists(path):
+        os.makedirs(instance_path, exist_ok=True)
+        temporary = f"{path}.{os.getpid()}"
+        with os.fdopen(os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as key_file:
+            key_file.write(os.urandom(32).hex())
+        try:
+            os.link(temporary, path)
+        except FileExistsError:
+            pass
+        os.remove(temporary)
+    with open(path) as key_file:
+        return key_file.read().strip()
+
+
+def create_app(config=None):
+    app = ParkingApp(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('PARKING_DATABASE_URI', 'sqlite:///database.db')
+    app.config['SQLALCHEMY_BINDS'] = lot_databases()
+    app.config['STORAGE_PROFILE'] = os.environ.get('PARKING_STORAGE_PROFILE', 'wal')
+    app.config['SHARED_STATE_CHECK_INTERVAL'] = shared_state_interval()
+    app.config['JOURNAL_PATH'] = os.environ.get('PARKING_JOURNAL', os.path.join(app.instance_path, 'journal.ndjson'))
+    app.config['JOURNAL_SYNC_INTERVAL'] = float(os.environ.get('PARKING_JOURNAL_SYNC', 0.1))
+    app.config['TOKEN_CACHE_SIZE'] = 10000
+    app.config['TOKEN_REAPER_INTERVAL'] = 60
+    app.config['TOKEN_REAPER_BATCH'] = 1000
+    app.config['TOKEN_REVOCATION_CHECK'] = 5
+    app.config['MAX_BATCH_SIZE'] = 500
+    app.config['VEHICLE_INDEX'] = False
+    app.config['PAGE_SIZE'] = 100
+    app.config['MAX_PAGE_SIZE'] = 1000
+    app.config['STREAM_CHUNK_SIZE'] = 1000
+    app.config['FEED_COALESCE'] = 0.05
+    app.config['FEED_HEARTBEAT'] = 15
+    app.config['FEED_STREAMS'] = int(os.environ.get('PARKING_FEED_STREAMS', 2))
+    app.config['ALLOCATION_POLICY'] = os.environ.get('PARKING_ALLOCATION_POLICY', 'lowest')
+    app.config['READ_CACHE_MAX_AGE'] = int(os.environ.get('PARKING_READ_CACHE_MAX_AGE', 1))
+    app.config['REPORT_WINDOW'] = 7 * 24 * 3600
+    app.config['RESERVATION_TTL'] = int(os.environ.get('PARKING_RESERVATION_TTL', 900))
+    app.config['MAX_RESERVATION_TTL'] = 4 * 3600
+    app.config['GROUP_COMMIT_WINDOW'] = group_commit_window()
+    app.config['GROUP_COMMIT_SIZE'] = int(os.environ.get('PARKING_GROUP_COMMIT_SIZE', 64))
+    app.config['MAX_REPORT_BUCKETS'] = 366 * 24
+    app.config['JSON_BACKEND'] = os.environ.get('PARKING_JSON_BACKEND', default_backend())
+    app.config.update(config or {})
+    app.config.setdefault('JOURNAL_CHECKPOINT_PATH', app.config['JOURNAL_PATH'] and app.config['JOURNAL_PATH'] + '.checkpoint')
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', storage.engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
+    if not app.config.get('SECRET_KEY'):
+        app.config['SECRET_KEY'] = os.environ.get('PARKING_SECRET_KEY') or instance_secret_key(app.instance_path)
+    app.json = CompactJSONProvider(app, app.config['JSON_BACKEND'])
+    db.init_app(app)
+    app.defer_blueprint(service)
+    app.defer_blueprint(bp)
+    app.defer_blueprint(bp, name="lot", url_prefix="/lots/<int:lot_id>")
+    app.cli.add_command(provision_command)
+    app.cli.add_command(migrate_command)
+    app.cli.add_command(layout_command)
+    app.cli.add_command(checkpoint_command)
+    app.cli.add_command(rebuild_command)
+    app.extensions["parking"] = ParkingState(app.config)
+    with app.app_context():
+        for engine in db.engines.values():
+            storage.install_pragmas(engine, storage.sqlite_pragmas(app.config['STORAGE_PROFILE']))
+            event.listen(engine, "before_cursor_execute", sql_started)
+            event.listen(engine, "after_cursor_execute", sql_finished)
+    return app
+
+
+def after_fork(app):
+    # Connections inherited from the parent process must not be reused, and
+    # the in-process maps are reloaded on first use in the worker.
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    app.extensions["parking"].after_fork()
+
+
+app_lock = threading.Lock()
+
+
+def __getattr__(name):
+    # main.app is built on first use, so importing main for its functions
+    # (tests, benchmarks, CLI jobs) does not set up an application.
+    global app
+    if name != "app":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with app_lock:
+        if "app" not in globals():
+            app = create_app()
+    return app
+
 
 limit = 10
 if __name__ == "__main__":
-    db.drop_all()
-    db.create_all()
-    for i in range(limit):
-        db.session.add(CarParkingModel(parking_available=True))
-        db.session.commit()
+    app = create_app()
+    with app.app_context():
+        db.drop_all()
+        for path in (app.config['JOURNAL_PATH'], app.config['JOURNAL_CHECKPOINT_PATH']):
+            if path and os.path.exists(path):
+                os.remove(path)
+        if app.config['JOURNAL_PATH']:
+            remove_segments(app.config['JOURNAL_PATH'])
+        upgrade_schema()
+        echo_report(provision_lot(limit))
+    start_token_reaper(app)
     app.run(debug=True)
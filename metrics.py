@@ -0,0 +1,66 @@
+from bisect import bisect_left
+import threading
+
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+count_buckets = (0, 1, 2, 3, 4, 6, 8, 12, 16, 32)
+
+
+class Histogram:
+    # Per-label bucket counts; observe() is a bisect and three increments under
+    # a lock, so it can stay on for every request.
+    def __init__(self, name, help, buckets, label="endpoint"):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.label = label
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            snapshot = [(label_value, list(counts), total, count) for label_value, (counts, total, count) in self.series.items()]
+        for label_value, counts, total, count in sorted(snapshot):
+            labels = f'{self.label}="{label_value}"'
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter", f"{self.name} {self.read()}"]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,358 @@
+import heapq
+import threading
+import time
+
+from allocation import LevelIndex, OrderedIndex, standard
+from feed import OccupancyFeed
+from group_commit import GroupCommit
+
+FREE = 1
+TAKEN = 0
+
+
+class Occupancy:
+    # One byte per spot, indexed by spot number (index 0 is never a spot).
+    # Every allocation policy, the lowest free spot included, uses an index
+    # built on first use and kept up to date under the same lock as the
+    # slots, so picking a spot stays O(log n) on a nearly full lot.
+    # A reserved spot is taken until its hold runs out; holds wait in a heap
+    # by expiry, so expire() only looks at the ones that are due.
+    def __init__(self):
+        self.slots = bytearray()
+        self.free = 0
+        self.levels = []
+        self.distances = []
+        self.types = {}
+        self.type_names = set()
+        self.indexes = {}
+        self.holds = {}
+        self.expiries = []
+        self.expired_through = None
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def load(self, rows, now=None):
+        # rows are (spot, available) or (spot, available, level, spot_type, distance[, reserved_until])
+        now = time.time() if now is None else now
+        slots = bytearray()
+        levels = []
+        distances = []
+        types = {}
+        holds = {}
+        expired_through = None
+        free = 0
+        for spot, available, *layout in rows:
+            if spot >= len(slots):
+                slots.extend(bytes(spot + 1 - len(slots)))
+                levels.extend([1] * (spot + 1 - len(levels)))
+                distances.extend([None] * (spot + 1 - len(distances)))
+            held_until = layout[3] if len(layout) > 3 else None
+            if held_until is not None and held_until <= now:
+                expired_through = max(expired_through or held_until, held_until)
+            elif held_until is not None and available:
+                holds[spot] = held_until
+                available = False
+            if available:
+                slots[spot] = FREE
+                free += 1
+            if layout:
+                levels[spot], spot_type, distances[spot] = layout[:3]
+                if spot_type != standard:
+                    types[spot] = spot_type
+        expiries = [(until, spot) for spot, until in holds.items()]
+        heapq.heapify(expiries)
+        with self.lock:
+            self.slots = slots
+            self.free = free
+            self.levels = levels
+            self.distances = distances
+            self.types = types
+            self.type_names = set(types.values())
+            self.indexes = {}
+            self.holds = holds
+            self.expiries = expiries
+            self.expired_through = expired_through
+            self.loaded = True
+
+    def _set(self, spot, state, held_until=None):
+        with self.lock:
+            self._update(spot, state, held_until)
+
+    def _update(self, spot, state, held_until=None):
+        if spot >= len(self.slots):
+            self.slots.extend(bytes(spot + 1 - len(self.slots)))
+            self.levels.extend([1] * (spot + 1 - len(self.levels)))
+            self.distances.extend([None] * (spot + 1 - len(self.distances)))
+            self.indexes = {}
+        if held_until is None:
+            self.holds.pop(spot, None)
+        else:
+            self.holds[spot] = held_until
+            heapq.heappush(self.expiries, (held_until, spot))
+        if self.slots[spot] != state:
+            self.slots[spot] = state
+            self.free += 1 if state == FREE else -1
+            for (policy, spot_type), index in self.indexes.items():
+                if spot_type is None or self.types.get(spot, standard) == spot_type:
+                    if state == FREE:
+                        index.released(spot)
+                    else:
+                        index.taken(spot)
+
+    def take(self, spot):
+        self._set(spot, TAKEN)
+
+    def release(self, spot):
+        self._set(spot, FREE)
+
+    def hold(self, spot, until):
+        self._set(spot, TAKEN, until)
+
+    def expire(self, now):
+        # Frees the spots whose holds ran out by now and returns them. Entries
+        # of holds that were parked on, cancelled or extended are skipped.
+        expiries = self.expiries
+        if not expiries or expiries[0][0] > now:
+            return []
+        freed = []
+        with self.lock:
+            while expiries and expiries[0][0] <= now:
+                until, spot = heapq.heappop(expiries)
+                if self.holds.get(spot) == until:
+                    self._update(spot, FREE)
+                    freed.append(spot)
+                    self.expired_through = max(self.expired_through or until, until)
+        return freed
+
+    def next_expiry(self):
+        with self.lock:
+            expiries = self.expiries
+            while expiries and self.holds.get(expiries[0][1]) != expiries[0][0]:
+                heapq.heappop(expiries)
+            return expiries[0][0] if expiries else None
+
+    def is_free(self, spot):
+        return 0 < spot < len(self.slots) and self.slots[spot] == FREE
+
+    def free_count(self):
+        return self.free
+
+    def has_type(self, spot_type):
+        if spot_type == standard:
+            return len(self.types) < len(self.slots) - 1
+        return spot_type in self.type_names
+
+    def next_free(self, policy="lowest", spot_type=None):
+        if spot_type is not None and not self.has_type(spot_type):
+            # Indexes are kept for good, so only types the lot has get one.
+            return None
+        with self.lock:
+            index = self.indexes.get((policy, spot_type))
+            if index is None:
+                index = self.indexes[(policy, spot_type)] = self._index(policy, spot_type)
+            return index.next_free()
+
+    def _index(self, policy, spot_type):
+        if spot_type is None:
+            spots = range(1, len(self.slots))
+        else:
+            spots = [spot for spot in range(1, len(self.slots)) if self.types.get(spot, standard) == spot_type]
+        if policy == "balanced":
+            return LevelIndex(self.levels.__getitem__, spots, self.is_free)
+        if policy == "nearest":
+            distances = self.distances
+            return OrderedIndex(lambda spot: (distances[spot] is None, distances[spot] or 0, spot), spots, self.is_free)
+        return OrderedIndex(lambda spot: spot, spots, self.is_free)
+
+    def free_spots(self):
+        slots = self.slots
+        return [spot for spot in range(1, len(slots)) if slots[spot] == FREE]
+
+    def copy(self):
+        return bytes(self.slots)
+
+    def changes(self, previous):
+        # (spot, free) for every spot that differs from an earlier copy().
+        slots = self.copy()
+        if slots == previous:
+            return []
+        width = max(len(slots), len(previous))
+        slots, previous = slots.ljust(width, b"\0"), previous.ljust(width, b"\0")
+        return [(spot, slots[spot] == FREE) for spot in range(1, width) if slots[spot] != previous[spot]]
+
+    def mismatches(self, rows, now=None):
+        now = time.time() if now is None else now
+        seen = set()
+        result = []
+        for spot, available, *layout in rows:
+            seen.add(spot)
+            if len(layout) > 3 and layout[3] is not None and layout[3] > now:
+                available = False
+            if self.is_free(spot) != bool(available):
+                result.append(spot)
+        for spot in range(1, len(self.slots)):
+            if self.slots[spot] == FREE and spot not in seen:
+                result.append(spot)
+        return sorted(result)
+
+
+class VehicleIndex:
+    def __init__(self):
+        self.spots = {}
+        self.vehicles = {}
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def load(self, rows):
+        spots = {}
+        vehicles = {}
+        for spot, vehicle_number in rows:
+            spots[vehicle_number] = spot
+            vehicles[spot] = vehicle_number
+        with self.lock:
+            self.spots = spots
+            self.vehicles = vehicles
+            self.loaded = True
+
+    def park(self, spot, vehicle_number):
+        with self.lock:
+            previous = self.vehicles.pop(spot, None)
+            if previous is not None:
+                self.spots.pop(previous, None)
+            self.spots[vehicle_number] = spot
+            self.vehicles[spot] = vehicle_number
+
+    def leave(self, spot):
+        with self.lock:
+            vehicle_number = self.vehicles.pop(spot, None)
+            if vehicle_number is not None and self.spots.get(vehicle_number) == spot:
+                del self.spots[vehicle_number]
+
+    def spot_of(self, vehicle_number):
+        return self.spots.get(vehicle_number)
+
+
+class SharedVersion:
+    # Tracks the occupancy version row that every committed park/leave bumps.
+    # seen is the version the in-process maps reflect, so a worker can tell
+    # whether another process changed the lot since its maps were last
+    # loaded. Commits of this process may get here out of order; the change
+    # of a version waits in ahead until the ones before it have been applied,
+    # so the maps go through the versions in the order they were committed.
+    def __init__(self, ahead_limit=64):
+        self.seen = None
+        self.ahead = {}
+        self.ahead_limit = ahead_limit
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+
+    def due(self, interval, now):
+        with self.lock:
+            if now - self.checked_at < interval:
+                return False
+            self.checked_at = now
+            return True
+
+    def observe(self, version, load=None):
+        # load puts rows read at version (or later) into the maps. It runs
+        # under the lock the changes are applied under, so a change of an
+        # older version that gets here late is dropped instead of applied over it.
+        with self.lock:
+            if load is not None:
+                load()
+            current = version is not None and version == self.seen
+            self.seen = version
+            if self.ahead:
+                self.ahead = {ahead: change for ahead, change in self.ahead.items()
+                              if version is not None and ahead > version}
+                self._drain()
+            return current
+
+    def advance(self, version, change=None):
+        # change applies the commit of version to the maps. False when
+        # versions of another process leave a gap that will not be filled
+        # here, so the maps have to be reloaded.
+        with self.lock:
+            if self.seen is None:
+                if change is not None:
+                    change()
+                return True
+            if version <= self.seen:
+                return True
+            self.ahead[version] = change
+            self._drain()
+            if len(self.ahead) > self.ahead_limit:
+                self.seen = None
+                self.ahead = {}
+                return False
+            return True
+
+    def _drain(self):
+        while self.seen is not None and self.seen + 1 in self.ahead:
+            change = self.ahead.pop(self.seen + 1)
+            self.seen += 1
+            if change is not None:
+                change()
+
+    def waiting(self):
+        # A commit of this process is held back behind a version it did not
+        # see, which another process may have taken; the next read checks
+        # the version row instead of waiting for it.
+        return bool(self.ahead)
+
+    def current(self):
+        # The version to validate cached reads against, None while some
+        # committed change is not yet applied.
+        with self.lock:
+            return None if self.ahead else self.seen
+
+    def reset(self):
+        with self.lock:
+            self.seen = None
+            self.ahead = {}
+            self.checked_at = 0.0
+
+
+class LotState:
+    def __init__(self):
+        self.occupancy = Occupancy()
+        self.vehicles = VehicleIndex()
+        self.version = SharedVersion()
+        self.feed = OccupancyFeed(self.occupancy)
+        self.writer = GroupCommit()
+
+    def reset(self):
+        self.occupancy.loaded = False
+        self.vehicles.loaded = False
+        self.version.reset()
+
+
+class Lots:
+    # In-process state per lot, created on first use, so a write to one lot
+    # never takes the lock of another.
+    def __init__(self):
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, lot_id):
+        state = self.states.get(lot_id)
+        if state is None:
+            with self.lock:
+                state = self.states.setdefault(lot_id, LotState())
+        return state
+
+    def __contains__(self, lot_id):
+        return lot_id in self.states
+
+    def reset(self):
+        with self.lock:
+            states = list(self.states.values())
+        for state in states:
+            state.reset()
+
+    def after_fork(self):
+        self.lock = threading.Lock()
+        for state in self.states.values():
+            state.reset()
+            state.feed.after_fork()
+            state.writer.after_fork()
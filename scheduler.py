@@ -0,0 +1,47 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class Scheduler:
+    # Calls functions at wall-clock times from one thread. Entries wait in a
+    # heap, so scheduling one is O(log n) and the thread sleeps until the
+    # earliest is due instead of sweeping on an interval.
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+
+    def call_at(self, when, function):
+        with self.lock:
+            heapq.heappush(self.heap, (when, next(self.counter), function))
+            if self.heap[0][0] == when:
+                self.wakeup.notify()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="scheduler", daemon=True)
+                self.thread.start()
+
+    def pending(self):
+        return len(self.heap)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.heap or self.heap[0][0] > time.time():
+                    self.wakeup.wait(self.heap[0][0] - time.time() if self.heap else None)
+                when, order, function = heapq.heappop(self.heap)
+            try:
+                function()
+            except Exception:
+                # One failing callback must not stop the ones after it; reads
+                # expire holds themselves, so a missed run is caught up later.
+                continue
+
+    def after_fork(self):
+        self.heap = []
+        self.thread = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
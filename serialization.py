@@ -0,0 +1,69 @@
+import json
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def stdlib_dumps(obj, default=None):
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=default).encode("utf8")
+
+
+def orjson_dumps(obj, default=None):
+    # Spot numbers are the keys of several responses.
+    return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def backends():
+    available = {"json": (stdlib_dumps, json.loads)}
+    if orjson is not None:
+        available["orjson"] = (orjson_dumps, orjson.loads)
+    return available
+
+
+def default_backend():
+    return "orjson" if orjson is not None else "json"
+
+
+def backend(name):
+    available = backends()
+    if name not in available:
+        raise ValueError(f"Unknown JSON backend {name}, use one of {', '.join(available)}.")
+    return available[name]
+
+
+def encode(obj, dumps, default=None):
+    if isinstance(obj, StaticBody):
+        return obj.body
+    return dumps(obj, default) + b"\n"
+
+
+class StaticBody(dict):
+    # A response that never changes, such as a fixed error message. It is
+    # encoded once when it is defined and sent as is every time after.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.body = encode(dict(self), backend(default_backend())[0])
+
+
+class CompactJSONProvider(DefaultJSONProvider):
+    # Response bodies without whitespace, in the order handlers build them,
+    # from the configured backend. dumps is left to the stdlib for Flask's
+    # own uses, the response and request bodies are what every request pays for.
+    sort_keys = False
+
+    def __init__(self, app, name):
+        super().__init__(app)
+        self.encoder, self.decoder = backend(name)
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return self.decoder(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(encode(obj, self.encoder, self.default), mimetype=self.mimetype)
@@ -0,0 +1,65 @@
+import os
+import re
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+profiles = {
+    "default": {},
+    "wal": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 268435456,
+        "cache_size": -65536,
+        "busy_timeout": 5000,
+        "temp_store": "MEMORY",
+    },
+    "durable": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "busy_timeout": 5000,
+    },
+}
+
+pragma_value = re.compile(r"^-?[A-Za-z0-9_]+$")
+
+
+def sqlite_pragmas(profile, environ=os.environ):
+    if profile not in profiles:
+        raise ValueError(f"Unknown storage profile {profile!r}, expected one of {', '.join(profiles)}")
+    pragmas = dict(profiles[profile])
+    for name in ("journal_mode", "synchronous", "mmap_size", "cache_size", "busy_timeout", "temp_store"):
+        value = environ.get("PARKING_SQLITE_" + name.upper())
+        if value is not None:
+            pragmas[name] = value
+    for name, value in pragmas.items():
+        if not pragma_value.match(str(value)):
+            raise ValueError(f"Invalid value {value!r} for PRAGMA {name}")
+    return pragmas
+
+
+def engine_options(uri, environ=os.environ):
+    url = make_url(uri)
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        return {}
+    options = {
+        "pool_size": int(environ.get("PARKING_POOL_SIZE", 10)),
+        "max_overflow": int(environ.get("PARKING_POOL_OVERFLOW", 20)),
+        "pool_timeout": int(environ.get("PARKING_POOL_TIMEOUT", 30)),
+    }
+    if url.get_backend_name() != "sqlite":
+        options["pool_pre_ping"] = True
+        options["pool_recycle"] = 1800
+    return options
+
+
+def install_pragmas(engine, pragmas):
+    if engine.dialect.name != "sqlite" or not pragmas:
+        return
+
+    @event.listens_for(engine, "connect")
+    def apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
@@ -1,34 +1,35 @@
 import requests
 from unittest import TestCase, main
-from main import message, db, get_token, CarParkingModel, limit
+from main import app, message, CarParkingModel, limit
 
 BASE = "http://127.0.0.1:5000"
 
+# The server keeps the occupancy in memory, so the data is changed through the
+# API it serves and only read back from the database.
+
+#Helping function for getting token
+def gen_token(vehicle_number,vehicle_mark):
+    return requests.get(url=BASE + f"/get_token/{vehicle_number}/{vehicle_mark}").json()["access_token"]
+
 #Helping function for cleaning data
 def clean_data():
+    token = gen_token("test_1", "test-mark")
     for i in range(1,limit+1):
-        db.session.merge(CarParkingModel(
-            vehicle_number=None,
-            vehicle_mark=None,
-            parking_available=True,
-            parking_spot=i,
-        ))
-        db.session.commit()
+        requests.patch(url=BASE + f"/leave/{i}", headers={"authorization": f"Basic {token}"})
 
 #Helping function for generating the data for parking
 def gen_data_parking(limit):
+    token = gen_token("test_1", "test-mark")
     for i in range(1,limit+1):
-        db.session.merge(CarParkingModel(
-            vehicle_number="test_"+str(i),
-            vehicle_mark="test-mark",
-            parking_available=False,
-            parking_spot=i,
-        ))
-        db.session.commit()
+        requests.put(url=BASE + f"/parking/{i}",
+                     json={"vehicle_number": "test_"+str(i), "vehicle_mark": "test-mark"},
+                     headers={"content-type": "application/json", "authorization": f"Basic {token}"})
 
-#Helping function for getting token
-def gen_token(vehicle_number,vehicle_mark):
-    return get_token(vehicle_number,vehicle_mark)["access_token"]
+#Helping function for reading a spot from the database
+def stored_spot(spot_number):
+    with app.app_context():
+        spot = CarParkingModel.query.filter_by(parking_spot=spot_number).first()
+        return spot.get_number(), spot.get_mark(), spot.get_available(), spot.get_spot()
 
 
 class Reparking(TestCase):
@@ -44,17 +45,8 @@ class Reparking(TestCase):
         response =response.json()
         self.assertEqual(expected, response)
         # Integration test part
-        actual_db = CarParkingModel.query.filter_by(parking_spot=2).first()
-        self.assertEqual(actual_db.get_number(), 'test_1')
-        self.assertEqual(actual_db.get_mark(), 'test-mark')
-        self.assertEqual(actual_db.get_available(), False)
-        self.assertEqual(actual_db.get_spot(), 2)
-
-        prev_spot_db = CarParkingModel.query.filter_by(parking_spot=1).first()
-        self.assertEqual(prev_spot_db.get_number(), None)
-        self.assertEqual(prev_spot_db.get_mark(), None)
-        self.assertEqual(prev_spot_db.get_available(), True)
-        self.assertEqual(prev_spot_db.get_spot(), 1)
+        self.assertEqual(('test_1', 'test-mark', False, 2), stored_spot(2))
+        self.assertEqual((None, None, True, 1), stored_spot(1))
         clean_data()
 
     def test_reparking_fail(self):
@@ -83,11 +75,7 @@ class Leaving(TestCase):
         ).json()
         self.assertEqual(expected, response)
         # Integration test part
-        actual_db = CarParkingModel.query.filter_by(parking_spot=1).first()
-        self.assertEqual(actual_db.get_number(), None)
-        self.assertEqual(actual_db.get_mark(), None)
-        self.assertEqual(actual_db.get_available(), True)
-        self.assertEqual(actual_db.get_spot(), 1)
+        self.assertEqual((None, None, True, 1), stored_spot(1))
         clean_data()
 
 
@@ -116,11 +104,7 @@ class Parking(TestCase):
         ).json()
         self.assertEqual(expected, response)
         # Integration test part
-        actual_db = CarParkingModel.query.filter_by(parking_spot=1).first()
-        self.assertEqual(actual_db.get_number(),"test_1")
-        self.assertEqual(actual_db.get_mark(),"test-mark")
-        self.assertEqual(actual_db.get_available(),False)
-        self.assertEqual(actual_db.get_spot(),1)
+        self.assertEqual(("test_1", "test-mark", False, 1), stored_spot(1))
         clean_data()
 
     def test_parking_fail(self):
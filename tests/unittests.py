@@ -1,22 +1,109 @@
-from unittest import TestCase, main, mock
+from unittest import TestCase, main, mock, skipUnless
 from main import free_spots, next_free_spot, get_parking_spot, \
-    get_all, parking, leave, change_spot, message, get_token,  is_authorized, CarParkingModel, AuthorizationModel
-from flask import Flask
+    get_all, parking, leave, change_spot, parking_batch, leave_batch, message, get_token,  is_authorized, CarParkingModel, AuthorizationModel, LotModel, \
+    occupancy_check, token_digest, reap_expired_tokens, provision_lot, create_app, after_fork, commit_spot_changes, \
+    default_lot, refresh_shared_state, spots_committed, \
+    record_sessions, report_window, session_statements, commit_group, spot_rows, set_layout, db, upgrade_schema, \
+    StateVersionModel, rebuild_from_snapshot
+from analytics import occupancy_buckets, peak_hours
+from occupancy import Occupancy, SharedVersion, VehicleIndex
+import sqlalchemy
+from sqlalchemy.exc import IntegrityError
+from token_cache import TokenCache
+from tokens import Revocations, TokenSigner, token_id
+import storage
+from metrics import Histogram, Registry, Counter
+from feed import OccupancyFeed
+from group_commit import GroupCommit
+from scheduler import Scheduler
+import serialization
+from journal import Journal, LotSnapshot, layout_event, leave_event, move_event, park_event, size_event, replay, \
+    write_checkpoint, reserve_event, cancel_event, rotate, remove_segments, journal_segments
+import asyncio
+import os
+import random
+import tempfile
+import threading
 import base64
 from datetime import datetime, timedelta
 import time
 
-testapp = Flask(__name__)
+try:
+    import asgi
+    from starlette.testclient import TestClient
+except ImportError:
+    asgi = None
+
+testapp = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'JOURNAL_PATH': None, 'SECRET_KEY': 'test-key',
+                      'TOKEN_REVOCATION_CHECK': None})
+# The in-process state of testapp, which most tests drive.
+state = testapp.extensions["parking"]
+lots, token_cache, token_signer, revocations = state.lots, state.token_cache, state.token_signer, state.revocations
+
+
+def file_app(config=None):
+    # An app on its own SQLite file, for tests that need real tables.
+    path = os.path.join(tempfile.mkdtemp(), "parking.db")
+    return create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path, 'JOURNAL_PATH': None, 'SECRET_KEY': 'test-key',
+                       'TOKEN_REVOCATION_CHECK': None, **(config or {})})
+
+
+def signed_token(vehicle_number, vehicle_mark):
+    with testapp.app_context():
+        return "Basic " + get_token(vehicle_number, vehicle_mark)["access_token"]
+
+
+def untrack_versions():
+    # A mocked database bumps the version to a mock, so tests on one keep the
+    # maps untracked and every change is applied as it comes.
+    lots[default_lot].version.reset()
 
 
 class Authorization(TestCase):
 
+    def setUp(self):
+        token_cache.clear()
+        context = testapp.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+
     def test_get_token(self):
         vehicle_mark = "Honda"
         vehicle_number = "THR335"
-        expected = {"access_token": base64.encodebytes(('%s:%s' % (vehicle_number, vehicle_mark)).encode('utf8')).decode('utf8').replace('\n', '')}
         result = get_token(vehicle_number=vehicle_number, vehicle_mark=vehicle_mark)
-        self.assertEqual(expected['access_token'], result['access_token'])
+        expected = {"n": vehicle_number, "m": vehicle_mark, "e": result["expires_at"]}
+        self.assertEqual(expected, token_signer.verify(result['access_token']))
+        with testapp.app_context():
+            self.assertEqual(({}, True), is_authorized({"Authorization": "Basic " + result['access_token']}))
+
+    def test_signed_token_checks(self):
+        signer = TokenSigner(b"key")
+        token = signer.sign({"n": "THR335", "m": "Honda", "e": 100})
+        self.assertEqual({"n": "THR335", "m": "Honda", "e": 100}, signer.verify(token))
+        self.assertIsNone(TokenSigner(b"other").verify(token))
+        self.assertIsNone(signer.verify(token[:-2] + "AA"))
+        self.assertIsNone(signer.verify("not a token"))
+        self.assertIsNone(signer.verify("bm90.4oCU"))
+        self.assertIsNone(signer.verify("abc.é"))
+        self.assertIsNone(signer.verify("é.abc"))
+        response = testapp.test_client().get("/free_spots", headers={"Authorization": "Basic abc.é"})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({message: "You are not authorized"}, response.json)
+        with testapp.app_context():
+            expired = is_authorized({"Authorization": "Basic " + token_signer.sign({"n": "A", "m": "B", "e": 1})})
+        self.assertEqual(({message: "You are not authorized, token expired"}, False), expired)
+
+    def test_revoked_token(self):
+        token = get_token("THR336", "Honda")["access_token"]
+        with testapp.app_context():
+            revocations.add(token_id(token), token_signer.verify(token)["e"])
+            self.assertEqual(({message: "You are not authorized, token revoked"}, False),
+                             is_authorized({"Authorization": "Basic " + token}))
+        tracker = Revocations()
+        tracker.add(b"old", 5)
+        tracker.load([(b"new", 20)], now=10)
+        self.assertNotIn(b"old", tracker)
+        self.assertIn(b"new", tracker)
 
     @mock.patch('main.AuthorizationModel')
     def test_is_authorized_success(self, authorization_model):
@@ -50,40 +137,516 @@ class Authorization(TestCase):
         result = is_authorized({"Authorization": basic_token})
         self.assertEqual(expected, result)
 
+    @mock.patch('main.AuthorizationModel')
+    def test_is_authorized_cached(self, authorization_model):
+        vehicle_mark = "Honda"
+        vehicle_number = "THR3353"
+        basic_token = "Basic "+base64.encodebytes(('%s:%s' % (vehicle_number, vehicle_mark)).encode('utf8')).decode('utf8').replace('\n', '')
+        expires_at = int(time.mktime((datetime.now() + timedelta(minutes=15)).timetuple()))
+        authorization_model.query.filter_by(access_token=basic_token).first.return_value = AuthorizationModel(access_token=basic_token, expires_at=expires_at)
+        expected = {}, True
+        self.assertEqual(expected, is_authorized({"Authorization": basic_token}))
+        self.assertEqual(expected, is_authorized({"Authorization": basic_token}))
+        self.assertEqual(1, authorization_model.query.filter_by.return_value.first.call_count)
+        self.assertEqual(1, token_cache.hits)
+
+    @mock.patch.dict(testapp.config, {'SHARED_STATE_CHECK_INTERVAL': 0})
+    @mock.patch('main.AuthorizationModel')
+    def test_is_authorized_not_cached_across_workers(self, authorization_model):
+        basic_token = "Basic " + base64.b64encode(b"THR3354:Honda").decode('utf8')
+        expires_at = int(time.time()) + 900
+        authorization_model.query.filter_by.return_value.first.return_value = AuthorizationModel(
+            access_token=basic_token, expires_at=expires_at)
+        self.assertEqual(({}, True), is_authorized({"Authorization": basic_token}))
+        # Revoked by another worker.
+        authorization_model.query.filter_by.return_value.first.return_value = None
+        self.assertEqual(({message: "You are not authorized"}, False), is_authorized({"Authorization": basic_token}))
+        self.assertEqual(0, token_cache.stats()["size"])
+
+
+class TokenReaper(TestCase):
+
+    def test_token_digest_is_fixed_width(self):
+        short = token_digest("Basic QUJDOkQ=")
+        long = token_digest("Basic " + "x" * 100)
+        self.assertEqual(16, len(short))
+        self.assertEqual(16, len(long))
+        self.assertNotEqual(short, long)
+
+    @mock.patch('main.db')
+    def test_reap_in_batches(self, db):
+        db.session.execute.side_effect = [mock.Mock(rowcount=2), mock.Mock(rowcount=2), mock.Mock(rowcount=1)]
+        result = reap_expired_tokens(batch_size=2)
+        self.assertEqual(5, result)
+        self.assertEqual(3, db.session.commit.call_count)
+
+
+class ParkingJournal(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "journal.ndjson")
+        self.journal = Journal()
+        self.journal.configure(self.path, 0)
+
+    def tearDown(self):
+        self.journal.close()
+
+    def test_replay(self):
+        self.journal.append(1, 1, [size_event(6, 3)])
+        self.journal.append(1, 2, [park_event(1, "AAA111", "Honda"), park_event(2, "BBB222", "Audi")])
+        self.journal.append(2, 1, [size_event(2, None)])
+        self.journal.append(1, 3, [move_event(1, 5, "AAA111", "Honda")])
+        self.journal.append(1, 4, [leave_event(2)])
+        self.journal.abort(1, 4)
+        self.journal.append(1, 4, [park_event(6, "CCC333", "BMW")])
+        lots, applied, offset, torn = replay(self.path)
+        self.assertEqual(6, applied)
+        self.assertEqual({5: ("AAA111", "Honda"), 2: ("BBB222", "Audi"), 6: ("CCC333", "BMW")}, lots[1].cars)
+        self.assertEqual([1, 1, 1, 2, 2, 2], lots[1].levels)
+        self.assertEqual(4, lots[1].version)
+        self.assertEqual([1, 1], lots[2].levels)
+
+    def test_replay_from_checkpoint(self):
+        checkpoint = os.path.join(self.directory, "journal.ndjson.checkpoint")
+        self.journal.append(1, 1, [size_event(4, None)])
+        self.journal.append(1, 2, [park_event(3, "AAA111", "Honda")])
+        lots, applied, offset, torn = replay(self.path, settle=False)
+        self.assertEqual({}, lots[1].cars)
+        write_checkpoint(checkpoint, lots, offset)
+        self.journal.append(1, 3, [leave_event(3)])
+        self.journal.append(1, 4, [park_event(4, "BBB222", "Audi")])
+        lots, applied, offset, torn = replay(self.path, checkpoint)
+        self.assertEqual(3, applied)
+        self.assertEqual({4: ("BBB222", "Audi")}, lots[1].cars)
+
+    def test_checkpoint_rotates_the_journal(self):
+        checkpoint = os.path.join(self.directory, "journal.ndjson.checkpoint")
+        self.journal.append(1, 1, [size_event(4, None)])
+        self.journal.append(1, 2, [park_event(3, "AAA111", "Honda")])
+        self.journal.append(2, 1, [size_event(2, None)])
+        lots, applied, offset, torn = replay(self.path, checkpoint, settle=False)
+        # A writer that has not noticed the rotation yet appends to the segment.
+        segment = rotate(self.path)
+        self.journal.fd, fd = None, self.journal.fd
+        os.write(fd, b'{"l":1,"v":3,"t":0,"ev":[["leave",3]]}\n')
+        self.journal.fd = fd
+        write_checkpoint(checkpoint, lots, offset, segment)
+        remove_segments(self.path, segment)
+        self.assertEqual(([1], {}), (journal_segments(self.path), lots[1].cars))
+        self.assertEqual(2, lots[1].pending["v"])
+        self.journal.append(1, 4, [park_event(4, "BBB222", "Audi")])
+        self.assertTrue(os.path.exists(self.path))
+        lots, applied, offset, torn = replay(self.path, checkpoint, settle=False)
+        self.assertEqual((2, os.path.getsize(self.path)), (applied, offset))
+        segment = rotate(self.path)
+        write_checkpoint(checkpoint, lots, offset, segment)
+        remove_segments(self.path, segment)
+        self.assertEqual([2], journal_segments(self.path))
+        self.assertFalse(os.path.exists(self.path))
+        lots, applied, offset, torn = replay(self.path, checkpoint)
+        self.assertEqual(({4: ("BBB222", "Audi")}, 4), (lots[1].cars, lots[1].version))
+        self.assertEqual([1, 1], lots[2].levels)
+
+    def test_uncommitted_last_record(self):
+        self.journal.append(1, 1, [size_event(4, None)])
+        self.journal.append(1, 2, [park_event(1, "AAA111", "Honda")])
+        self.journal.append(2, 1, [size_event(2, None)])
+        self.journal.append(2, 2, [park_event(2, "BBB222", "Audi")])
+        # Lot 1 crashed before its version 2 committed, lot 2 has no version row.
+        lots, applied, offset, torn = replay(self.path, committed={1: 1}.get)
+        self.assertEqual(({}, 1), (lots[1].cars, lots[1].version))
+        self.assertEqual({2: ("BBB222", "Audi")}, lots[2].cars)
+        lots, applied, offset, torn = replay(self.path, committed={1: 2, 2: 2}.get)
+        self.assertEqual({1: ("AAA111", "Honda")}, lots[1].cars)
+
+    def test_torn_last_record(self):
+        self.journal.append(1, 1, [size_event(4, None)])
+        self.journal.append(1, 2, [park_event(1, "AAA111", "Honda")])
+        self.journal.close()
+        size = os.path.getsize(self.path)
+        with open(self.path, "ab") as journal_file:
+            journal_file.write(b'{"l":1,"v":3,"t":0,"ev":[["park",2,"BB')
+        lots, applied, offset, torn = replay(self.path)
+        self.assertEqual(([["journal.ndjson", size]], size), (torn, offset))
+        self.assertEqual({1: ("AAA111", "Honda")}, lots[1].cars)
+        # Reopened after the crash, the journal ends the torn line first.
+        self.journal.append(1, 3, [park_event(3, "CCC333", "Audi")])
+        lots, applied, offset, torn = replay(self.path)
+        self.assertEqual([["journal.ndjson", size]], torn)
+        self.assertEqual({1: ("AAA111", "Honda"), 3: ("CCC333", "Audi")}, lots[1].cars)
+
+    def test_rebuild_moves_the_version_on(self):
+        app = file_app()
+        with app.app_context():
+            db.create_all()
+            provision_lot(2)
+            snapshot = LotSnapshot(1)
+            snapshot.apply(size_event(2, None))
+            snapshot.apply(park_event(2, "AAA111", "Honda"))
+            rebuild_from_snapshot({default_lot: snapshot})
+            self.assertEqual(2, db.session.query(StateVersionModel.version).scalar())
+            snapshot.version = 5
+            rebuild_from_snapshot({default_lot: snapshot})
+            self.assertEqual(6, db.session.query(StateVersionModel.version).scalar())
+            cars = {spot.get_spot(): spot.get_number() for spot in CarParkingModel.query.filter_by(parking_available=False)}
+            self.assertEqual({2: "AAA111"}, cars)
+
+    @mock.patch.object(state, 'journal')
+    @mock.patch('main.db')
+    def test_commit_appends_before_commit(self, db, journal):
+        db.session.execute().scalar.return_value = 7
+        db.session.commit.side_effect = lambda: journal.append.assert_called_once_with(1, 7, [leave_event(2)])
+        with testapp.app_context():
+            commit_spot_changes([leave_event(2)])
+        db.session.commit.assert_called_once()
+        journal.abort.assert_not_called()
+
+    @mock.patch('main.db')
+    def test_commit_without_events(self, db):
+        with testapp.app_context():
+            self.assertIsNone(commit_spot_changes([]))
+        db.session.execute.assert_not_called()
+        db.session.commit.assert_not_called()
+
+
+@skipUnless(asgi, "async serving mode needs starlette, aiosqlite and greenlet")
+class AsyncServing(TestCase):
+
+    def setUp(self):
+        # The async engine on a lot provisioned through the Flask app.
+        self.app = file_app()
+        with self.app.app_context():
+            db.create_all()
+            provision_lot(4)
+            self.headers = {"Authorization": "Basic " + get_token("ASG001", "Honda")["access_token"]}
+        self.lots = self.app.extensions["parking"].lots
+        for name, value in (("flask_app", self.app),
+                            ("engine", asgi.create_engine(self.app.config['SQLALCHEMY_DATABASE_URI']))):
+            patcher = mock.patch.object(asgi, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def park(self, client, spot, vehicle_number):
+        return client.put(f"/parking/{spot}", json={"vehicle_number": vehicle_number, "vehicle_mark": "Honda"},
+                          headers=self.headers).json()
+
+    def test_async_uri(self):
+        self.assertEqual("sqlite+aiosqlite:////tmp/parking.db", str(asgi.async_uri("sqlite:////tmp/parking.db")))
+        self.assertEqual("postgresql+asyncpg://parking@localhost/parking",
+                         asgi.async_uri("postgresql://parking@localhost/parking").render_as_string())
+        self.assertTrue(str(asgi.async_uri("sqlite:///database.db")).endswith("/instance/database.db"))
+        self.assertRaises(ValueError, asgi.async_uri, "mysql://localhost/parking")
+
+    def test_park_leave_and_change_spot(self):
+        with TestClient(asgi.app) as client:
+            self.assertEqual({"parking spot": 1}, self.park(client, 1, "AAA111"))
+            self.assertEqual({message: "This spot is not available!"}, self.park(client, 1, "BBB222"))
+            self.assertEqual({message: "Car AAA111 is already parked."}, self.park(client, 2, "AAA111"))
+            self.assertEqual({"parking spot": 2}, self.park(client, 2, "BBB222"))
+            change = lambda spot, number: client.put(f"/change_to/{spot}", headers=self.headers, json={
+                "vehicle_number": number, "vehicle_mark": "Audi"}).json()
+            self.assertEqual({"message": "AAA111 parked to 3"}, change(3, "AAA111"))
+            self.assertEqual({message: "This spot is not available!"}, change(2, "AAA111"))
+            self.assertEqual({message: "Car CCC333 not parked."}, change(4, "CCC333"))
+            self.assertEqual({"AAA111": 3}, client.get("/get_parking_spot/AAA111", headers=self.headers).json())
+            self.assertEqual({"message": "spot 2 is available"}, client.patch("/leave/2", headers=self.headers).json())
+            self.assertEqual({message: "There is no car parked in this spot."},
+                             client.patch("/leave/2", headers=self.headers).json())
+            self.assertEqual({"free": 3}, client.get("/free_spots", headers=self.headers).json())
+            self.assertEqual({"consistent": True, "mismatched": []},
+                             client.get("/occupancy_check", headers=self.headers).json())
+            self.assertEqual(200, client.get("/metrics").status_code)
+            self.assertIn("hits", client.get("/token_cache_stats", headers=self.headers).json())
+            unknown = client.get("/lots/77/free_spots", headers=self.headers)
+            self.assertEqual((404, {message: "There is no lot 77."}), (unknown.status_code, unknown.json()))
+            self.assertNotIn(77, self.lots)
+        with self.app.app_context():
+            cars = {spot.get_spot(): spot.get_number() for spot in CarParkingModel.query.filter_by(parking_available=False)}
+            self.assertEqual({3: "AAA111"}, cars)
+            # Provisioning and the four writes that changed a spot.
+            self.assertEqual(5, db.session.query(StateVersionModel.version).scalar())
+
+    def test_feed_wakers_belong_to_one_lifespan(self):
+        feed = self.lots[default_lot].feed
+        with TestClient(asgi.app) as client:
+            waker = asgi.FeedWaker(client.portal.call(asyncio.get_running_loop))
+            asgi.app.state.feed_wakers[default_lot] = waker
+            feed.add_listener(waker.notify)
+        self.assertNotIn(waker.notify, feed.listeners)
+        with TestClient(asgi.app):
+            self.assertEqual({}, asgi.app.state.feed_wakers)
+
+    def test_get_all(self):
+        with TestClient(asgi.app) as client:
+            get_all = lambda query="": client.get(f"/get_all{query}", headers=self.headers)
+            self.assertEqual({message: "There are no cars parked in this parking lot."}, get_all().json())
+            self.park(client, 3, "AAA111")
+            self.park(client, 1, "BBB222")
+            self.assertEqual({"1": "BBB222", "3": "AAA111"}, get_all().json())
+            self.assertEqual({"spots": [1, 3], "vehicle_numbers": ["BBB222", "AAA111"]}, get_all("?format=columnar").json())
+            self.assertEqual({"cars": {"1": "BBB222"}, "next": 1}, get_all("?limit=1").json())
+            self.assertEqual({"cars": {"3": "AAA111"}, "next": None}, get_all("?after=1&limit=2").json())
+            self.assertEqual(b'{"spot":1,"vehicle_number":"BBB222"}\n{"spot":3,"vehicle_number":"AAA111"}\n',
+                             get_all("?format=ndjson").content)
+            self.assertEqual({message: "limit must be a whole number."}, get_all("?limit=x").json())
+            self.assertEqual({message: "ttl must be a whole number."}, client.put(
+                "/reserve/4", json={"vehicle_number": "CCC333", "ttl": "soon"}, headers=self.headers).json())
+            for path, name in (("/occupancy_history?from=yesterday", "from"), ("/peak_hours?top=x", "top"),
+                               ("/sessions/AAA111?limit=all", "limit")):
+                self.assertEqual({message: f"{name} must be a whole number."},
+                                 client.get(path, headers=self.headers).json())
+
+
+class Migration(TestCase):
+
+    def flat_app(self):
+        # A database of the first version: one flat table keyed by the spot.
+        app = file_app()
+        with app.app_context(), db.engine.begin() as connection:
+            connection.execute(sqlalchemy.text(
+                "CREATE TABLE car_parking_model (parking_spot INTEGER PRIMARY KEY, vehicle_number VARCHAR(6), "
+                "vehicle_mark VARCHAR(100), parking_available BOOLEAN NOT NULL)"))
+            connection.execute(sqlalchemy.text("INSERT INTO car_parking_model VALUES (:spot, :number, :mark, :free)"), [
+                {"spot": 1, "number": None, "mark": None, "free": True},
+                {"spot": 2, "number": "AAA111", "mark": "Honda", "free": False},
+                {"spot": 3, "number": "BBB222", "mark": "Audi", "free": False},
+                {"spot": 4, "number": "AAA111", "mark": "Honda", "free": False}])
+        return app
+
+    def test_tokens_of_the_first_version_stay_valid(self):
+        app = self.flat_app()
+        token = "Basic " + base64.b64encode(b"MIG001:Honda").decode("utf8")
+        with app.app_context(), db.engine.begin() as connection:
+            connection.execute(sqlalchemy.text(
+                "CREATE TABLE authorization_model (access_token VARCHAR(100) PRIMARY KEY, expires_at INTEGER NOT NULL)"))
+            connection.execute(sqlalchemy.text("INSERT INTO authorization_model VALUES (:token, :expires_at)"), [
+                {"token": token, "expires_at": int(time.time()) + 600},
+                {"token": "Basic ZXhwaXJlZA==", "expires_at": 1}])
+        with app.app_context():
+            upgrade_schema()
+            self.assertEqual(1, AuthorizationModel.query.count())
+        response = app.test_client().get("/free_spots", headers={"Authorization": token})
+        self.assertEqual({"free": 2}, response.json)
+
+    def test_car_in_two_spots_keeps_the_lowest(self):
+        app = self.flat_app()
+        with app.app_context():
+            upgrade_schema()
+            cars = {spot.get_spot(): spot.get_number() for spot in CarParkingModel.query.filter_by(parking_available=False)}
+            self.assertEqual({2: "AAA111", 3: "BBB222"}, cars)
+            self.assertEqual(4, CarParkingModel.query.filter_by(lot_id=default_lot).count())
+
+    def test_failed_rebuild_leaves_the_flat_table(self):
+        app = self.flat_app()
+        with app.app_context(), mock.patch('main.free_duplicate_plates'):
+            self.assertRaises(IntegrityError, upgrade_schema)
+            inspector = sqlalchemy.inspect(db.engine)
+            self.assertFalse(inspector.has_table("car_parking_model_flat"))
+            self.assertNotIn("lot_id", {column["name"] for column in inspector.get_columns("car_parking_model")})
+
+
+class Startup(TestCase):
+
+    def test_routes_are_registered_on_first_use(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'JOURNAL_PATH': None, 'SECRET_KEY': 'test-key',
+                          'TOKEN_REVOCATION_CHECK': None})
+        self.assertFalse(app.routes_registered)
+        self.assertEqual(200, app.test_client().get("/metrics").status_code)
+        self.assertTrue(app.routes_registered)
+        rules = {rule.rule for rule in app.url_map.iter_rules()}
+        self.assertIn("/free_spots", rules)
+        self.assertIn("/lots/<int:lot_id>/free_spots", rules)
+
+    def test_apps_keep_their_own_state(self):
+        directory = tempfile.mkdtemp()
+        first, second = (create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'SECRET_KEY': name + '-key',
+                                     'JOURNAL_PATH': os.path.join(directory, name + '.ndjson'),
+                                     'TOKEN_REVOCATION_CHECK': None}) for name in ("first", "second"))
+        with first.app_context():
+            headers = {"Authorization": "Basic " + get_token("THR335", "Honda")["access_token"]}
+        with second.app_context():
+            self.assertEqual(({message: "You are not authorized"}, False), is_authorized(headers))
+        with first.app_context():
+            self.assertEqual(({}, True), is_authorized(headers))
+        self.assertEqual(os.path.join(directory, "first.ndjson"), first.extensions["parking"].journal.path)
+        self.assertIsNot(first.extensions["parking"].lots, second.extensions["parking"].lots)
+
+
+class Serialization(TestCase):
+
+    def test_backends_agree(self):
+        body = {5: "THR334", 12: "ÄBC123", "next": None}
+        for name in serialization.backends():
+            dumps, loads = serialization.backend(name)
+            self.assertEqual({"5": "THR334", "12": "ÄBC123", "next": None},
+                             loads(serialization.encode(body, dumps)))
+        self.assertRaises(ValueError, serialization.backend, "yaml")
+
+    def test_static_body_is_encoded_once(self):
+        body = serialization.StaticBody({message: "This spot is not available!"})
+        self.assertEqual(b'{"message":"This spot is not available!"}\n', body.body)
+        with testapp.app_context():
+            response = testapp.json.response(body)
+        self.assertEqual(body.body, response.get_data())
+        self.assertEqual("application/json", response.mimetype)
+
+
+class Metrics(TestCase):
+
+    def test_histogram_render(self):
+        registry = Registry()
+        histogram = registry.register(Histogram("latency_seconds", "Latency.", (0.1, 1.0)))
+        registry.register(Counter("hits_total", "Hits.", lambda: 3))
+        histogram.observe("parking", 0.05)
+        histogram.observe("parking", 0.5)
+        histogram.observe("parking", 5)
+        expected = "\n".join([
+            "# HELP latency_seconds Latency.",
+            "# TYPE latency_seconds histogram",
+            'latency_seconds_bucket{endpoint="parking",le="0.1"} 1',
+            'latency_seconds_bucket{endpoint="parking",le="1.0"} 2',
+            'latency_seconds_bucket{endpoint="parking",le="+Inf"} 3',
+            'latency_seconds_sum{endpoint="parking"} 5.55',
+            'latency_seconds_count{endpoint="parking"} 3',
+            "# HELP hits_total Hits.",
+            "# TYPE hits_total counter",
+            "hits_total 3",
+        ]) + "\n"
+        self.assertEqual(expected, registry.render())
+
+
+class StorageProfile(TestCase):
+
+    def test_profile_with_overrides(self):
+        pragmas = storage.sqlite_pragmas("wal", {"PARKING_SQLITE_SYNCHRONOUS": "FULL"})
+        self.assertEqual("WAL", pragmas["journal_mode"])
+        self.assertEqual("FULL", pragmas["synchronous"])
+        self.assertEqual({}, storage.sqlite_pragmas("default", {}))
+
+    def test_invalid_profile_and_values(self):
+        self.assertRaises(ValueError, storage.sqlite_pragmas, "turbo", {})
+        self.assertRaises(ValueError, storage.sqlite_pragmas, "wal", {"PARKING_SQLITE_SYNCHRONOUS": "OFF; DROP"})
+
+    def test_engine_options(self):
+        self.assertEqual({}, storage.engine_options("sqlite://"))
+        self.assertEqual(10, storage.engine_options("sqlite:///database.db", {})["pool_size"])
+        options = storage.engine_options("postgresql://parking@localhost/parking", {"PARKING_POOL_SIZE": "4"})
+        self.assertEqual(4, options["pool_size"])
+        self.assertTrue(options["pool_pre_ping"])
+
+
+class TokenCacheEviction(TestCase):
+
+    def test_expiry_is_exact(self):
+        cache = TokenCache(10)
+        cache.put("a", 100, 50)
+        self.assertEqual(100, cache.get("a", 100))
+        self.assertIsNone(cache.get("a", 101))
+        self.assertEqual({"hits": 1, "misses": 1, "size": 0, "maxsize": 10}, cache.stats())
+
+    def test_expired_entries_evicted_before_lru(self):
+        cache = TokenCache(2)
+        cache.put("old", 10, 0)
+        cache.put("live", 1000, 0)
+        cache.put("new", 1000, 20)
+        self.assertIsNone(cache.get("old", 0))
+        self.assertEqual(1000, cache.get("live", 20))
+        self.assertEqual(1000, cache.get("new", 20))
+
+    def test_lru_eviction_and_invalidate(self):
+        cache = TokenCache(2)
+        cache.put("a", 1000, 0)
+        cache.put("b", 1000, 0)
+        cache.get("a", 0)
+        cache.put("c", 1000, 0)
+        self.assertIsNone(cache.get("b", 0))
+        self.assertEqual(1000, cache.get("a", 0))
+        cache.invalidate("a")
+        self.assertIsNone(cache.get("a", 0))
+
+
+class Provisioning(TestCase):
+
+    @mock.patch('main.lot_spot_rows')
+    @mock.patch('main.db')
+    def test_grow_lot(self, db, spot_rows):
+        db.session.query().filter_by().scalar.return_value = 5
+        db.session.get.return_value = LotModel(lot_id=1, spots_per_level=6)
+        spot_rows.return_value = [(i, True) for i in range(1, 9)]
+        with testapp.app_context():
+            result = provision_lot(8)
+        rows = db.session.execute.call_args_list[0][0][1]
+        self.assertEqual([6, 7, 8], [row["parking_spot"] for row in rows])
+        self.assertEqual([1, 2, 2], [row["level"] for row in rows])
+        self.assertEqual((8, 3, 0), (result["spots"], result["added"], result["removed"]))
+        db.session.commit.assert_called_once()
+        self.assertEqual(8, lots[default_lot].occupancy.free_count())
+
+    @mock.patch('main.db')
+    def test_shrink_refused_when_occupied(self, db):
+        db.session.query().filter_by().scalar.return_value = 10
+        expected = {message: "Cannot remove spots above 8, 2 of them are occupied."}
+        with testapp.app_context(), mock.patch.object(CarParkingModel, 'query') as query:
+            query.filter_by().filter().count.return_value = 2
+            self.assertEqual(expected, provision_lot(8))
+        db.session.commit.assert_not_called()
+
+
+class Lots(TestCase):
+
+    def test_levels_fill_in_order(self):
+        lot = LotModel(lot_id=2, spots_per_level=50)
+        self.assertEqual([1, 1, 2, 3], [lot.get_level(spot) for spot in (1, 50, 51, 101)])
+        self.assertEqual(1, LotModel(lot_id=3).get_level(400))
+
+    def test_routes_scoped_by_lot(self):
+        vehicle_mark = "Honda"
+        vehicle_number = "THR335"
+        basic_token = signed_token(vehicle_number, vehicle_mark)
+        lots[default_lot].occupancy.load([(1, False)])
+        lots[3].occupancy.load([(1, True), (2, True), (3, False)])
+        client = testapp.test_client()
+        self.assertEqual({"free": 2}, client.get("/lots/3/free_spots", headers={"Authorization": basic_token}).json)
+        self.assertEqual({"closest spot": 1}, client.get("/lots/3/next_free_spot", headers={"Authorization": basic_token}).json)
+        self.assertEqual({"free": 0}, client.get("/free_spots", headers={"Authorization": basic_token}).json)
+
+
+    def test_unknown_lot(self):
+        app = file_app()
+        with app.app_context():
+            db.create_all()
+            headers = {"Authorization": "Basic " + get_token("THR335", "Honda")["access_token"]}
+        client = app.test_client()
+        for response in (client.get("/lots/77/free_spots", headers=headers),
+                         client.put("/lots/77/parking/1", json={"vehicle_number": "THR335", "vehicle_mark": "Honda"},
+                                    headers=headers)):
+            self.assertEqual((404, {message: "There is no lot 77."}), (response.status_code, response.json))
+        self.assertNotIn(77, lots)
+
 
 class FreeSpots(TestCase):
 
-    @mock.patch('main.AuthorizationModel')
     @mock.patch('main.CarParkingModel')
-    def test_no_free_spots(self, car_parking_model, authorization_model):
+    def test_no_free_spots(self, car_parking_model):
         vehicle_mark = "Honda"
         vehicle_number = "THR335"
         free = 0
-        basic_token = "Basic " + base64.encodebytes(('%s:%s' % (vehicle_number, vehicle_mark)).encode('utf8')).decode(
-            'utf8').replace('\n', '')
-        expires_at = int(time.mktime((datetime.now() + timedelta(minutes=15)).timetuple()))
-        authorization_model.query.filter_by(access_token=basic_token).first.return_value = AuthorizationModel(
-            access_token=basic_token, expires_at=expires_at)
+        basic_token = signed_token(vehicle_number, vehicle_mark)
         expected = {"free": free}
-        car_parking_model.query.filter_by(parking_available=True).all.return_value = []
+        lots[default_lot].occupancy.load([(i, False) for i in range(1, 11)])
         with testapp.test_request_context(headers={"Authorization": basic_token}):
             result = free_spots()
         self.assertEqual(expected, result)
 
-    @mock.patch('main.AuthorizationModel')
     @mock.patch('main.CarParkingModel')
-    def test_free_spots_in_parking_lot(self, car_parking_model, authorization_model):
+    def test_free_spots_in_parking_lot(self, car_parking_model):
         vehicle_mark = "Honda"
         vehicle_number = "THR3351"
         free = 7
-        basic_token = "Basic " + base64.encodebytes(('%s:%s' % (vehicle_number, vehicle_mark)).encode('utf8')).decode(
-            'utf8').replace('\n', '')
-        expires_at = int(time.mktime((datetime.now() + timedelta(minutes=15)).timetuple()))
-        authorization_model.query.filter_by(access_token=basic_token).first.return_value = AuthorizationModel(
-            access_token=basic_token, expires_at=expires_at)
+        basic_token = signed_token(vehicle_number, vehicle_mark)
         expected = {"free": free}
-        car_parking_model.query.filter_by(parking_available=True).all.return_value = \
-            [CarParkingModel() for i in range(free)]
+        lots[default_lot].occupancy.load([(i, i > 10 - free) for i in range(1, 11)])
         with testapp.test_request_context(headers={"Authorization": basic_token}):
             result = free_spots()
         self.assertEqual(expected, result)
@@ -91,73 +654,623 @@ class FreeSpots(TestCase):
 
 class NextFreeSpot(TestCase):
 
-    @mock.patch('main.AuthorizationModel')
     @mock.patch('main.CarParkingModel')
-    def test_next_free_spot(self, car_parking_model, authorization_model):
+    def test_next_free_spot(self, car_parking_model):
         vehicle_mark = "Honda"
         vehicle_number = "THR3351"
         closest_spot = 8
-        basic_token = "Basic " + base64.encodebytes(('%s:%s' % (vehicle_number, vehicle_mark)).encode('utf8')).decode(
-            'utf8').replace('\n', '')
-        expires_at = int(time.mktime((datetime.now() + timedelta(minutes=15)).timetuple()))
-        authorization_model.query.filter_by(access_token=basic_token).first.return_value = AuthorizationModel(
-            access_token=basic_token, expires_at=expires_at)
+        basic_token = signed_token(vehicle_number, vehicle_mark)
         expected = {"closest spot": closest_spot}
-        car_parking_model.query.filter_by(parking_available=True).first.return_value = \
-            CarParkingModel(parking_spot=closest_spot)
+        lots[default_lot].occupancy.load([(i, i >= closest_spot) for i in range(1, 11)])
         with testapp.test_request_context(headers={"Authorization": basic_token}):
             result = next_free_spot()
         self.assertEqual(expected, result)
 
-    @mock.patch('main.AuthorizationModel')
     @mock.patch('main.CarParkingModel')
-    def test_no_next_free_spot(self, car_parking_model, authorization_model):
+    def test_no_next_free_spot(self, car_parking_model):
         vehicle_mark = "Honda"
         vehicle_number = "THR3351"
-        basic_token = "Basic " + base64.encodebytes(('%s:%s' % (vehicle_number, vehicle_mark)).encode('utf8')).decode(
-            'utf8').replace('\n', '')
-        expires_at = int(time.mktime((datetime.now() + timedelta(minutes=15)).timetuple()))
-        authorization_model.query.filter_by(access_token=basic_token).first.return_value = AuthorizationModel(
-            access_token=basic_token, expires_at=expires_at)
+        basic_token = signed_token(vehicle_number, vehicle_mark)
         expected = {message: "There are no free spots in a parking lot."}
-        car_parking_model.query.filter_by(parking_available=True).first.return_value = None
+        lots[default_lot].occupancy.load([(i, False) for i in range(1, 11)])
         with testapp.test_request_context(headers={"Authorization": basic_token}):
             result = next_free_spot()
         self.assertEqual(expected, result)
 
 
+class OccupancyEngine(TestCase):
+
+    def test_take_and_release(self):
+        engine = Occupancy()
+        engine.load([(1, True), (2, True), (3, False)])
+        self.assertEqual(2, engine.free_count())
+        self.assertEqual(1, engine.next_free())
+        engine.take(1)
+        engine.take(1)
+        self.assertEqual(1, engine.free_count())
+        self.assertEqual(2, engine.next_free())
+        engine.release(3)
+        self.assertEqual(2, engine.free_count())
+        engine.take(2)
+        engine.take(3)
+        self.assertEqual(0, engine.free_count())
+        self.assertIsNone(engine.next_free())
+
+    def test_mismatches(self):
+        engine = Occupancy()
+        engine.load([(1, True), (2, False), (3, True)])
+        self.assertEqual([], engine.mismatches([(1, True), (2, False), (3, True)]))
+        self.assertEqual([2, 3], engine.mismatches([(1, True), (2, True)]))
+
+    def test_mismatches_of_stored_rows(self):
+        # spot_rows() also has the layout and reservation columns.
+        app = file_app()
+        with app.app_context():
+            db.create_all()
+            provision_lot(3)
+            set_layout(2, 2, "ev", 5)
+            rows = spot_rows()
+            self.assertEqual(6, len(rows[0]))
+            occupancy = app.extensions["parking"].lots[1].occupancy
+            self.assertEqual([], occupancy.mismatches(rows))
+            occupancy.take(3)
+            self.assertEqual([3], occupancy.mismatches(rows))
+
+    @mock.patch('main.spot_rows')
+    def test_occupancy_check(self, spot_rows):
+        vehicle_mark = "Honda"
+        vehicle_number = "THR3351"
+        basic_token = signed_token(vehicle_number, vehicle_mark)
+        lots[default_lot].occupancy.load([(1, True), (2, False)])
+        spot_rows.return_value = [(1, False), (2, False)]
+        expected = {"consistent": False, "mismatched": [1]}
+        with testapp.test_request_context(headers={"Authorization": basic_token}):
+            result = occupancy_check()
+        self.assertEqual(expected, result)
+
+
+class Allocation(TestCase):
+
+    def layout(self):
+        # spot, available, level, spot_type, distance
+        return [(1, False, 1, "standard", 6), (2, True, 1, "ev", 5), (3, True, 1, "standard", 4),
+                (4, True, 2, "standard", 3), (5, True, 2, "disabled", None), (6, True, 2, "standard", 1)]
+
+    def test_policies(self):
+        engine = Occupancy()
+        engine.load(self.layout())
+        self.assertEqual(2, engine.next_free("lowest"))
+        self.assertEqual(6, engine.next_free("nearest"))
+        self.assertEqual(4, engine.next_free("balanced"))
+        self.assertEqual(2, engine.next_free("nearest", "ev"))
+        self.assertEqual(5, engine.next_free("lowest", "disabled"))
+        self.assertIsNone(engine.next_free("lowest", "compact"))
+        engine.take(6)
+        engine.take(4)
+        self.assertEqual(3, engine.next_free("nearest"))
+        self.assertEqual(2, engine.next_free("balanced"))
+        engine.take(2)
+        self.assertIsNone(engine.next_free("nearest", "ev"))
+        engine.release(2)
+        engine.release(6)
+        self.assertEqual(2, engine.next_free("nearest", "ev"))
+        self.assertEqual(6, engine.next_free("nearest"))
+
+    def test_indexes_follow_changes(self):
+        generator = random.Random(7)
+        spots = range(1, 301)
+        engine = Occupancy()
+        engine.load([(spot, True, (spot - 1) // 50 + 1, generator.choice(["standard", "ev"]), generator.randrange(100))
+                     for spot in spots])
+        expected = {
+            ("nearest", None): lambda free: min(free, key=lambda spot: (engine.distances[spot], spot)),
+            ("lowest", "ev"): lambda free: min(spot for spot in free if engine.types.get(spot) == "ev"),
+        }
+        for step in range(3000):
+            spot = generator.choice(spots)
+            if generator.random() < 0.6:
+                engine.take(spot)
+            else:
+                engine.release(spot)
+            free = [spot for spot in spots if engine.is_free(spot)]
+            for (policy, spot_type), pick in expected.items():
+                self.assertEqual(pick(free) if free else None, engine.next_free(policy, spot_type))
+            levels = {}
+            for spot in free:
+                levels[engine.levels[spot]] = levels.get(engine.levels[spot], 0) + 1
+            if levels:
+                level = max(levels, key=lambda level: (levels[level], -level))
+                self.assertEqual(min(spot for spot in free if engine.levels[spot] == level), engine.next_free("balanced"))
+        self.assertLess(len(engine.indexes[("nearest", None)].queue.heap), 2 * len(spots) + 65)
+
+    def test_unknown_types_get_no_index(self):
+        engine = Occupancy()
+        engine.load(self.layout())
+        self.assertTrue(engine.has_type("standard"))
+        self.assertTrue(engine.has_type("ev"))
+        self.assertFalse(engine.has_type("compact"))
+        for spot_type in ("compact", "junk-1", "junk-2"):
+            self.assertIsNone(engine.next_free("nearest", spot_type))
+        self.assertEqual(2, engine.next_free("nearest", "ev"))
+        self.assertEqual([("nearest", "ev")], list(engine.indexes))
+
+    def test_unknown_policy(self):
+        with testapp.app_context():
+            basic_token = "Basic " + get_token("THR335", "Honda")["access_token"]
+        with testapp.test_request_context("/next_free_spot?policy=random", headers={"Authorization": basic_token}):
+            result = next_free_spot()
+        self.assertEqual({message: "Unknown allocation policy random, use one of lowest, nearest, balanced."}, result)
+
+    def test_layout_in_journal(self):
+        snapshot = LotSnapshot()
+        snapshot.apply(size_event(4, None))
+        snapshot.apply(layout_event(2, 3, "ev", 10, 5))
+        snapshot.apply(layout_event(3, 9, None, 1, 0))
+        restored = LotSnapshot.from_record(snapshot.to_record(1))
+        self.assertEqual([("standard", None), ("ev", 10), ("ev", 1), ("standard", 1)],
+                         [(row["spot_type"], row["distance"]) for row in restored.rows()])
+
+
+class SessionHistory(TestCase):
+
+    def test_occupancy_buckets(self):
+        rows = [(3600, 2, 0), (7200, 1, 1), (14400, 0, 2)]
+        self.assertEqual([{"start": 0, "arrivals": 2, "departures": 0, "occupied": 3},
+                          {"start": 7200, "arrivals": 1, "departures": 1, "occupied": 3}],
+                         occupancy_buckets(1, rows, 0, 14400, 7200))
+        self.assertEqual([1, 3, 3, 3, 1], [bucket["occupied"] for bucket in occupancy_buckets(1, rows, 0, 18000, 3600)])
+
+    def test_peak_hours(self):
+        day = 24 * 3600
+        buckets = [{"start": 9 * 3600, "arrivals": 4, "departures": 0, "occupied": 10},
+                   {"start": 10 * 3600, "arrivals": 1, "departures": 0, "occupied": 11},
+                   {"start": day + 9 * 3600, "arrivals": 2, "departures": 0, "occupied": 14},
+                   {"start": day + 10 * 3600, "arrivals": 0, "departures": 6, "occupied": 8}]
+        self.assertEqual([{"hour": 9, "average occupied": 12.0, "average arrivals": 3.0}],
+                         peak_hours(buckets, 1))
+        self.assertEqual([9, 10], [peak["hour"] for peak in peak_hours(buckets, 5)])
+
+    def test_report_window(self):
+        self.assertEqual((3600 * 9, 3600 * 12), report_window({"to": "43000"}, 0, 7200))
+        self.assertEqual((0, 3600), report_window({"from": "10", "to": "3600"}, 99999, 7200))
+
+    def test_numbers_in_query_are_checked(self):
+        app = file_app()
+        with app.app_context():
+            db.create_all()
+            provision_lot(2)
+            headers = {"Authorization": "Basic " + get_token("RPT001", "Honda")["access_token"]}
+        client = app.test_client()
+        for path, name in (("/occupancy_history?from=yesterday", "from"), ("/dwell_time?to=now", "to"),
+                           ("/peak_hours?top=x", "top"), ("/occupancy_history?bucket=day", "bucket"),
+                           ("/sessions/RPT001?limit=all", "limit"), ("/get_all?after=x", "after")):
+            response = client.get(path, headers=headers)
+            self.assertEqual((200, {message: f"{name} must be a whole number."}), (response.status_code, response.json))
+        self.assertEqual(2, len(client.get("/peak_hours?top=2", headers=headers).json["peak hours"]))
+
+    def test_statements_keep_event_order(self):
+        events = [leave_event(5), park_event(5, "A", "a"), park_event(6, "B", "b"), move_event(6, 7, "B", "c")]
+        statements = list(session_statements(1, events, 100))
+        self.assertEqual(["leave", "park", "move"], [kind for kind, statement, rows in statements])
+        self.assertEqual([5, 6], [row["parking_spot"] for row in statements[1][2]])
+
+    def test_record_sessions_rolls_up(self):
+        connection = mock.Mock()
+        connection.execute().scalars().all.return_value = [100, 250]
+        connection.execute().rowcount = 0
+        connection.execute.reset_mock()
+        record_sessions(connection, 1, [leave_event(1), leave_event(2), park_event(3, "A", "a")], 7300)
+        rollup = connection.execute.call_args_list[-1].args[0].compile().params
+        self.assertEqual({"lot_id": 1, "hour": 7200, "arrivals": 1, "departures": 2, "dwell_seconds": 14250}, rollup)
+
+
+class GroupCommits(TestCase):
+
+    def test_concurrent_writes_share_a_commit(self):
+        groups = []
+
+        def run(operations):
+            groups.append(len(operations))
+            return [(True, operation()) for operation in operations]
+        writer = GroupCommit()
+        writer.start(run, 0.5, 3)
+        results = []
+        threads = [threading.Thread(target=lambda i=i: results.append(writer.submit(lambda: i))) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([3], groups)
+        self.assertEqual([0, 1, 2], sorted(results))
+
+    def test_errors_reach_their_request(self):
+        failures = iter([None, RuntimeError("disk full")])
+
+        def run(operations):
+            failure = next(failures)
+            if failure:
+                raise failure
+            return [(False, IntegrityError("insert", {}, None))]
+        writer = GroupCommit()
+        writer.start(run, 0, 1)
+        with self.assertRaises(IntegrityError):
+            writer.submit(lambda: None)
+        with self.assertRaisesRegex(RuntimeError, "disk full"):
+            writer.submit(lambda: None)
+
+    @mock.patch('main.commit_version')
+    @mock.patch('main.db')
+    def test_failed_operation_is_rolled_back_alone(self, db, commit_version):
+        savepoints = [mock.Mock(), mock.Mock()]
+        db.session.begin_nested.side_effect = savepoints
+        db.session.execute().scalar.return_value = 8
+
+        def duplicate():
+            raise IntegrityError("update", {}, None)
+        with testapp.app_context():
+            outcomes = commit_group([duplicate, lambda: (True, [park_event(1, "A", "a")])])
+        self.assertIsInstance(outcomes[0][1], IntegrityError)
+        self.assertEqual((True, True), outcomes[1])
+        savepoints[0].rollback.assert_called_once()
+        savepoints[1].commit.assert_called_once()
+        commit_version.assert_called_once_with(1, 8, [park_event(1, "A", "a")])
+
+
+class Reservations(TestCase):
+
+    def test_holds_expire_in_order(self):
+        engine = Occupancy()
+        engine.load([(1, True), (2, True), (3, True)])
+        engine.hold(1, 200)
+        engine.hold(2, 100)
+        self.assertEqual(3, engine.next_free())
+        self.assertEqual(100, engine.next_expiry())
+        self.assertEqual([], engine.expire(99))
+        self.assertEqual([2], engine.expire(150))
+        self.assertEqual(100, engine.expired_through)
+        self.assertEqual(200, engine.next_expiry())
+        self.assertEqual(2, engine.next_free())
+
+    def test_taken_or_cancelled_holds_do_not_expire(self):
+        engine = Occupancy()
+        engine.load([(1, True), (2, True)])
+        engine.hold(1, 100)
+        engine.hold(2, 100)
+        engine.take(1)
+        engine.release(2)
+        self.assertIsNone(engine.next_expiry())
+        self.assertEqual([], engine.expire(200))
+        self.assertEqual(1, engine.free_count())
+
+    def test_load_skips_lapsed_holds(self):
+        engine = Occupancy()
+        engine.load([(1, True, 1, "standard", 0, 50), (2, True, 1, "standard", 0, 500), (3, False, 1, "standard", 0, None)],
+                    now=100)
+        self.assertEqual(1, engine.free_count())
+        self.assertEqual(1, engine.next_free())
+        self.assertEqual(500, engine.next_expiry())
+        self.assertEqual([], engine.mismatches([(1, True, 1, "standard", 0, 50), (2, True, 1, "standard", 0, 500),
+                                                (3, False, 1, "standard", 0, None)], now=100))
+
+    def test_scheduler_runs_due_calls_in_order(self):
+        scheduler = Scheduler()
+        calls = []
+        done = threading.Event()
+        now = time.time()
+        scheduler.call_at(now + 0.2, lambda: (calls.append("late"), done.set()))
+        scheduler.call_at(now + 0.1, lambda: calls.append("early"))
+        scheduler.call_at(now, lambda: 1 / 0)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(["early", "late"], calls)
+        self.assertEqual(0, scheduler.pending())
+
+    def test_ttl_must_be_a_whole_number(self):
+        app = file_app()
+        with app.app_context():
+            db.create_all()
+            provision_lot(2)
+            headers = {"Authorization": "Basic " + get_token("RSV001", "Honda")["access_token"]}
+        client = app.test_client()
+        for ttl in ("soon", 1.5, [60], True, None):
+            response = client.put("/reserve/1", json={"vehicle_number": "RSV001", "ttl": ttl}, headers=headers)
+            self.assertEqual((200, {message: "ttl must be a whole number."}), (response.status_code, response.json))
+        self.assertEqual(1, client.put("/reserve/1", json={"vehicle_number": "RSV001", "ttl": "60"},
+                                       headers=headers).json["reserved spot"])
+
+    def test_held_spot_is_not_free_on_its_level(self):
+        app = file_app()
+        with app.app_context():
+            db.create_all()
+            provision_lot(3)
+            headers = {"Authorization": "Basic " + get_token("RSV002", "Honda")["access_token"]}
+        client = app.test_client()
+        client.put("/reserve/1", json={"vehicle_number": "RSV002"}, headers=headers)
+        self.assertEqual({"free": 2}, client.get("/free_spots", headers=headers).json)
+        self.assertEqual({"1": {"spots": 3, "free": 2}}, client.get("/levels", headers=headers).json)
+
+    def test_scheduler_expires_holds_of_its_app(self):
+        app = file_app()
+        lot = app.extensions["parking"].lots[default_lot]
+        lot.occupancy.load([(1, True)])
+        with app.app_context():
+            spots_committed(default_lot, 1, [reserve_event(1, "AAA111", time.time() + 0.1)])
+        self.assertEqual(0, lot.occupancy.free_count())
+        deadline = time.time() + 5
+        while not lot.occupancy.free_count() and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(1, lot.occupancy.free_count())
+
+    def test_snapshot_keeps_holds(self):
+        snapshot = LotSnapshot()
+        for event in [size_event(3, None), reserve_event(1, "AAA111", 500), reserve_event(2, "BBB222", 500),
+                      park_event(1, "AAA111", "Honda"), cancel_event(2), reserve_event(3, "CCC333", 600)]:
+            snapshot.apply(event)
+        restored = LotSnapshot.from_record(snapshot.to_record(1))
+        self.assertEqual({3: ("CCC333", 600)}, restored.holds)
+
+
+class SharedState(TestCase):
+
+    def test_shared_version(self):
+        tracker = SharedVersion()
+        self.assertTrue(tracker.due(1.0, 10.0))
+        self.assertFalse(tracker.due(1.0, 10.5))
+        self.assertFalse(tracker.observe(3))
+        self.assertTrue(tracker.observe(3))
+        tracker.advance(4)
+        self.assertTrue(tracker.observe(4))
+        tracker.advance(6)
+        self.assertTrue(tracker.waiting())
+        self.assertFalse(tracker.observe(6))
+        self.assertFalse(tracker.waiting())
+
+    @mock.patch('main.db')
+    def test_refresh_reloads_after_foreign_write(self, db):
+        lots[default_lot].version.reset()
+        lots[default_lot].occupancy.load([(1, True)])
+        db.session.execute().scalar.return_value = 7
+        with testapp.app_context(), mock.patch.dict(testapp.config, {'SHARED_STATE_CHECK_INTERVAL': 0}):
+            refresh_shared_state()
+            self.assertFalse(lots[default_lot].occupancy.loaded)
+            lots[default_lot].occupancy.load([(1, True)])
+            refresh_shared_state()
+            self.assertTrue(lots[default_lot].occupancy.loaded)
+            db.session.execute().scalar.return_value = 8
+            refresh_shared_state()
+        self.assertFalse(lots[default_lot].occupancy.loaded)
+
+    def test_own_commits_after_a_foreign_write(self):
+        # Without PARKING_SHARED_STATE_CHECK, as python main.py and uvicorn run.
+        server = file_app()
+        with server.app_context():
+            db.create_all()
+            provision_lot(10)
+            headers = {"Authorization": "Basic " + get_token("SHR001", "Honda")["access_token"]}
+        client = server.test_client()
+        self.assertEqual({"free": 10}, client.get("/free_spots", headers=headers).json)
+        cli = create_app({'SQLALCHEMY_DATABASE_URI': server.config['SQLALCHEMY_DATABASE_URI'], 'JOURNAL_PATH': None,
+                          'SECRET_KEY': 'test-key'})
+        with cli.app_context():
+            set_layout(9, 10, "ev")
+        for spot in (1, 2, 3):
+            client.put(f"/parking/{spot}", json={"vehicle_number": f"SHR00{spot}", "vehicle_mark": "Honda"},
+                       headers=headers)
+        self.assertEqual({"free": 7}, client.get("/free_spots", headers=headers).json)
+        self.assertEqual({"closest spot": 4}, client.get("/next_free_spot", headers=headers).json)
+        self.assertEqual({"consistent": True, "mismatched": []},
+                         client.get("/occupancy_check", headers=headers).json)
+
+    def test_after_fork(self):
+        lots[default_lot].occupancy.load([(1, True)])
+        lots[default_lot].version.observe(5)
+        after_fork(testapp)
+        self.assertFalse(lots[default_lot].occupancy.loaded)
+        self.assertIsNone(lots[default_lot].version.seen)
+
+
+class ConditionalReads(TestCase):
+
+    def test_out_of_order_commits(self):
+        tracker = SharedVersion(ahead_limit=2)
+        tracker.observe(5)
+        self.assertTrue(tracker.advance(7))
+        self.assertEqual(5, tracker.seen)
+        self.assertIsNone(tracker.current())
+        tracker.advance(6)
+        self.assertEqual(7, tracker.current())
+        tracker.advance(9)
+        tracker.advance(10)
+        self.assertFalse(tracker.advance(11))
+        self.assertIsNone(tracker.seen)
+
+    def test_commits_reach_the_maps_in_order(self):
+        lot = lots[5]
+        lot.occupancy.load([(1, True)])
+        lot.version.observe(4)
+        with testapp.app_context():
+            spots_committed(5, 6, [leave_event(1)])
+            self.assertIsNone(lot.version.current())
+            spots_committed(5, 5, [park_event(1, "AAA111", "Honda")])
+            self.assertEqual((True, 6), (lot.occupancy.is_free(1), lot.version.current()))
+            # Maps loaded at version 8 already have the commit of version 7.
+            lot.version.observe(8, lambda: lot.occupancy.load([(1, True)]))
+            spots_committed(5, 7, [park_event(1, "BBB222", "Audi")])
+        self.assertEqual((True, 8), (lot.occupancy.is_free(1), lot.version.current()))
+
+    def test_not_modified(self):
+        vehicle_mark = "Honda"
+        vehicle_number = "THR335"
+        basic_token = signed_token(vehicle_number, vehicle_mark)
+        lots[4].occupancy.load([(1, True), (2, True)])
+        lots[4].version.observe(3)
+        client = testapp.test_client()
+        response = client.get("/lots/4/free_spots", headers={"Authorization": basic_token})
+        self.assertEqual('"4-3"', response.headers["ETag"])
+        self.assertEqual("Authorization", response.headers["Vary"])
+        cached = client.get("/lots/4/free_spots", headers={"Authorization": basic_token, "If-None-Match": '"4-3"'})
+        self.assertEqual(304, cached.status_code)
+        self.assertEqual(b"", cached.data)
+        with testapp.app_context():
+            spots_committed(4, 4, [park_event(1, vehicle_number, vehicle_mark)])
+        response = client.get("/lots/4/free_spots", headers={"Authorization": basic_token, "If-None-Match": '"4-3"'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({"free": 1}, response.json)
+        self.assertEqual('"4-4"', response.headers["ETag"])
+
+
+class LiveFeed(TestCase):
+
+    def test_bursts_are_coalesced(self):
+        engine = Occupancy()
+        engine.load([(1, True), (2, True), (3, True)])
+        feed = OccupancyFeed(engine)
+        feed.publish(1, False)
+        self.assertEqual({}, feed.pending)
+        feed.attach()
+        engine.take(1)
+        feed.publish(1, False)
+        engine.take(2)
+        feed.publish(2, False)
+        engine.release(2)
+        feed.publish(2, True)
+        feed._seal()
+        chunks, last_seq = feed.since(0)
+        self.assertEqual(1, last_seq)
+        self.assertEqual(['id: 1\nevent: delta\ndata: {"free":2,"closest spot":2,"changed":{"1":false,"2":true}}\n\n'],
+                         chunks)
+        self.assertEqual(([], 1), feed.since(1))
+
+    def test_resync_with_snapshot(self):
+        engine = Occupancy()
+        engine.load([(1, True), (2, False)])
+        feed = OccupancyFeed(engine, history=2)
+        feed.attach()
+        for spot in (3, 4, 5):
+            feed.publish(spot, True)
+            feed._seal()
+        chunks, last_seq = feed.since(0)
+        self.assertEqual(['id: 3\nevent: snapshot\ndata: {"free":1,"closest spot":1,"free spots":[1]}\n\n'], chunks)
+        self.assertEqual(3, last_seq)
+        chunks, last_seq = feed.since(1)
+        self.assertEqual(["id: 2", "id: 3"], [chunk.splitlines()[0] for chunk in chunks])
+
+    def test_failing_listener_and_poll_keep_the_feed_running(self):
+        engine = Occupancy()
+        engine.load([(1, True)])
+        feed = OccupancyFeed(engine, coalesce=0)
+        woken = []
+
+        def broken():
+            raise RuntimeError("event loop is closed")
+        feed.add_listener(broken)
+        feed.add_listener(lambda: woken.append(True))
+        polls = []
+
+        def poll():
+            polls.append(True)
+            raise RuntimeError("database is locked")
+        feed.attach()
+        feed.start(poll_interval=0.01, poll=poll)
+        feed.publish(1, False)
+        deadline = time.time() + 5
+        while (not woken or len(polls) < 2) and time.time() < deadline:
+            time.sleep(0.01)
+        feed.detach()
+        self.assertEqual((1, [True]), (feed.seq, woken))
+        self.assertTrue(feed.thread.is_alive())
+
+    def test_dead_thread_is_restarted(self):
+        feed = OccupancyFeed(Occupancy())
+        feed.thread = threading.Thread(target=lambda: None)
+        feed.thread.start()
+        feed.thread.join()
+        feed.start()
+        self.assertTrue(feed.thread.is_alive())
+
+    def test_occupancy_changes(self):
+        engine = Occupancy()
+        engine.load([(1, True), (2, False)])
+        before = engine.copy()
+        engine.take(1)
+        engine.release(4)
+        self.assertEqual([(1, False), (4, True)], engine.changes(before))
+
+    def test_wsgi_streams_are_capped(self):
+        app = file_app({'FEED_STREAMS': 1})
+        with app.app_context():
+            db.create_all()
+            provision_lot(2)
+            headers = {"Authorization": "Basic " + get_token("FED001", "Honda")["access_token"]}
+        client = app.test_client()
+        first = client.get("/occupancy_feed", headers=headers, buffered=False)
+        self.assertEqual(200, first.status_code)
+        refused = client.get("/occupancy_feed", headers=headers)
+        self.assertEqual(503, refused.status_code)
+        self.assertEqual({message: "This server keeps at most 1 live feeds open, use the async server "
+                                   "(uvicorn asgi:app) for more."}, refused.json)
+        first.close()
+        second = client.get("/occupancy_feed", headers=headers, buffered=False)
+        self.assertEqual(200, second.status_code)
+        second.close()
+
+
+class VehicleLookup(TestCase):
+
+    def test_vehicle_index(self):
+        index = VehicleIndex()
+        index.load([(1, "AAA111"), (2, "BBB222")])
+        self.assertEqual(2, index.spot_of("BBB222"))
+        index.leave(2)
+        self.assertIsNone(index.spot_of("BBB222"))
+        index.leave(1)
+        index.park(5, "AAA111")
+        self.assertEqual(5, index.spot_of("AAA111"))
+
+    @mock.patch('main.get_vehicle_index')
+    def test_get_parking_spot_from_index(self, vehicle_index):
+        vehicle_mark = "Honda"
+        vehicle_number = 'THR334'
+        basic_token = signed_token(vehicle_number, vehicle_mark)
+        vehicle_index.return_value.spot_of.return_value = 4
+        with mock.patch.dict(testapp.config, {'VEHICLE_INDEX': True}):
+            with testapp.test_request_context(headers={"Authorization": basic_token}):
+                result = get_parking_spot(vehicle_number)
+        self.assertEqual({vehicle_number: 4}, result)
+
+    @mock.patch('main.db')
+    def test_parking_already_parked(self, db):
+        vehicle_mark = "Honda"
+        vehicle_number = 'THR334'
+        basic_token = signed_token(vehicle_number, vehicle_mark)
+        db.session.execute.side_effect = IntegrityError("UPDATE", {}, Exception())
+        expected = {message: "Car THR445 is already parked."}
+        with testapp.test_request_context(json={"vehicle_number": "THR445", "vehicle_mark": "Honda"}, headers={"Authorization": basic_token}):
+            result = parking(2)
+        self.assertEqual(expected, result)
+        db.session.rollback.assert_called_once()
+
+
 class GetParkingSpot(TestCase):
 
-    @mock.patch('main.AuthorizationModel')
-    @mock.patch('main.CarParkingModel')
-    def test_get_parking_spot_fail(self, car_parking_model, authorization_model):
+    @mock.patch('main.db')
+    def test_get_parking_spot_fail(self, db):
         vehicle_mark = "Honda"
         vehicle_number = 'THR334'
-        basic_token = "Basic " + base64.encodebytes(('%s:%s' % (vehicle_number, vehicle_mark)).encode('utf8')).decode(
-            'utf8').replace('\n', '')
-        expires_at = int(time.mktime((datetime.now() + timedelta(minutes=15)).timetuple()))
-        authorization_model.query.filter_by(access_token=basic_token).first.return_value = AuthorizationModel(
-            access_token=basic_token, expires_at=expires_at)
+        basic_token = signed_token(vehicle_number, vehicle_mark)
         expected = {message: "There is no car with this vehicle number in a parking lot."}
-        car_parking_model.query.filter_by(vehicle_number=vehicle_number).first.return_value = None
+        db.session.execute().scalar.return_value = None
         with testapp.test_request_context(headers={"Authorization": basic_token}):
             result = get_parking_spot(vehicle_number)
         self.assertEqual(expected, result)
 
-    @mock.patch('main.AuthorizationModel')
-    @mock.patch('main.CarParkingModel')
-    def test_get_parking_spot_success(self, car_parking_model, authorization_model):
+    @mock.patch('main.db')
+    def test_get_parking_spot_success(self, db):
         vehicle_mark = "Honda"
         vehicle_number = 'THR334'
         parking_spot = 5
-        basic_token = "Basic " + base64.encodebytes(('%s:%s' % (vehicle_number, vehicle_mark)).encode('utf8')).decode(
-            'utf8').replace('\n', '')
-        expires_at = int(time.mktime((datetime.now() + timedelta(minutes=15)).timetuple()))
-        authorization_model.query.filter_by(access_token=basic_token).first.return_value = AuthorizationModel(
-            access_token=basic_token, expires_at=expires_at)
+        basic_token = signed_token(vehicle_number, vehicle_mark)
         expected = {vehicle_number: parking_spot}
-        car_parking_model.query.filter_by(vehicle_number=vehicle_number).first.return_value = \
-            CarParkingModel(parking_spot=parking_spot, vehicle_number=vehicle_number)
+        db.session.execute().scalar.return_value = parking_spot
         with testapp.test_request_context(headers={"Authorization": basic_token}):
             result = get_parking_spot(vehicle_number)
         self.assertEqual(expected, result)
@@ -165,117 +1278,207 @@ class GetParkingSpot(TestCase):
 
 class GetAll(TestCase):
 
-    @mock.patch('main.AuthorizationModel')
-    @mock.patch('main.CarParkingModel')
-    def test_get_all_no_cars(self, car_parking_model, authorization_model):
+    @mock.patch('main.db')
+    def test_get_all_no_cars(self, db):
         vehicle_mark = "Honda"
         vehicle_number = 'THR334'
-        basic_token = "Basic " + base64.encodebytes(('%s:%s' % (vehicle_number, vehicle_mark)).encode('utf8')).decode(
-            'utf8').replace('\n', '')
-        expires_at = int(time.mktime((datetime.now() + timedelta(minutes=15)).timetuple()))
-        authorization_model.query.filter_by(access_token=basic_token).first.return_value = AuthorizationModel(
-            access_token=basic_token, expires_at=expires_at)
+        basic_token = signed_token(vehicle_number, vehicle_mark)
         expected = {message: "There are no cars parked in this parking lot."}
-        car_parking_model.query.filter_by(parking_available=False).all.return_value = []
+        db.session.execute().all.return_value = []
         with testapp.test_request_context(headers={"Authorization": basic_token}):
             result = get_all()
         self.assertEqual(expected, result)
 
-    @mock.patch('main.AuthorizationModel')
-    @mock.patch('main.CarParkingModel')
-    def test_get_all_cars_and_spots(self, car_parking_model, authorization_model):
+    @mock.patch('main.db')
+    def test_get_all_cars_and_spots(self, db):
         vehicle_mark = "Honda"
         vehicle_number = 'THR334'
         parking_spot = 5
-        basic_token = "Basic " + base64.encodebytes(('%s:%s' % (vehicle_number, vehicle_mark)).encode('utf8')).decode(
-            'utf8').replace('\n', '')
-        expires_at = int(time.mktime((datetime.now() + timedelta(minutes=15)).timetuple()))
-        authorization_model.query.filter_by(access_token=basic_token).first.return_value = AuthorizationModel(
-            access_token=basic_token, expires_at=expires_at)
+        basic_token = signed_token(vehicle_number, vehicle_mark)
         expected = {parking_spot: vehicle_number, parking_spot+1: vehicle_number+"1"}
-        car_parking_model.query.filter_by(parking_available=False).all.return_value = [
-            CarParkingModel(parking_spot=parking_spot, vehicle_number=vehicle_number),
-            CarParkingModel(parking_spot=parking_spot+1, vehicle_number=vehicle_number+"1")
-        ]
+        db.session.execute().all.return_value = [(parking_spot, vehicle_number), (parking_spot+1, vehicle_number+"1")]
         with testapp.test_request_context(headers={"Authorization": basic_token}):
             result = get_all()
         self.assertEqual(expected, result)
 
 
+class GetAllPaged(TestCase):
+
+    def setUp(self):
+        vehicle_mark = "Honda"
+        vehicle_number = 'THR334'
+        self.basic_token = signed_token(vehicle_number, vehicle_mark)
+
+    @mock.patch('main.db')
+    def test_get_all_page(self, db):
+        db.session.execute().all.return_value = [(3, "AAA111"), (7, "BBB222")]
+        expected = {"cars": {3: "AAA111", 7: "BBB222"}, "next": 7}
+        with testapp.test_request_context(query_string={"after": 2, "limit": 2}, headers={"Authorization": self.basic_token}):
+            result = get_all()
+        self.assertEqual(expected, result)
+
+    @mock.patch('main.db')
+    def test_get_all_last_page(self, db):
+        db.session.execute().all.return_value = [(9, "CCC333")]
+        expected = {"cars": {9: "CCC333"}, "next": None}
+        with testapp.test_request_context(query_string={"after": 7, "limit": 2}, headers={"Authorization": self.basic_token}):
+            result = get_all()
+        self.assertEqual(expected, result)
+
+    @mock.patch('main.db')
+    def test_get_all_ndjson(self, db):
+        db.session.execute.return_value = iter([(3, "AAA111"), (7, "BBB222")])
+        expected = b'{"spot":3,"vehicle_number":"AAA111"}\n{"spot":7,"vehicle_number":"BBB222"}\n'
+        with testapp.test_request_context(query_string={"format": "ndjson"}, headers={"Authorization": self.basic_token}):
+            response = get_all()
+            self.assertEqual("application/x-ndjson", response.mimetype)
+            self.assertEqual(expected, response.get_data())
+
+    @mock.patch('main.db')
+    def test_get_all_columnar(self, db):
+        db.session.execute().all.return_value = [(3, "AAA111"), (7, "BBB222")]
+        expected = {"spots": [3, 7], "vehicle_numbers": ["AAA111", "BBB222"]}
+        with testapp.test_request_context(query_string={"format": "columnar"}, headers={"Authorization": self.basic_token}):
+            result = get_all()
+        self.assertEqual(expected, result)
+
+
+class ConcurrentParking(TestCase):
+
+    def test_no_double_booking(self):
+        app = file_app()
+        with app.app_context():
+            db.create_all()
+            provision_lot(1)
+            token = "Basic " + get_token("R0", "test-mark")["access_token"]
+        workers = 16
+        barrier = threading.Barrier(workers)
+        responses = [None] * workers
+
+        def park(i):
+            client = app.test_client()
+            barrier.wait()
+            responses[i] = client.put("/parking/1", json={"vehicle_number": f"R{i}", "vehicle_mark": "test-mark"},
+                                      headers={"Authorization": token}).json
+        threads = [threading.Thread(target=park, args=(i,)) for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        winners = [i for i, response in enumerate(responses) if response == {"parking spot": 1}]
+        self.assertEqual(1, len(winners))
+        for i, response in enumerate(responses):
+            if i not in winners:
+                self.assertEqual({message: "This spot is not available!"}, response)
+        with app.app_context():
+            spot = CarParkingModel.query.filter_by(parking_spot=1).one()
+            self.assertEqual((f"R{winners[0]}", False), (spot.get_number(), spot.get_available()))
+
+
 class Parking(TestCase):
 
-    @mock.patch('main.CarParkingModel')
-    @mock.patch('main.AuthorizationModel')
+    def setUp(self):
+        untrack_versions()
+
     @mock.patch('main.db')
-    def test_parking_success(self, car_parking_model,authorization_model, db):
+    def test_parking_success(self, db):
         vehicle_mark = "Honda"
         vehicle_number = 'THR334'
         spot_number = 3
-        basic_token = "Basic " + base64.encodebytes(('%s:%s' % (vehicle_number, vehicle_mark)).encode('utf8')).decode(
-            'utf8').replace('\n', '')
-        expires_at = int(time.mktime((datetime.now() + timedelta(minutes=15)).timetuple()))
-        authorization_model.query.filter_by(access_token=basic_token).first.return_value = AuthorizationModel(
-            access_token=basic_token, expires_at=expires_at)
+        basic_token = signed_token(vehicle_number, vehicle_mark)
         expected = {"parking spot": spot_number}
-        car_parking_model.query.filter_by(parking_spot=spot_number).first.return_value = CarParkingModel(
-            parking_spot=spot_number, parking_available=True)
+        db.session.execute().rowcount = 1
         with testapp.test_request_context(json={"vehicle_number": "THR445", "vehicle_mark": "Honda"}, headers={"Authorization": basic_token}):
             result = parking(spot_number)
         self.assertEqual(expected, result)
+        db.session.commit.assert_called_once()
 
-    @mock.patch('main.AuthorizationModel')
-    @mock.patch('main.CarParkingModel')
-    def test_parking_fail(self, car_parking_model,authorization_model):
+    @mock.patch('main.db')
+    def test_parking_fail(self, db):
         vehicle_mark = "Honda"
         vehicle_number = 'THR334'
         spot_number = 2
-        basic_token = "Basic " + base64.encodebytes(('%s:%s' % (vehicle_number, vehicle_mark)).encode('utf8')).decode(
-            'utf8').replace('\n', '')
-        expires_at = int(time.mktime((datetime.now() + timedelta(minutes=15)).timetuple()))
-        authorization_model.query.filter_by(access_token=basic_token).first.return_value = AuthorizationModel(
-            access_token=basic_token, expires_at=expires_at)
+        basic_token = signed_token(vehicle_number, vehicle_mark)
         expected = {message: "This spot is not available!"}
-        car_parking_model.query.filter_by(parking_spot=spot_number).first.return_value = CarParkingModel(parking_spot=spot_number, parking_available=False)
-        with testapp.test_request_context(headers={"Authorization": basic_token}):
+        db.session.execute().rowcount = 0
+        with testapp.test_request_context(json={"vehicle_number": "THR445", "vehicle_mark": "Honda"}, headers={"Authorization": basic_token}):
             result = parking(spot_number)
         self.assertEqual(expected, result)
+        db.session.commit.assert_not_called()
+
+
+class Batches(TestCase):
+
+    def setUp(self):
+        untrack_versions()
+        vehicle_mark = "Honda"
+        vehicle_number = 'THR334'
+        self.basic_token = signed_token(vehicle_number, vehicle_mark)
+
+    @mock.patch('main.occupy_spot')
+    @mock.patch('main.db')
+    def test_parking_batch(self, db, occupy_spot):
+        occupy_spot.side_effect = [1, 0, 0]
+        body = [
+            {"spot": 1, "vehicle_number": "AAA111", "vehicle_mark": "Honda"},
+            {"spot": 2, "vehicle_number": "BBB222", "vehicle_mark": "Audi"},
+            {"spot": 1, "vehicle_number": "CCC333", "vehicle_mark": "Opel"},
+        ]
+        expected = {"results": [
+            {"parking spot": 1},
+            {message: "This spot is not available!"},
+            {message: "This spot is not available!"},
+        ]}
+        with testapp.test_request_context(json=body, headers={"Authorization": self.basic_token}):
+            result = parking_batch()
+        self.assertEqual(expected, result)
+        self.assertEqual(1, db.session.commit.call_count)
+
+    @mock.patch('main.vacate_spot')
+    @mock.patch('main.db')
+    def test_leave_batch(self, db, vacate_spot):
+        vacate_spot.side_effect = [1, 0]
+        expected = {"results": [
+            {"message": "spot 1 is available"},
+            {message: "There is no car parked in this spot."},
+        ]}
+        with testapp.test_request_context(json=[1, 2], headers={"Authorization": self.basic_token}):
+            result = leave_batch()
+        self.assertEqual(expected, result)
+        self.assertEqual(1, db.session.commit.call_count)
+
+    def test_batch_size_limit(self):
+        expected = {message: "Batch is limited to 500 items."}
+        with testapp.test_request_context(json=list(range(501)), headers={"Authorization": self.basic_token}):
+            result = leave_batch()
+        self.assertEqual(expected, result)
 
 
 class Leave(TestCase):
 
-    @mock.patch('main.AuthorizationModel')
-    @mock.patch('main.CarParkingModel')
-    def test_leave_fail(self, car_parking_model, authorization_model):
+    def setUp(self):
+        untrack_versions()
+
+    @mock.patch('main.db')
+    def test_leave_fail(self, db):
         vehicle_mark = "Honda"
         vehicle_number = 'THR334'
         spot_number = 3
-        basic_token = "Basic " + base64.encodebytes(('%s:%s' % (vehicle_number, vehicle_mark)).encode('utf8')).decode(
-            'utf8').replace('\n', '')
-        expires_at = int(time.mktime((datetime.now() + timedelta(minutes=15)).timetuple()))
-        authorization_model.query.filter_by(access_token=basic_token).first.return_value = AuthorizationModel(
-            access_token=basic_token, expires_at=expires_at)
+        basic_token = signed_token(vehicle_number, vehicle_mark)
         expected = {message: "There is no car parked in this spot."}
-        car_parking_model.query.filter_by(parking_spot=spot_number, parking_available=False).first.return_value = \
-            CarParkingModel(parking_spot=spot_number, parking_available=True)
+        db.session.execute().rowcount = 0
         with testapp.test_request_context(headers={"Authorization": basic_token}):
             result = leave(spot_number)
         self.assertEqual(expected, result)
 
     @mock.patch('main.db')
-    @mock.patch('main.AuthorizationModel')
-    @mock.patch('main.CarParkingModel')
-    def test_leave_success(self, car_parking_model, authorization_model, db):
+    def test_leave_success(self, db):
         vehicle_mark = "Honda"
         vehicle_number = 'THR334'
         spot_number = 3
-        basic_token = "Basic " + base64.encodebytes(('%s:%s' % (vehicle_number, vehicle_mark)).encode('utf8')).decode(
-            'utf8').replace('\n', '')
-        expires_at = int(time.mktime((datetime.now() + timedelta(minutes=15)).timetuple()))
-        authorization_model.query.filter_by(access_token=basic_token).first.return_value = AuthorizationModel(
-            access_token=basic_token, expires_at=expires_at)
+        basic_token = signed_token(vehicle_number, vehicle_mark)
         expected = {"message": f"spot {spot_number} is available"}
-        car_parking_model.query.filter_by(parking_spot=spot_number).first.return_value = \
-            CarParkingModel(parking_spot=spot_number)
+        db.session.execute().rowcount = 1
         with testapp.test_request_context(headers={"Authorization": basic_token}):
             result = leave(spot_number)
         self.assertEqual(expected, result)
@@ -283,47 +1486,74 @@ class Leave(TestCase):
 
 class ChangeSpot(TestCase):
 
-    @mock.patch('main.parking')
-    @mock.patch('main.AuthorizationModel')
-    @mock.patch('main.get_parking_spot')
-    def test_change_spot_fail(self, get_parking_spot, authorization_model, parking):
+    def setUp(self):
+        untrack_versions()
+
+    @mock.patch('main.occupy_spot')
+    @mock.patch('main.vacate_spot')
+    @mock.patch('main.find_car')
+    @mock.patch('main.db')
+    def test_change_spot_fail(self, db, find_car, vacate_spot, occupy_spot):
         expected = {message: "This spot is not available!"}
         spot_number = 3
         vehicle_number = "123"
         vehicle_mark = "honda"
-        basic_token = "Basic " + base64.encodebytes(('%s:%s' % (vehicle_number, vehicle_mark)).encode('utf8')).decode(
-            'utf8').replace('\n', '')
-        expires_at = int(time.mktime((datetime.now() + timedelta(minutes=15)).timetuple()))
-        authorization_model.query.filter_by(access_token=basic_token).first.return_value = AuthorizationModel(
-            access_token=basic_token, expires_at=expires_at)
-        get_parking_spot.return_value = {vehicle_number: spot_number}
-        parking.return_value = {message: "This spot is not available!"}
+        basic_token = signed_token(vehicle_number, vehicle_mark)
+        find_car.return_value = 1
+        vacate_spot.return_value = 1
+        occupy_spot.return_value = 0
         with testapp.test_request_context(json={"vehicle_number": vehicle_number, "vehicle_mark": vehicle_mark}, headers={"Authorization": basic_token}):
             result = change_spot(spot_number)
         self.assertEqual(expected, result)
+        db.session.rollback.assert_called_once()
+        db.session.commit.assert_not_called()
 
+    @mock.patch('main.find_car')
     @mock.patch('main.db')
-    @mock.patch('main.AuthorizationModel')
-    @mock.patch('main.leave')
-    @mock.patch('main.parking')
-    @mock.patch('main.get_parking_spot')
-    def test_change_spot_success(self, get_parking_spot, parking, leave, authorization_model, db):
+    def test_change_spot_not_parked(self, db, find_car):
+        vehicle_number = "123"
+        vehicle_mark = "honda"
+        expected = {message: f"Car {vehicle_number} not parked."}
+        basic_token = signed_token(vehicle_number, vehicle_mark)
+        find_car.return_value = None
+        with testapp.test_request_context(json={"vehicle_number": vehicle_number, "vehicle_mark": vehicle_mark}, headers={"Authorization": basic_token}):
+            result = change_spot(5)
+        self.assertEqual(expected, result)
+
+    @mock.patch('main.occupy_spot')
+    @mock.patch('main.vacate_spot')
+    @mock.patch('main.find_car')
+    @mock.patch('main.db')
+    def test_change_spot_success(self, db, find_car, vacate_spot, occupy_spot):
         spot_number = 3
         new_spot = 5
         vehicle_number = "123"
         vehicle_mark = "honda"
-        basic_token = "Basic " + base64.encodebytes(('%s:%s' % (vehicle_number, vehicle_mark)).encode('utf8')).decode(
-            'utf8').replace('\n', '')
-        expires_at = int(time.mktime((datetime.now() + timedelta(minutes=15)).timetuple()))
-        authorization_model.query.filter_by(access_token=basic_token).first.return_value = AuthorizationModel(
-            access_token=basic_token, expires_at=expires_at)
+        basic_token = signed_token(vehicle_number, vehicle_mark)
         expected = {"message": f"{vehicle_number} parked to {new_spot}"}
-        get_parking_spot.return_value = {vehicle_number: spot_number}
-        leave.return_value = {"message": f"spot {spot_number} is available"}
-        parking.return_value = {"parking spot": spot_number}
+        find_car.return_value = spot_number
+        vacate_spot.return_value = 1
+        occupy_spot.return_value = 1
+        lots[default_lot].occupancy.load([(spot_number, False), (new_spot, True)])
         with testapp.test_request_context(json={"vehicle_number": vehicle_number, "vehicle_mark": vehicle_mark}, headers={"Authorization": basic_token}):
             result = change_spot(new_spot)
         self.assertEqual(expected, result)
+        db.session.commit.assert_called_once()
+        self.assertEqual(spot_number, lots[default_lot].occupancy.next_free())
+
+    @mock.patch('main.vacate_spot')
+    @mock.patch('main.find_car')
+    @mock.patch('main.db')
+    def test_change_to_same_spot(self, db, find_car, vacate_spot):
+        vehicle_number = "123"
+        vehicle_mark = "honda"
+        basic_token = signed_token(vehicle_number, vehicle_mark)
+        find_car.return_value = 3
+        with testapp.test_request_context(json={"vehicle_number": vehicle_number, "vehicle_mark": vehicle_mark}, headers={"Authorization": basic_token}):
+            result = change_spot(3)
+        self.assertEqual({message: "This spot is not available!"}, result)
+        vacate_spot.assert_not_called()
+        db.session.commit.assert_not_called()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,63 @@
+from collections import OrderedDict
+import heapq
+import threading
+
+
+class TokenCache:
+    # LRU keyed on the Authorization header. A heap of (expires_at, key) lets
+    # expired entries be dropped before any live entry is evicted for space.
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.expiries = []
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, now):
+        with self.lock:
+            expires_at = self.entries.get(key)
+            if expires_at is None:
+                self.misses += 1
+                return None
+            if expires_at < now:
+                del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return expires_at
+
+    def put(self, key, expires_at, now):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.entries[key] = expires_at
+            self.entries.move_to_end(key)
+            heapq.heappush(self.expiries, (expires_at, key))
+            self._evict_expired(now)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+            if len(self.expiries) > 2 * self.maxsize:
+                self.expiries = [(e, k) for k, e in self.entries.items()]
+                heapq.heapify(self.expiries)
+
+    def _evict_expired(self, now):
+        while self.expiries and self.expiries[0][0] < now:
+            expires_at, key = heapq.heappop(self.expiries)
+            if self.entries.get(key) == expires_at:
+                del self.entries[key]
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.expiries = []
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries), "maxsize": self.maxsize}